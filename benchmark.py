@@ -0,0 +1,453 @@
+"""Benchmarks for the local file server
+
+Usage:
+    python benchmark.py download [--size-mb 256] [--rounds 5]
+    python benchmark.py zip [--files 2000] [--file-kb 512] [--workers 1,2,4,8]
+    python benchmark.py connections [--clients 2000]
+    python benchmark.py processes [--workers 1,2,4] [--clients 8] [--upload-mb 32]
+    python benchmark.py small-uploads [--files 2000] [--file-kb 16] [--rtt-ms 2]
+    python benchmark.py metrics [--requests 5000] [--size-mb 512] [--rounds 15]
+"""
+import argparse
+import concurrent.futures
+import http.client
+import os
+import resource
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import index
+
+BENCH_PORT = 8390
+
+class LegacyDownloadHandler(index.FileServerHandler):
+    """The original download loop: 8KB reads with a flush after every chunk"""
+
+    def copy_file_range(self, f, offset, length):
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(index.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            try:
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return False
+        return True
+
+def serve(mode, port):
+    """Run a server for one benchmark mode until terminated"""
+    handler = index.FileServerHandler
+    if mode == "legacy":
+        handler = LegacyDownloadHandler
+    elif mode == "buffered":
+        index.USE_SENDFILE = False
+    elif mode.startswith("zip-workers-"):
+        index.ZIP_WORKERS = int(mode.rsplit("-", 1)[1])
+    elif mode == "asyncio":
+        return index.AsyncFileServer(("127.0.0.1", port)).serve_forever()
+    elif mode.startswith("processes-"):
+        return index.Supervisor(("127.0.0.1", port), int(mode.rsplit("-", 1)[1]), "threaded").run()
+    with index.ThreadedTCPServer(("127.0.0.1", port), handler) as httpd:
+        httpd.serve_forever()
+
+def start_server(mode, workdir, port=BENCH_PORT):
+    """Start a benchmark server in a child process and wait until it accepts connections"""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "_serve", mode, str(port)],
+        cwd=workdir,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"Server for mode '{mode}' did not start")
+
+def stop_server(proc):
+    """Stop a benchmark server and return the CPU seconds it used"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    proc.terminate()
+    proc.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+def fetch(path, port=BENCH_PORT, headers=""):
+    """GET a path over a raw socket, discard the body and return the bytes received"""
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(f"GET {path} HTTP/1.0\r\nHost: localhost\r\n{headers}\r\n".encode())
+        total = 0
+        while True:
+            read = sock.recv_into(view)
+            if not read:
+                return total
+            total += read
+
+def bench_download(args):
+    """Compare download throughput and server CPU per GB across send paths"""
+    with tempfile.TemporaryDirectory() as workdir:
+        shared = os.path.join(workdir, index.DIRECTORY)
+        os.makedirs(shared)
+        with open(os.path.join(shared, "blob.bin"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        print(f"{'mode':<10} {'MB/s':>10} {'CPU s/GB':>10}")
+        for mode in ("legacy", "buffered", "sendfile"):
+            proc = start_server(mode, workdir)
+            try:
+                fetch("/blob.bin")  # Warm the page cache
+                received = 0
+                start = time.perf_counter()
+                for _ in range(args.rounds):
+                    received += fetch("/blob.bin")
+                elapsed = time.perf_counter() - start
+            finally:
+                cpu = stop_server(proc)
+            gigabytes = received / 1024 ** 3
+            print(f"{mode:<10} {received / 1024 ** 2 / elapsed:>10.1f} {cpu / gigabytes:>10.3f}")
+
+def bench_zip(args):
+    """Measure zip download throughput of a compressible source tree per worker count"""
+    with tempfile.TemporaryDirectory() as workdir:
+        tree = os.path.join(workdir, index.DIRECTORY, "tree")
+        os.makedirs(tree)
+        line = b"def function_%d(value):\n    return value * %d  # source-like filler\n"
+        total = 0
+        for i in range(args.files):
+            with open(os.path.join(tree, f"module_{i}.py"), "wb") as f:
+                data = b"".join(line % (n, n) for n in range(args.file_kb * 1024 // 60))
+                total += f.write(data)
+
+        print(f"source: {args.files} files, {total / 1024 ** 2:.1f} MB")
+        print(f"{'workers':<10} {'MB/s':>10} {'seconds':>10}")
+        for workers in args.workers.split(","):
+            proc = start_server(f"zip-workers-{workers}", workdir)
+            try:
+                start = time.perf_counter()
+                fetch("/download_zip?items=tree&compression=deflate")
+                elapsed = time.perf_counter() - start
+            finally:
+                stop_server(proc)
+            print(f"{workers:<10} {total / 1024 ** 2 / elapsed:>10.1f} {elapsed:>10.2f}")
+
+def process_status(pid):
+    """Thread count and resident memory (MB) of a process from /proc"""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["Threads"][0]), int(fields["VmRSS"][0]) / 1024
+
+def open_slow_clients(count, timeout=10):
+    """Open connections that send half a request head and stall, return the ones the server accepted"""
+    pending = selectors.DefaultSelector()
+    for _ in range(count):
+        sock = socket.socket()
+        sock.setblocking(False)
+        sock.connect_ex(("127.0.0.1", BENCH_PORT))
+        pending.register(sock, selectors.EVENT_WRITE)
+    connected = []
+    deadline = time.time() + timeout
+    while pending.get_map() and time.time() < deadline:
+        for key, _ in pending.select(timeout=0.5):
+            sock = key.fileobj
+            pending.unregister(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                sock.close()
+                continue
+            sock.setblocking(True)
+            sock.sendall(b"GET /small.txt HTTP/1.0\r\nHost: localhost\r\n")
+            connected.append(sock)
+    for key in list(pending.get_map().values()):
+        key.fileobj.close()
+    return connected
+
+def bench_connections(args):
+    """Hold many slow clients open per engine and check a fresh request is still served promptly"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 + 100)), hard))
+    with tempfile.TemporaryDirectory() as workdir:
+        shared = os.path.join(workdir, index.DIRECTORY)
+        os.makedirs(shared)
+        with open(os.path.join(shared, "small.txt"), "wb") as f:
+            f.write(b"x" * 4096)
+
+        print(f"{'engine':<10} {'clients':>8} {'accepted':>9} {'threads':>8} {'RSS MB':>8} {'fresh ms':>9} {'served':>8} {'seconds':>8}")
+        for engine in ("threaded", "asyncio"):
+            proc = start_server("sendfile" if engine == "threaded" else engine, workdir)
+            clients = []
+            try:
+                clients = open_slow_clients(args.clients)
+                time.sleep(1)
+                threads, rss = process_status(proc.pid)
+
+                start = time.perf_counter()
+                fetch("/small.txt")
+                fresh = (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                for sock in clients:
+                    sock.sendall(b"\r\n")
+                served = 0
+                for sock in clients:
+                    response = b""
+                    try:
+                        while True:
+                            data = sock.recv(65536)
+                            if not data:
+                                break
+                            response += data
+                    except OSError:
+                        pass
+                    served += response.startswith(b"HTTP/1.1 200") or response.startswith(b"HTTP/1.0 200")
+                elapsed = time.perf_counter() - start
+            finally:
+                for sock in clients:
+                    sock.close()
+                stop_server(proc)
+            print(f"{engine:<10} {args.clients:>8} {len(clients):>9} {threads:>8} {rss:>8.1f} {fresh:>9.1f} {served:>8} {elapsed:>8.2f}")
+
+def upload(body, boundary, port=BENCH_PORT):
+    """POST one multipart body to /upload and return the status line"""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(
+            f"POST /upload HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+            f"Content-Type: multipart/form-data; boundary={boundary}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode())
+        sock.sendall(body)
+        return sock.makefile("rb").readline()
+
+def bench_processes(args):
+    """Aggregate multipart upload throughput (CPU-bound parsing) per number of worker processes"""
+    boundary = "benchmarkboundary"
+    payload = (b"--%s\r\n" % boundary.encode()
+               + b'Content-Disposition: form-data; name="file"; filename="upload.bin"\r\n\r\n'
+               + bytes(range(256)) * (args.upload_mb * 4096)
+               + b"\r\n--%s--\r\n" % boundary.encode())
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, index.DIRECTORY))
+        print(f"{os.cpu_count()} cores, {args.clients} concurrent clients, {args.upload_mb} MB per upload")
+        print(f"{'workers':<10} {'MB/s':>10} {'seconds':>10}")
+        for workers in args.workers.split(","):
+            proc = start_server(f"processes-{workers}", workdir)
+            try:
+                results = []
+                clients = [threading.Thread(target=lambda: results.append(upload(payload, boundary)))
+                           for _ in range(args.clients)]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.perf_counter() - start
+            finally:
+                stop_server(proc)
+            ok = sum(line.startswith(b"HTTP/1.1 200") for line in results)
+            print(f"{workers:<10} {ok * args.upload_mb / elapsed:>10.1f} {elapsed:>10.2f}")
+
+def multipart_body(files, boundary):
+    """Encode (name, data) pairs as a multipart/form-data body"""
+    parts = []
+    for name, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b"\r\n")
+    return b"".join(parts) + f"--{boundary}--\r\n".encode()
+
+def post_files(connection, path, files, rtt=0, boundary="benchmarkboundary"):
+    body = multipart_body(files, boundary)
+    time.sleep(rtt)  # Simulated network round trip, loopback has none
+    connection.request("POST", path, body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+def bench_small_uploads(args):
+    """Small-file upload rate: one request per file (old client) vs parallel batches"""
+    files = [(f"photo_{i}.jpg", os.urandom(args.file_kb * 1024)) for i in range(args.files)]
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, index.DIRECTORY))
+        rtt = args.rtt_ms / 1000
+        print(f"{args.files} files of {args.file_kb} KB, {args.rtt_ms} ms simulated round trip per request")
+        print(f"{'client':<28} {'files/s':>10} {'seconds':>10}")
+        proc = start_server("sendfile", workdir)
+        try:
+            def sequential():
+                connection = http.client.HTTPConnection("127.0.0.1", BENCH_PORT)
+                for file in files:
+                    assert post_files(connection, "/upload", [file], rtt) == 200
+
+            def batched():
+                size = 200
+                batches = [files[i:i + size] for i in range(0, len(files), size)]
+
+                def send(batch):
+                    connection = http.client.HTTPConnection("127.0.0.1", BENCH_PORT)
+                    assert post_files(connection, "/api/upload_batch", batch, rtt) == 200
+
+                with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                    list(pool.map(send, batches))
+
+            for label, run in (("one request per file", sequential), ("batches of 200, 4 parallel", batched)):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                print(f"{label:<28} {args.files / elapsed:>10.1f} {elapsed:>10.2f}")
+        finally:
+            stop_server(proc)
+
+def process_cpu(pid):
+    """CPU seconds the threads of a process have run so far, from the nanosecond schedstat counters"""
+    total = 0
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/schedstat") as f:
+                total += int(f.read().split()[0])
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return total / 1e9
+
+def pipelined_gets(path, requests, port=BENCH_PORT):
+    """Pipeline GETs over persistent connections, each as long as the server allows, and return the bytes received"""
+    per_connection = index.MAX_KEEPALIVE_REQUESTS
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+    last = f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode()
+    buffer = bytearray(1024 * 1024)
+    total = 0
+    for first in range(0, requests, per_connection):
+        count = min(per_connection, requests - first)
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            # Send from a thread, responses must be read meanwhile or both sides block on full buffers
+            sender = threading.Thread(target=sock.sendall, args=(request * (count - 1) + last,))
+            sender.start()
+            while read := sock.recv_into(buffer):
+                total += read
+            sender.join()
+    return total
+
+def client_gets(path, requests, port=BENCH_PORT):
+    """Run pipelined_gets in a child process, keeping the client's CPU out of this process"""
+    subprocess.run([sys.executable, os.path.abspath(__file__), "_get", path, str(requests), str(port)], check=True)
+
+def bench_metrics(args):
+    """Server CPU per download with the /metrics instrumentation on and off"""
+    with tempfile.TemporaryDirectory() as workdir:
+        shared = os.path.join(workdir, index.DIRECTORY)
+        os.makedirs(shared)
+        with open(os.path.join(shared, "small.bin"), "wb") as f:
+            f.write(os.urandom(args.file_kb * 1024))
+        with open(os.path.join(shared, "blob.bin"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        # One server in this process, switched between modes chunk by chunk: two server processes
+        # differ in CPU per request by more than the instrumentation costs, even running identical code
+        os.chdir(workdir)
+        httpd = index.ThreadedTCPServer(("127.0.0.1", BENCH_PORT), index.FileServerHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        modes = {"metrics-off": False, "metrics-on": True}
+        samples = {(mode, kind): [] for mode in modes for kind in ("small", "large")}
+        try:
+            client_gets("/small.bin", 1000)  # Warm up
+            client_gets("/blob.bin", 1)
+            for round_ in range(args.rounds):
+                # Alternate which mode goes first, the second chunk of a round runs measurably slower
+                for mode in list(modes)[::1 if round_ % 2 else -1]:
+                    index.METRICS_ENABLED = modes[mode]
+                    cpu = process_cpu(os.getpid())
+                    start = time.perf_counter()
+                    client_gets("/small.bin", args.requests)
+                    elapsed = time.perf_counter() - start
+                    samples[mode, "small"].append(((process_cpu(os.getpid()) - cpu) / args.requests, args.requests / elapsed))
+                    cpu = process_cpu(os.getpid())
+                    start = time.perf_counter()
+                    client_gets("/blob.bin", 1)
+                    elapsed = time.perf_counter() - start
+                    samples[mode, "large"].append(((process_cpu(os.getpid()) - cpu) / (args.size_mb / 1024), args.size_mb / elapsed))
+        finally:
+            index.METRICS_ENABLED = True
+            httpd.shutdown()
+            httpd.server_close()
+
+        print(f"{'mode':<12} {'req/s':>10} {'CPU us/req':>11} {'MB/s':>10} {'CPU s/GB':>10}   (medians of {args.rounds} rounds)")
+        for mode in modes:
+            print(f"{mode:<12} {statistics.median(rate for _, rate in samples[mode, 'small']):>10.0f} "
+                  f"{statistics.median(cpu for cpu, _ in samples[mode, 'small']) * 1e6:>11.1f} "
+                  f"{statistics.median(rate for _, rate in samples[mode, 'large']):>10.1f} "
+                  f"{statistics.median(cpu for cpu, _ in samples[mode, 'large']):>10.3f}")
+        # Each round ran both modes back to back, so compare within rounds and report the spread:
+        # an overhead is only measured when its interquartile range excludes zero
+        for kind, label in (("small", "per small download"), ("large", "per GB of large downloads")):
+            overheads = sorted((on[0] - off[0]) / off[0] * 100
+                               for off, on in zip(samples["metrics-off", kind], samples["metrics-on", kind]))
+            low, _, high = statistics.quantiles(overheads, n=4) if len(overheads) > 1 else overheads * 3
+            verdict = "not distinguishable from noise" if low <= 0 <= high else "measurable"
+            print(f"overhead {label}: median {statistics.median(overheads):+.1f}% "
+                  f"(interquartile {low:+.1f}% .. {high:+.1f}%, {verdict})")
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "_serve":
+        return serve(sys.argv[2], int(sys.argv[3]))
+    if len(sys.argv) > 1 and sys.argv[1] == "_get":
+        return pipelined_gets(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    download = commands.add_parser("download", help="download throughput: legacy loop vs buffered vs sendfile")
+    download.add_argument("--size-mb", type=int, default=256)
+    download.add_argument("--rounds", type=int, default=5)
+    download.set_defaults(func=bench_download)
+
+    zip_parser = commands.add_parser("zip", help="zip download throughput by number of deflate workers")
+    zip_parser.add_argument("--files", type=int, default=2000)
+    zip_parser.add_argument("--file-kb", type=int, default=512)
+    zip_parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4, 8, 16)))
+    zip_parser.set_defaults(func=bench_zip)
+
+    connections = commands.add_parser("connections", help="idle/slow connection load: threaded vs asyncio engine")
+    connections.add_argument("--clients", type=int, default=2000)
+    connections.set_defaults(func=bench_connections)
+
+    processes = commands.add_parser("processes", help="CPU-bound upload throughput by number of worker processes")
+    processes.add_argument("--workers", default="1,2,4")
+    processes.add_argument("--clients", type=int, default=8)
+    processes.add_argument("--upload-mb", type=int, default=32)
+    processes.set_defaults(func=bench_processes)
+
+    small = commands.add_parser("small-uploads", help="small-file upload rate: per-file requests vs batches")
+    small.add_argument("--files", type=int, default=2000)
+    small.add_argument("--file-kb", type=int, default=16)
+    small.add_argument("--rtt-ms", type=float, default=2, help="round trip added per request to model a LAN")
+    small.set_defaults(func=bench_small_uploads)
+
+    metrics = commands.add_parser("metrics", help="download CPU cost of the /metrics instrumentation")
+    metrics.add_argument("--requests", type=int, default=5000, help="small-file GETs per round and mode")
+    metrics.add_argument("--file-kb", type=int, default=4)
+    metrics.add_argument("--size-mb", type=int, default=512)
+    metrics.add_argument("--rounds", type=int, default=15)
+    metrics.set_defaults(func=bench_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,438 +1,4249 @@
 import http.server
+import http.client
 import socketserver
+import asyncio
+import argparse
+import signal
+import traceback
+import stat
+import sys
 import os
+import re
+import email.utils
+import uuid
 import urllib
 import io
 import socket
 import threading
 import time
+import json
+import gzip
+import hashlib
 import zipfile
+import zlib
+import struct
+import collections
+import itertools
+import bisect
+import concurrent.futures
+import queue
 import tempfile
+import shutil
+import sqlite3
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import select
+import selectors
 from urllib.parse import parse_qs, urlparse
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Resumable upload sessions are then only locked within one process
+
+try:
+    import brotli  # Optional, enables precompressed br variants of the UI assets
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps  # Optional, thumbnails for every image format instead of embedded JPEG ones
+except ImportError:
+    Image = ImageOps = None
+
 PORT = 8303
 DIRECTORY = "shared"
-MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # 100MB limit
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024 * 1024  # 10GB limit, uploads are streamed to disk
 CHUNK_SIZE = 8192  # 8KB chunks
+USE_SENDFILE = hasattr(os, "sendfile")  # Zero-copy downloads where the platform supports it
+COPY_BUFFER_SIZE = 1024 * 1024  # Reusable buffer for downloads when sendfile is unavailable
+ZIP_BUFFER_SIZE = 256 * 1024  # Output batching for streamed zip archives
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Read size for the streaming multipart parser
+MAX_PART_HEADER_SIZE = 16 * 1024  # Limit for the headers of a single multipart part
+MAX_FORM_FIELD_SIZE = 64 * 1024  # Limit for non-file form fields held in memory
+PARTIAL_UPLOAD_PREFIX = ".upload-"  # In-progress uploads are hidden from listings
+UPLOAD_SESSION_DIR = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "sessions")  # Resumable uploads in progress
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size suggested to resumable upload clients
+UPLOAD_SESSION_TTL = 7 * 24 * 3600  # Seconds an untouched resumable upload is kept
+UPLOAD_BATCH_FILE_LIMIT = 1024 * 1024  # Batch-uploaded files up to this size are buffered and written in parallel
+UPLOAD_WRITERS = 4  # Threads writing batch-uploaded files to disk
+DEDUP_STORAGE = False  # Store identical uploads once, hardlinked into the shared tree (also --dedup)
+BLOB_STORE_DIR = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "blobs")  # Content-addressed upload data
+BLOB_GC_INTERVAL = 3600  # Seconds between collections of blobs no file links to any more
+MAX_RANGES = 64  # Range headers with more parts than this are ignored
+ZIP_COMPRESSION = "auto"  # auto (skip already-compressed data), deflate or store
+ZIP_COMPRESSLEVEL = 6  # Deflate level used for zip downloads
+ZIP_SAMPLE_SIZE = 64 * 1024  # Bytes sampled to detect incompressible files
+ZIP_INCOMPRESSIBLE_RATIO = 0.95  # Samples that shrink less than this are stored
+ZIP_WORKERS = os.cpu_count() or 1  # Deflate threads shared by zip downloads, 1 disables parallel mode
+ZIP_BLOCK_SIZE = 1024 * 1024  # Members are deflated in blocks of this size across the workers
+ZIP64_LIMIT = 0xFFFFFFFF
+LISTING_CACHE_SIZE = 256  # Directories whose listings are kept in memory
+LISTING_PAGE_SIZE = 200  # File cards rendered up front, the rest load while scrolling
+API_LIST_MAX_LIMIT = 5000  # Largest page /api/list returns as a single JSON document
+IDLE_TIMEOUT = 30  # Seconds a client may stall inside a request (and idle between requests under asyncio)
+KEEPALIVE_TIMEOUT = 5  # Seconds an idle persistent connection may hold a worker thread
+KEEPALIVE_POLL_INTERVAL = 0.1  # Seconds between checks whether an idle connection should free its worker for queued ones
+MAX_KEEPALIVE_REQUESTS = 100  # Requests served on one connection before it is closed
+MAX_REQUEST_HEAD_SIZE = 64 * 1024  # Request line plus headers
+MAX_WORKERS = 64  # Request threads (per connection when threaded, per bridged request under asyncio)
+MAX_QUEUED_CONNECTIONS = 256  # Requests waiting for a worker before new ones get 503
+MAX_HEAVY_REQUESTS = 8  # Concurrent uploads and ZIP builds (a browser opens up to 6 connections)
+HEAVY_REQUEST_WAIT = 2  # Seconds an upload or ZIP build waits for a slot before 503
+RETRY_AFTER = 5  # Seconds clients are asked to wait after a 503
+DRAIN_TIMEOUT = 30  # Seconds a stopping server waits for in-flight requests
+BANDWIDTH_LIMIT = 0  # Bytes/s shared by all bulk downloads, 0 = unlimited (adjustable via /api/bandwidth)
+CLIENT_BANDWIDTH_LIMIT = 0  # Bytes/s for the bulk downloads of one client IP, 0 = unlimited
+PRIORITY_RESPONSE_SIZE = 256 * 1024  # Smaller responses (listings, API, assets) bypass shaping
+SHAPING_BURST = 256 * 1024  # Token bucket depth of a shaped transfer
+BANDWIDTH_LIMITS_PATH = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "bandwidth.json")  # Runtime limits shared by --workers processes
+SHAPING_SLICE = 64 * 1024  # Shaped transfers are sent in slices of this size
+TRANSFER_WEIGHTS = {"file": 2, "zip": 1}  # Fair-share weights: plain downloads before bulk ZIP archives
+METRICS_ENABLED = True  # Record per-route request metrics for /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Histogram bounds in seconds
+CONTENT_ENCODING_MIN_SIZE = 1024  # Compressible downloads smaller than this are sent as is
+CONTENT_ENCODING_LEVELS = {"gzip": 6, "br": 5}  # Levels for text downloads, compressed once per file version
+ENCODED_CACHE_DIR = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "encoded")  # Precompressed sidecars of text downloads
+ENCODED_CACHE_SIZE = 512 * 1024 * 1024  # Sidecar bytes kept before the least recently used are evicted
+SEARCH_INDEX_ENABLED = True  # Keep a catalog of every path for /api/search (a background thread and a SQLite file)
+SEARCH_INDEX_PATH = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "index.sqlite")  # The search catalog
+SEARCH_RESCAN_INTERVAL = 600  # Seconds between rescans picking up changes made outside the server
+SEARCH_HASH_FILES = False  # Also record each file's SHA-256 (reads every new or changed file)
+SEARCH_RESULT_LIMIT = 500  # Largest page /api/search returns
+WATCH_CHANGES = True  # Follow changes other processes make in the share (inotify, else polling)
+WATCH_POLL_INTERVAL = 2  # Seconds between directory checks when inotify is unavailable
+WATCH_LEADER_PATH = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "watch.lock")  # Held by the one process feeding the catalog from watcher events
+SSE_MAX_STREAMS = 1024  # Browsers subscribed to live folder updates via /events, further ones get 503
+SSE_MAX_BUFFER = 256 * 1024  # Bytes queued for a subscriber that stopped reading before it is dropped
+SSE_HEARTBEAT = 15  # Seconds between keep-alive comments on idle /events streams
+THUMB_SIZES = (128, 256, 512)  # Edge lengths /thumb renders, other sizes are rounded up to one of these
+THUMB_CARD_SIZE = 256  # Thumbnail size shown on the file cards
+THUMB_QUALITY = 80  # JPEG quality of rendered thumbnails
+THUMB_WORKERS = 2  # Threads rendering thumbnails, requests beyond them wait in line
+THUMB_WAIT = 15  # Seconds a /thumb request waits for its render before a 503
+THUMB_CACHE_DIR = os.path.join(DIRECTORY, PARTIAL_UPLOAD_PREFIX + "thumbs")  # Rendered thumbnails
+THUMB_CACHE_SIZE = 256 * 1024 * 1024  # Thumbnail bytes kept before the least recently used are evicted
+BATCH_WORKERS = 8  # Threads carrying out /api/batch operations, shared by all batches
+BATCH_MAX_OPERATIONS = 10000  # Operations accepted in one /api/batch request
+BATCH_MAX_BODY = 4 * 1024 * 1024  # Largest /api/batch request body
+
+# Cache-Control per kind of response; "no-cache" lets clients keep a copy but revalidate it
+# with If-None-Match / If-Modified-Since, which costs a single 304 round trip when unchanged
+CACHE_POLICIES = {
+    "files": "no-cache",
+    "listing": "no-cache",
+    "api": "no-cache",
+    "static": "public, max-age=31536000, immutable",  # Versioned UI assets never change
+    "default": "no-cache, no-store, must-revalidate",
+}
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp'}
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv'}
+AUDIO_EXTENSIONS = {'.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma'}
+CODE_EXTENSIONS = {'.py', '.js', '.html', '.css', '.php', '.java', '.cpp', '.c', '.h'}
+ARCHIVE_EXTENSIONS = {'.zip', '.rar', '.7z', '.tar', '.gz'}
+TEXT_EXTENSIONS = {'.txt', '.md', '.log', '.csv'}
+EXECUTABLE_EXTENSIONS = {'.exe', '.msi', '.deb', '.rpm', '.dmg'}
+DOCUMENT_EXTENSIONS = {'.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx'}
+
+# Images /thumb can render; without Pillow only JPEGs carrying an EXIF thumbnail
+THUMBNAIL_EXTENSIONS = IMAGE_EXTENSIONS - {'.svg'} if Image is not None else {'.jpg', '.jpeg'}
+
+# Categories for the type filter of /api/search, checked in order
+FILE_TYPES = (
+    ('image', IMAGE_EXTENSIONS),
+    ('video', VIDEO_EXTENSIONS),
+    ('audio', AUDIO_EXTENSIONS),
+    ('document', DOCUMENT_EXTENSIONS),
+    ('code', CODE_EXTENSIONS),
+    ('archive', ARCHIVE_EXTENSIONS),
+    ('text', TEXT_EXTENSIONS),
+    ('executable', EXECUTABLE_EXTENSIONS),
+)
+FILE_TYPE_NAMES = {'folder', 'other'} | {name for name, _ in FILE_TYPES}
+
+# Formats whose payload is already compressed, deflating them again only burns CPU
+COMPRESSED_EXTENSIONS = (
+    (IMAGE_EXTENSIONS - {'.bmp', '.svg'})
+    | VIDEO_EXTENSIONS
+    | (AUDIO_EXTENSIONS - {'.wav'})
+    | (ARCHIVE_EXTENSIONS - {'.tar'})
+    | {'.docx', '.xlsx', '.pptx', '.pdf', '.bz2', '.xz', '.zst', '.tgz', '.msi', '.deb', '.rpm', '.dmg'}
+)
+
+# Text formats worth a gzip/br Content-Encoding on download
+COMPRESSIBLE_EXTENSIONS = (
+    TEXT_EXTENSIONS
+    | CODE_EXTENSIONS
+    | {'.json', '.xml', '.svg', '.tsv', '.yaml', '.yml', '.ini', '.toml', '.sql', '.sh', '.ts', '.rst'}
+)
+
+def get_local_ip():
+    """Detect local LAN IP address"""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+        s.close()
+    except Exception:
+        ip = "127.0.0.1"
+    return ip
+
+class MultipartError(ValueError):
+    """Raised when a multipart/form-data body is malformed or truncated"""
+
+def get_multipart_boundary(content_type):
+    """Extract the boundary parameter from a multipart Content-Type header"""
+    if "multipart/form-data" not in content_type:
+        return None
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"').encode("latin-1")
+    return None
+
+def parse_content_disposition(value):
+    """Parse a Content-Disposition header value into a dict of its parameters"""
+    params = {}
+    for match in re.finditer(r'([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))', value):
+        key = match.group(1).lower()
+        params[key] = match.group(2) if match.group(2) is not None else match.group(3)
+    return params
+
+class MultipartPart:
+    """A single part of a multipart body whose data is pulled lazily from the parser"""
+
+    def __init__(self, parser, headers):
+        self.parser = parser
+        self.headers = headers
+        disposition = parse_content_disposition(headers.get("content-disposition", ""))
+        self.name = disposition.get("name", "")
+        self.filename = disposition.get("filename")
+
+    def iter_chunks(self):
+        """Yield the part's data in bounded chunks until the next boundary"""
+        return self.parser._iter_part_data()
+
+    def read_value(self, limit=MAX_FORM_FIELD_SIZE):
+        """Read a small, non-file form field into memory"""
+        value = bytearray()
+        for chunk in self.iter_chunks():
+            value += chunk
+            if len(value) > limit:
+                raise MultipartError(f"Form field '{self.name}' is too large")
+        return bytes(value)
+
+class MultipartParser:
+    """Incremental multipart/form-data parser that never holds more than one chunk in memory"""
+
+    def __init__(self, rfile, boundary, content_length, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.rfile = rfile
+        self.remaining = content_length
+        self.chunk_size = chunk_size
+        self.delimiter = b"\r\n--" + boundary
+        # Prefix CRLF so the very first boundary matches the same delimiter
+        self.buffer = bytearray(b"\r\n")
+        self.part_open = False
+        self.finished = False
+
+    def _fill(self):
+        """Read the next chunk of the body into the buffer, returns False at EOF"""
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Upload was truncated")
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _find(self, needle, limit=MAX_PART_HEADER_SIZE):
+        """Find needle within the first limit bytes of the buffer, reading more data as needed"""
+        start = 0
+        while True:
+            index = self.buffer.find(needle, start)
+            if index != -1:
+                return index
+            if len(self.buffer) > limit:
+                return -1
+            start = max(0, len(self.buffer) - len(needle) + 1)
+            if not self._fill():
+                return -1
+
+    def _after_delimiter(self):
+        """Consume the bytes after a boundary, returns False on the closing boundary"""
+        while len(self.buffer) < 2 and self._fill():
+            pass
+        if self.buffer[:2] == b"--":
+            self.finished = True
+            return False
+        end = self._find(b"\r\n")
+        if end == -1:
+            raise MultipartError("Malformed multipart boundary")
+        del self.buffer[:end + 2]
+        return True
+
+    def _iter_part_data(self):
+        """Yield part data up to the next delimiter, keeping back a possible partial match"""
+        keep = len(self.delimiter) + 1
+        while self.part_open:
+            index = self.buffer.find(self.delimiter)
+            if index != -1:
+                if index:
+                    yield bytes(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                self.part_open = False
+                return
+            if len(self.buffer) > keep:
+                chunk = bytes(self.buffer[:-keep])
+                del self.buffer[:-keep]
+                yield chunk
+            if not self._fill():
+                raise MultipartError("Upload was truncated")
+
+    def __iter__(self):
+        """Yield MultipartPart objects in order; unread part data is skipped automatically"""
+        index = self._find(self.delimiter)
+        if index == -1:
+            raise MultipartError("No multipart boundary found")
+        del self.buffer[:index + len(self.delimiter)]
+
+        while self._after_delimiter():
+            end = self._find(b"\r\n\r\n")
+            if end == -1:
+                raise MultipartError("Malformed multipart part headers")
+            headers = {}
+            for line in bytes(self.buffer[:end]).decode("utf-8", "replace").split("\r\n"):
+                key, _, value = line.partition(":")
+                if key:
+                    headers[key.strip().lower()] = value.strip()
+            del self.buffer[:end + 4]
+
+            self.part_open = True
+            yield MultipartPart(self, headers)
+            for _ in self._iter_part_data():
+                pass
+
+        # Discard any epilogue so the request body is fully consumed
+        self.buffer.clear()
+        while self._fill():
+            self.buffer.clear()
+
+def get_umask():
+    """Read the process umask (os.umask can only be queried by setting it)"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+FILE_MODE = 0o666 & ~get_umask()
+
+UPLOAD_SESSION_ROUTE = re.compile(r'^/api/uploads/([0-9a-f]{32})(/complete)?$')
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read with the per-thread copy buffer"""
+    digest = hashlib.sha256()
+    buffer = get_copy_buffer()
+    with open(path, 'rb') as f:
+        while read := f.readinto(buffer):
+            digest.update(buffer[:read])
+    return digest.hexdigest()
+
+class BlobStore:
+    """Content-addressed upload data, one file per SHA-256 digest under directory/<2 hex>/<digest>.
+
+    Files in the shared tree are hardlinks to their blob, so re-uploading
+    known content only adds a link and a blob whose link count drops back
+    to one is unreferenced. Linked copies share one inode: uploads and
+    renames replace files, which is safe, but nothing may edit them in place.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.collected = time.monotonic()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def link(self, blob_path, final_path):
+        """Atomically make final_path another link to a blob"""
+        link_path = os.path.join(os.path.dirname(final_path), f"{PARTIAL_UPLOAD_PREFIX}{uuid.uuid4().hex}.link")
+        os.link(blob_path, link_path)
+        os.replace(link_path, final_path)
+        # rename() is a no-op when both names already link the same blob
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(link_path)
+
+    def store(self, temp_path, digest, final_path):
+        """Publish a fully written upload at final_path, returns True if its content was already stored"""
+        blob_path = self.path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        for _ in range(2):  # Once more if the blob is collected between the two links
+            try:
+                os.link(temp_path, blob_path)
+                break  # New content, the upload itself becomes the blob
+            except FileExistsError:
+                pass
+            except OSError:
+                break  # No hardlinks here (other filesystem, link limit), keep a plain copy
+            try:
+                self.link(blob_path, final_path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                break
+            os.unlink(temp_path)
+            return True
+        os.replace(temp_path, final_path)
+        if time.monotonic() - self.collected > BLOB_GC_INTERVAL:
+            self.collect()
+        return False
+
+    def link_existing(self, digest, size, final_path):
+        """Publish known content without receiving it, False if no blob of that digest and size exists"""
+        blob_path = self.path(digest)
+        try:
+            if os.stat(blob_path).st_size != size:
+                return False
+            self.link(blob_path, final_path)
+        except OSError:
+            return False
+        return True
+
+    def collect(self):
+        """Remove blobs that no file in the shared tree links to, returns (blobs, bytes) freed"""
+        self.collected = time.monotonic()
+        blobs = freed = 0
+        try:
+            shards = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+        except FileNotFoundError:
+            return blobs, freed
+        for shard in shards:
+            with os.scandir(shard) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        if st.st_nlink == 1:
+                            os.unlink(entry.path)
+                            blobs += 1
+                            freed += st.st_size
+                    except OSError:
+                        pass
+        return blobs, freed
+
+BLOB_STORE = BlobStore(BLOB_STORE_DIR)
+
+def save_upload_stream(chunks, filename, directory=DIRECTORY):
+    """Write an uploaded file to disk chunk by chunk, renaming it into place once complete"""
+    final_path = os.path.join(directory, os.path.basename(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=PARTIAL_UPLOAD_PREFIX, suffix=".part")
+    digest = hashlib.sha256() if DEDUP_STORAGE else None
+    try:
+        os.chmod(temp_path, FILE_MODE)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        if digest is not None:
+            # A duplicate's temp file is unlinked before writeback, so its data never reaches the disk
+            BLOB_STORE.store(temp_path, digest.hexdigest(), final_path)
+        else:
+            os.replace(temp_path, final_path)
+        LISTING_CACHE.invalidate(final_path)
+        SEARCH_INDEX.changed(final_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return final_path
+
+class UploadSessionError(ValueError):
+    """Raised for a resumable upload request that cannot be applied, carrying the HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def merge_ranges(ranges):
+    """Merge [start, end) byte ranges into a sorted list of disjoint ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(committed, size):
+    """The [start, end) gaps left between committed ranges of a file of size bytes"""
+    missing = []
+    position = 0
+    for start, end in committed:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+class UploadSessions:
+    """Resumable uploads persisted as <id>.json (metadata) and <id>.part (data) under one directory.
+
+    Chunks are written straight into the preallocated .part file at their
+    offset, in any order and from several requests at once; their byte
+    ranges are only recorded once fully written. Metadata updates are
+    serialised with a thread lock plus flock(), so sessions stay
+    consistent across --workers processes and survive restarts.
+    """
+
+    def __init__(self, directory=UPLOAD_SESSION_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def paths(self, session_id):
+        if not re.fullmatch(r'[0-9a-f]{32}', session_id):
+            raise UploadSessionError(404, "Unknown upload session")
+        base = os.path.join(self.directory, session_id)
+        return base + '.json', base + '.part'
+
+    def create(self, filename, size, sha256=None):
+        name = os.path.basename(filename or '')
+        if not name or name.startswith(PARTIAL_UPLOAD_PREFIX):
+            raise UploadSessionError(400, "A valid filename is required")
+        if not isinstance(size, int) or size < 0:
+            raise UploadSessionError(400, "File size must be a non-negative integer")
+        if size > MAX_UPLOAD_SIZE:
+            raise UploadSessionError(413, "File too large")
+        if sha256 is not None and not (isinstance(sha256, str) and re.fullmatch(r'[0-9a-f]{64}', sha256)):
+            raise UploadSessionError(400, "sha256 must be a lowercase hex digest")
+        final_path = os.path.join(DIRECTORY, name)
+        if DEDUP_STORAGE and sha256 and BLOB_STORE.link_existing(sha256, size, final_path):
+            # Known content: the upload completes without sending any data
+            LISTING_CACHE.invalidate(final_path)
+            SEARCH_INDEX.changed(final_path)
+            return {'id': None, 'filename': name, 'size': size, 'sha256': sha256, 'deduplicated': True}
+        os.makedirs(self.directory, exist_ok=True)
+        self.expire()
+        if shutil.disk_usage(self.directory).free < size:
+            raise UploadSessionError(507, "Not enough free disk space")
+
+        session = {'id': uuid.uuid4().hex, 'filename': name, 'size': size, 'sha256': sha256,
+                   'created': time.time(), 'committed': []}
+        meta_path, data_path = self.paths(session['id'])
+        with open(data_path, 'wb') as f:
+            os.chmod(data_path, FILE_MODE)
+            f.truncate(size)  # Sparse until the chunks arrive
+        self.save(session)
+        return session
+
+    def get(self, session_id):
+        meta_path, _ = self.paths(session_id)
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadSessionError(404, "Unknown upload session") from None
+
+    def save(self, session):
+        meta_path, _ = self.paths(session['id'])
+        temp_path = meta_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(session, f)
+        os.replace(temp_path, meta_path)
+
+    @contextlib.contextmanager
+    def locked(self, session_id):
+        """Hold the session's metadata lock across threads and worker processes"""
+        _, data_path = self.paths(session_id)
+        with self.lock:
+            try:
+                fd = os.open(data_path, os.O_RDONLY)
+            except FileNotFoundError:
+                raise UploadSessionError(404, "Unknown upload session") from None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def write_chunk(self, session_id, start, end, chunks):
+        """Write the chunk for bytes [start, end) and record it as committed"""
+        session = self.get(session_id)
+        if not 0 <= start < end <= session['size']:
+            raise UploadSessionError(416, "Chunk lies outside the file")
+        _, data_path = self.paths(session_id)
+        try:
+            f = open(data_path, 'r+b')
+        except FileNotFoundError:
+            raise UploadSessionError(404, "Unknown upload session") from None
+        with f:
+            f.seek(start)
+            for chunk in chunks:
+                f.write(chunk)
+            if f.tell() != end:
+                raise UploadSessionError(400, "Chunk body does not match its Content-Range")
+        with self.locked(session_id):
+            session = self.get(session_id)
+            session['committed'] = merge_ranges(session['committed'] + [[start, end]])
+            self.save(session)
+        return session
+
+    def complete(self, session_id):
+        """Rename a fully committed upload into DIRECTORY, returning (final path or None, missing ranges)"""
+        with self.locked(session_id):
+            session = self.get(session_id)
+            missing = missing_ranges(session['committed'], session['size'])
+            if missing:
+                return None, missing
+            meta_path, data_path = self.paths(session_id)
+            final_path = os.path.join(DIRECTORY, session['filename'])
+            digest = hash_file(data_path) if DEDUP_STORAGE or session.get('sha256') else None
+            if session.get('sha256') and digest != session['sha256']:
+                raise UploadSessionError(422, "Uploaded data does not match the sha256 digest")
+            if DEDUP_STORAGE:
+                BLOB_STORE.store(data_path, digest, final_path)
+            else:
+                os.replace(data_path, final_path)
+            os.unlink(meta_path)
+        LISTING_CACHE.invalidate(final_path)
+        SEARCH_INDEX.changed(final_path)
+        return final_path, []
+
+    def abort(self, session_id):
+        with self.locked(session_id):
+            for path in self.paths(session_id):
+                os.unlink(path)
+
+    def expire(self):
+        """Remove sessions untouched for UPLOAD_SESSION_TTL seconds"""
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        stale = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        stale.append(entry.path)
+                except OSError:
+                    pass  # Completed or aborted meanwhile
+        for meta_path in stale:
+            for path in (meta_path, meta_path[:-len('.json')] + '.part'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+UPLOAD_SESSIONS = UploadSessions()
+
+_copy_buffers = threading.local()
+_zip_executor = None
+_zip_executor_lock = threading.Lock()
+_upload_writers = None
+_upload_writers_lock = threading.Lock()
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def get_copy_buffer():
+    """Get this thread's reusable buffer for the non-sendfile copy path"""
+    buffer = getattr(_copy_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _copy_buffers.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return buffer
+
+class ResponseStream(io.RawIOBase):
+    """Write-only file object over a response body, optionally using chunked framing"""
+
+    def __init__(self, wfile, chunked=False, transfer=None):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.transfer = transfer  # Bandwidth shaping Transfer, None when unshaped
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not data:
+            return 0
+        if self.transfer is not None:
+            self.transfer.throttle(len(data))
+        if self.chunked:
+            self.wfile.write(b"%x\r\n" % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+        else:
+            self.wfile.write(data)
+        return len(data)
+
+    def finish(self):
+        """Mark the body as complete; only a finished chunked body gets its terminator"""
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+def iter_zip_members(items, directory=DIRECTORY):
+    """Yield (file_path, arc_name) for every file under the requested items, walking lazily"""
+    for item in items:
+        item_path = os.path.join(directory, item)
+        if os.path.isfile(item_path):
+            # Add single file
+            yield item_path, item
+        elif os.path.isdir(item_path):
+            # Add entire directory
+            for root, dirs, files in os.walk(item_path):
+                # Skip the hidden upload session and sidecar directories
+                dirs[:] = sorted(d for d in dirs if not d.startswith(PARTIAL_UPLOAD_PREFIX))
+                for file in sorted(files):
+                    if file.startswith(PARTIAL_UPLOAD_PREFIX):
+                        continue
+                    file_path = os.path.join(root, file)
+                    yield file_path, os.path.relpath(file_path, directory)
+
+def choose_zip_compression(file_path, mode=ZIP_COMPRESSION):
+    """Pick ZIP_STORED or ZIP_DEFLATED for a file according to the compression mode"""
+    if mode == "store":
+        return zipfile.ZIP_STORED
+    if mode == "deflate":
+        return zipfile.ZIP_DEFLATED
+    if os.path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    try:
+        with open(file_path, 'rb') as f:
+            sample = f.read(ZIP_SAMPLE_SIZE)
+    except OSError:
+        return zipfile.ZIP_DEFLATED
+    if not sample:
+        return zipfile.ZIP_STORED
+    # A fast level-1 pass over the first block is enough to spot random-looking data
+    if len(zlib.compress(sample, 1)) > len(sample) * ZIP_INCOMPRESSIBLE_RATIO:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def parse_zip_compression(value):
+    """Parse a ?compression= override into (mode, level), falling back to the defaults"""
+    value = (value or "").strip().lower()
+    if value.isdigit() and 0 <= int(value) <= 9:
+        level = int(value)
+        return ("store", ZIP_COMPRESSLEVEL) if level == 0 else ("deflate", level)
+    if value in ("auto", "deflate", "store"):
+        return value, ZIP_COMPRESSLEVEL
+    return ZIP_COMPRESSION, ZIP_COMPRESSLEVEL
+
+def get_zip_executor():
+    """Get the thread pool shared by all parallel zip downloads, creating it on first use"""
+    global _zip_executor
+    with _zip_executor_lock:
+        if _zip_executor is None:
+            _zip_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ZIP_WORKERS, thread_name_prefix="zip-deflate")
+        return _zip_executor
+
+def get_upload_writers():
+    """Get the thread pool that writes batch-uploaded files, creating it on first use"""
+    global _upload_writers
+    with _upload_writers_lock:
+        if _upload_writers is None:
+            _upload_writers = concurrent.futures.ThreadPoolExecutor(
+                max_workers=UPLOAD_WRITERS, thread_name_prefix="upload-writer")
+        return _upload_writers
+
+def deflate_block(data, level, zdict, final):
+    """Raw-deflate one block, primed with the previous block so the stream stays continuous"""
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # A sync flush ends on a byte boundary without closing the stream, so blocks concatenate
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+def zip_dos_time(timestamp):
+    """Convert a Unix timestamp to the (time, date) pair used in zip headers"""
+    t = time.localtime(max(timestamp, 315532800))  # Zip dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class ZipMember:
+    """Bookkeeping for one archive member while it is written and for the central directory"""
+
+    def __init__(self, arc_name, st, compress_type, offset):
+        self.name = arc_name.replace(os.sep, "/").encode("utf-8")
+        self.flags = 0x08 | (0x800 if not arc_name.isascii() else 0)  # Data descriptor, UTF-8 name
+        self.compress_type = compress_type
+        self.dos_time, self.dos_date = zip_dos_time(st.st_mtime)
+        self.external_attr = (st.st_mode & 0xFFFF) << 16
+        # Sizes are only known afterwards, so decide on ZIP64 from the size on disk
+        self.zip64 = st.st_size * 1.05 >= ZIP64_LIMIT
+        self.offset = offset
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+class ParallelZipWriter:
+    """Streaming zip writer that deflates members on a shared thread pool.
+
+    Each member is cut into ZIP_BLOCK_SIZE blocks that are compressed
+    concurrently (each primed with the tail of the previous block, as pigz
+    does) and written back in order. At most `window` blocks are in flight,
+    so memory stays bounded whatever the archive size. ZIP64 records are
+    emitted for members over 4GB and archives with more than 65535 entries.
+    """
+
+    def __init__(self, out, executor, level=ZIP_COMPRESSLEVEL, window=None):
+        self.out = out
+        self.executor = executor
+        self.level = level
+        self.window = window or ZIP_WORKERS * 2
+        self.offset = 0
+        self.members = []
+        self.pending = collections.deque()
+        self.in_flight = 0
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def write_members(self, members):
+        """Write every (file_path, arc_name, compress_type) and the central directory"""
+        for file_path, arc_name, compress_type in members:
+            try:
+                f = open(file_path, 'rb')
+            except OSError:
+                # Vanished between the walk and the read, leave it out
+                continue
+            with f:
+                self._queue_member(f, arc_name, compress_type)
+        while self.pending:
+            self._drain_one()
+        self._write_central_directory()
+
+    def _queue_member(self, f, arc_name, compress_type):
+        st = os.fstat(f.fileno())
+        member = ZipMember(arc_name, st, compress_type, None)
+        self._push(("start", member, None, None))
+        previous = None
+        block = f.read(ZIP_BLOCK_SIZE)
+        while True:
+            following = f.read(ZIP_BLOCK_SIZE) if block else b""
+            final = not following
+            if compress_type == zipfile.ZIP_DEFLATED:
+                zdict = previous[-32768:] if previous else None
+                future = self.executor.submit(deflate_block, block, self.level, zdict, final)
+            else:
+                future = None
+            self._push(("block", member, block, future))
+            if final:
+                break
+            previous, block = block, following
+        self._push(("end", member, None, None))
+
+    def _push(self, event):
+        self.pending.append(event)
+        if event[0] == "block":
+            # Stored blocks count too, or whole stored members would pile up in pending
+            self.in_flight += 1
+        while self.in_flight > self.window:
+            self._drain_one()
+
+    def _drain_one(self):
+        kind, member, data, future = self.pending.popleft()
+        if kind == "start":
+            member.offset = self.offset
+            self._write_local_header(member)
+        elif kind == "block":
+            member.crc = zlib.crc32(data, member.crc)
+            member.file_size += len(data)
+            self.in_flight -= 1
+            if future is not None:
+                data = future.result()
+            member.compress_size += len(data)
+            self._write(data)
+        else:
+            if not member.zip64 and max(member.file_size, member.compress_size) >= ZIP64_LIMIT:
+                raise RuntimeError(f"{member.name!r} grew past 4GB while being archived")
+            if member.zip64:
+                self._write(struct.pack("<IIQQ", 0x08074b50, member.crc, member.compress_size, member.file_size))
+            else:
+                self._write(struct.pack("<IIII", 0x08074b50, member.crc, member.compress_size, member.file_size))
+            self.members.append(member)
+
+    def _write_local_header(self, member):
+        extra = b""
+        size_field = 0
+        if member.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            size_field = 0xFFFFFFFF
+        self._write(struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, 45 if member.zip64 else 20, member.flags,
+            member.compress_type, member.dos_time, member.dos_date, 0, size_field, size_field,
+            len(member.name), len(extra)))
+        self._write(member.name)
+        self._write(extra)
+
+    def _write_central_directory(self):
+        start = self.offset
+        for member in self.members:
+            zip64_fields = []
+            file_size, compress_size, offset = member.file_size, member.compress_size, member.offset
+            if file_size >= ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size >= ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            if zip64_fields:
+                extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if (zip64_fields or member.zip64) else 20
+            self._write(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version, version, member.flags,
+                member.compress_type, member.dos_time, member.dos_date, member.crc,
+                compress_size, file_size, len(member.name), len(extra), 0, 0, 0,
+                member.external_attr, offset))
+            self._write(member.name)
+            self._write(extra)
+
+        count = len(self.members)
+        size = self.offset - start
+        if count >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._write(struct.pack(
+                "<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, size, start))
+            self._write(struct.pack("<IIQI", 0x07064b50, 0, zip64_end, 1))
+        self._write(struct.pack(
+            "<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF), 0))
+
+ListingEntry = collections.namedtuple("ListingEntry", "name is_dir size mtime")
+
+class ListingCache:
+    """LRU cache of directory listings validated against the directory's mtime.
+
+    Entries are compact ListingEntry records sorted directories first, then
+    by case-insensitive name. A repeat listing of an unchanged directory
+    costs a single stat. In-place file edits do not touch the directory
+    mtime, so the server's own write handlers invalidate explicitly and
+    the FileWatcher reports edits made by other processes.
+    """
+
+    def __init__(self, max_dirs=LISTING_CACHE_SIZE):
+        self.max_dirs = max_dirs
+        self.dirs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Return the sorted ListingEntry records for a directory, raising OSError if unreadable"""
+        key = os.path.abspath(path)
+        mtime_ns = os.stat(key).st_mtime_ns
+        with self.lock:
+            cached = self.dirs.get(key)
+            if cached is not None and cached[0] == mtime_ns:
+                self.dirs.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        entries = scan_directory(key)
+        with self.lock:
+            self.dirs[key] = [mtime_ns, entries, {}]
+            self.dirs.move_to_end(key)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+        return entries
+
+    def get_view(self, path, entries, name, build):
+        """Return build(entries), memoized under name for as long as this listing stays cached"""
+        key = os.path.abspath(path)
+        with self.lock:
+            cached = self.dirs.get(key)
+            if cached is not None and cached[1] is entries and name in cached[2]:
+                return cached[2][name]
+        view = build(entries)
+        with self.lock:
+            cached = self.dirs.get(key)
+            if cached is not None and cached[1] is entries:
+                cached[2][name] = view
+        return view
+
+    def invalidate(self, path):
+        """Drop the listing of a changed path's parent, the path itself and anything below it"""
+        key = os.path.abspath(path)
+        prefix = key + os.sep
+        with self.lock:
+            self.dirs.pop(os.path.dirname(key), None)
+            for cached in [k for k in self.dirs if k == key or k.startswith(prefix)]:
+                del self.dirs[cached]
+
+    def on_file_events(self, events):
+        """FileWatcher subscriber: drop listings that changed behind the server's back"""
+        for event in events:
+            self.invalidate(event.path)
+            if event.old_path:
+                self.invalidate(event.old_path)
+
+def scan_directory(path):
+    """Read a directory with os.scandir into sorted ListingEntry records"""
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith(PARTIAL_UPLOAD_PREFIX):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                # Vanished or a dangling symlink, list it without details
+                files.append(ListingEntry(entry.name, False, None, None))
+                continue
+            if is_dir:
+                dirs.append(ListingEntry(entry.name, True, None, st.st_mtime))
+            else:
+                files.append(ListingEntry(entry.name, False, st.st_size, st.st_mtime))
+
+    # Sort files: directories first, then files, both alphabetically
+    dirs.sort(key=lambda e: e.name.lower())
+    files.sort(key=lambda e: e.name.lower())
+    return dirs + files
+
+def sort_entries(entries, sort="name", descending=False):
+    """Order listing records by name, size or mtime, keeping directories first"""
+    if sort == "name" and not descending:
+        return entries
+    key = LISTING_SORT_KEYS[sort]
+    dirs = sorted((e for e in entries if e.is_dir), key=key, reverse=descending)
+    files = sorted((e for e in entries if not e.is_dir), key=key, reverse=descending)
+    return dirs + files
+
+def resolve_share_path(relative_path):
+    """Map a share-relative path to a filesystem path, or None if it escapes DIRECTORY or names upload internals"""
+    root = os.path.realpath(DIRECTORY)
+    full = os.path.realpath(os.path.join(root, relative_path.strip('/')))
+    if full != root and not full.startswith(root + os.sep):
+        return None
+    if is_internal_path(relative_path) or is_internal_path(full[len(root):]):
+        return None
+    return full
+
+def is_internal_path(relative_path):
+    """Whether a share-relative path passes through the server's own PARTIAL_UPLOAD_PREFIX files"""
+    return any(part.startswith(PARTIAL_UPLOAD_PREFIX) for part in relative_path.split('/'))
+
+LISTING_SORT_KEYS = {
+    "name": lambda e: e.name.lower(),
+    "size": lambda e: (e.size or 0, e.name.lower()),
+    "mtime": lambda e: (e.mtime or 0, e.name.lower()),
+}
+
+def make_listing_etag(entries):
+    """Weak ETag derived from the scanned entries, so every worker process agrees on it"""
+    digest = hashlib.blake2b(digest_size=8)
+    for entry in entries:
+        digest.update(f"{entry.name}\0{entry.is_dir:d}\0{entry.size}\0{entry.mtime!r}\n".encode('utf-8', 'surrogateescape'))
+    return f'W/"{digest.hexdigest()}-{STATIC_ASSETS["app.js"].digest[:8]}"'
+
+LISTING_CACHE = ListingCache()
+
+def get_file_type(name, is_dir=False):
+    """Category of a path for search filters, one of FILE_TYPE_NAMES"""
+    if is_dir:
+        return 'folder'
+    ext = os.path.splitext(name)[1].lower()
+    for file_type, extensions in FILE_TYPES:
+        if ext in extensions:
+            return file_type
+    return 'other'
+
+class SearchIndex:
+    """SQLite catalog of every path under the share, searched by name through an FTS5 index.
+
+    A background thread owns the only write connection. It applies the
+    paths the write handlers report through changed() and rescans the tree
+    every SEARCH_RESCAN_INTERVAL for changes made behind the server's back,
+    diffing each directory against its rows so only what differs is
+    written. Searches run on per-thread read connections, which WAL mode
+    keeps from waiting on the writer; --workers processes share one
+    catalog and take turns at the rescan.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            type TEXT NOT NULL,
+            sha256 TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+        CREATE INDEX IF NOT EXISTS files_type_size ON files (type, size);
+        CREATE INDEX IF NOT EXISTS files_size ON files (size);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256) WHERE sha256 IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        INSERT OR IGNORE INTO meta VALUES ('scanned', 0), ('complete', 0);
+    """
+    # Rows are never renamed (a rename is a delete plus an insert), so names only change on insert and delete
+    NAMES_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(name, content='files', content_rowid='id', tokenize='{}');
+        CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+            INSERT INTO names (rowid, name) VALUES (new.id, new.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+            INSERT INTO names (names, rowid, name) VALUES ('delete', old.id, old.name);
+        END;
+    """
+
+    RESCAN = ''  # Queued to request a full rescan, no changed() path is ever empty
+
+    def __init__(self, path=SEARCH_INDEX_PATH, root=DIRECTORY):
+        self.path = path
+        self.root = root
+        self.pending = queue.SimpleQueue()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writer = None
+        self.thread = None
+        self.tokenizer = None  # trigram (substring matches), unicode61 (word prefixes) or None without FTS5
+
+    def connect(self, **kwargs):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, **kwargs)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def start(self):
+        """Open the catalog and start the indexer thread, once per process"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.writer = self.connect(check_same_thread=False)
+            self.writer.execute('PRAGMA journal_mode = WAL')
+            self.writer.executescript(self.SCHEMA)
+            tokenizer = 'trigram' if sqlite3.sqlite_version_info >= (3, 34) else 'unicode61'
+            try:
+                self.writer.executescript(self.NAMES_SCHEMA.format(tokenizer))
+                # An existing catalog keeps the tokenizer it was created with
+                sql = self.writer.execute("SELECT sql FROM sqlite_master WHERE name = 'names'").fetchone()[0]
+                self.tokenizer = 'trigram' if 'trigram' in sql else 'unicode61'
+            except sqlite3.OperationalError:
+                self.tokenizer = None  # SQLite built without FTS5, names are matched with LIKE
+            self.thread = threading.Thread(target=self.run, name="search-indexer", daemon=True)
+            self.thread.start()
+
+    def changed(self, *paths):
+        """Queue paths the server just created, replaced or removed for re-indexing"""
+        if self.thread is None:
+            return
+        root = os.path.abspath(self.root)
+        for path in paths:
+            rel = os.path.relpath(os.path.abspath(path), root)
+            if rel != '.' and rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+                self.pending.put(rel.replace(os.sep, '/'))
+
+    def on_file_events(self, events):
+        """FileWatcher subscriber: re-index what changed, or everything after lost events"""
+        for event in events:
+            if event.kind == 'overflow':
+                self.pending.put(self.RESCAN)
+            else:
+                self.changed(event.path, *filter(None, [event.old_path]))
+
+    def drain(self, timeout=0):
+        """Take the queued paths, waiting up to timeout seconds for the first one"""
+        paths = set()
+        try:
+            paths.add(self.pending.get(timeout=timeout) if timeout else self.pending.get_nowait())
+            while len(paths) < 1000:
+                paths.add(self.pending.get_nowait())
+        except queue.Empty:
+            pass
+        return paths
+
+    def run(self):
+        next_scan = 0  # Scan at startup to catch up with changes made while stopped
+        scanned = False
+        while True:
+            paths = self.drain(max(0.0, next_scan - time.monotonic()))
+            forced = self.RESCAN in paths
+            paths.discard(self.RESCAN)
+            try:
+                if paths:
+                    self.apply(paths)
+                if forced or time.monotonic() >= next_scan:
+                    next_scan = time.monotonic() + SEARCH_RESCAN_INTERVAL
+                    # While inotify watches every directory, changes arrive as events and need no walk
+                    if forced or not (scanned and FILE_WATCHER.exhaustive) and self.claim_scan():
+                        self.rescan()
+                        scanned = True
+            except (sqlite3.Error, OSError):
+                traceback.print_exc()
+
+    def claim_scan(self):
+        """Claim the due rescan, False if another worker process already started it"""
+        now = time.time()
+        return self.writer.execute("UPDATE meta SET value = ? WHERE key = 'scanned' AND value <= ?",
+                                   (now, now - SEARCH_RESCAN_INTERVAL / 2)).rowcount == 1
+
+    def rescan(self):
+        """Walk the whole share a directory at a time, applying queued changes in between"""
+        stack = ['']
+        while stack:
+            stack.extend(self.sync_directory(stack.pop()))
+            paths = self.drain()
+            if paths:
+                self.apply(paths)
+        self.writer.execute("UPDATE meta SET value = 1 WHERE key = 'complete'")
+
+    def apply(self, paths):
+        """Bring the rows of share-relative paths, and everything below directories among them, in line with the disk"""
+        directories = []
+        for rel in sorted(paths):
+            if is_internal_path(rel):
+                continue
+            parent, _, name = rel.rpartition('/')
+            try:
+                st = os.stat(os.path.join(self.root, rel))
+            except OSError:
+                st = None
+            self.write(parent, removed=[name] if st is None else [], updated=[] if st is None else [(name, st)])
+            # Symlinked directories are recorded but not followed, as in sync_directory
+            if st is not None and stat.S_ISDIR(st.st_mode) and not os.path.islink(os.path.join(self.root, rel)):
+                directories.append(rel)
+        for rel in directories:
+            stack = [rel]
+            while stack:
+                stack.extend(self.sync_directory(stack.pop()))
+
+    def sync_directory(self, rel):
+        """Diff one directory against its rows and write the differences, returns its subdirectories"""
+        full = os.path.join(self.root, rel)
+        on_disk = {}
+        subdirectories = []
+        try:
+            with os.scandir(full) as it:
+                for entry in it:
+                    if entry.name.startswith(PARTIAL_UPLOAD_PREFIX):
+                        continue
+                    try:
+                        on_disk[entry.name] = entry.stat()
+                        # Symlinked directories are listed but not followed, they could loop
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(f"{rel}/{entry.name}" if rel else entry.name)
+                    except OSError:
+                        pass  # Vanished or a dangling symlink
+        except OSError:
+            pass  # The directory itself is gone, drop its rows
+        rows = {name: (is_dir, size, mtime) for name, is_dir, size, mtime in self.writer.execute(
+            "SELECT name, is_dir, size, mtime FROM files WHERE parent = ?", (rel,))}
+        updated = []
+        for name, st in on_disk.items():
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if rows.get(name) != (is_dir, None if is_dir else st.st_size, st.st_mtime):
+                updated.append((name, st))
+        self.write(rel, [name for name in rows if name not in on_disk], updated)
+        return subdirectories
+
+    def write(self, parent, removed, updated):
+        """Delete removed names (with anything below them) and upsert updated (name, stat) pairs of one directory"""
+        if not removed and not updated:
+            return
+        records = []
+        for name, st in updated:
+            path = f"{parent}/{name}" if parent else name
+            is_dir = stat.S_ISDIR(st.st_mode)
+            sha256 = None
+            if SEARCH_HASH_FILES and not is_dir:
+                # Hashed before the write transaction, which would otherwise hold the lock while reading
+                with contextlib.suppress(OSError):
+                    sha256 = hash_file(os.path.join(self.root, path))
+            records.append((path, parent, name, is_dir, None if is_dir else st.st_size, st.st_mtime,
+                            get_file_type(name, is_dir), sha256))
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            for name in removed:
+                path = f"{parent}/{name}" if parent else name
+                # '0' follows '/', so this range is everything below path
+                self.writer.execute("DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)",
+                                    (path, path + '/', path + '0'))
+            self.writer.executemany(
+                "INSERT INTO files (path, parent, name, is_dir, size, mtime, type, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (path) DO UPDATE SET is_dir = excluded.is_dir, size = excluded.size,"
+                " mtime = excluded.mtime, type = excluded.type, sha256 = excluded.sha256", records)
+            self.writer.execute('COMMIT')
+        except BaseException:
+            self.writer.execute('ROLLBACK')
+            raise
+
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def search(self, query='', file_type=None, min_size=None, max_size=None, sha256=None, limit=50, offset=0):
+        """Rows whose name contains every word of query and that pass the filters, in catalog order.
+
+        Returns (results, more, complete): more when rows beyond limit
+        matched, complete once a full scan has finished. Words shorter than
+        three characters cannot use the trigram index and are matched with
+        LIKE instead, which scans when they are all there is.
+        """
+        terms = query.split()
+        if self.tokenizer == 'trigram':
+            indexed = [term for term in terms if len(term) >= 3]
+        else:
+            indexed = terms if self.tokenizer else []
+        source, conditions, params = 'files', [], []
+        if indexed:
+            source = 'names JOIN files ON files.id = names.rowid'
+            conditions.append('names MATCH ?')
+            suffix = '' if self.tokenizer == 'trigram' else '*'
+            params.append(' '.join('"{}"{}'.format(term.replace('"', '""'), suffix) for term in indexed))
+        for term in terms:
+            if term not in indexed:
+                conditions.append("files.name LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+        for column, operator, value in (('type', '=', file_type), ('size', '>=', min_size),
+                                        ('size', '<=', max_size), ('sha256', '=', sha256)):
+            if value is not None:
+                conditions.append(f'files.{column} {operator} ?')
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        conn = self.reader()
+        rows = conn.execute(
+            f"SELECT files.path, files.name, files.is_dir, files.size, files.mtime, files.type, files.sha256"
+            f" FROM {source}{where} LIMIT ? OFFSET ?", params + [limit + 1, offset]).fetchall()
+        complete = conn.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()[0] == 1
+        results = [{'path': path, 'name': name, 'is_dir': bool(is_dir), 'size': size, 'mtime': mtime,
+                    'type': kind, 'sha256': digest} for path, name, is_dir, size, mtime, kind, digest in rows[:limit]]
+        return results, len(rows) > limit, complete
+
+SEARCH_INDEX = SearchIndex()
+
+FileEvent = collections.namedtuple("FileEvent", "kind path is_dir old_path")
+
+class FileWatcher:
+    """Publishes changes under the share, whoever makes them, to subscribers in batches of FileEvent.
+
+    Event kinds are create, modify, delete, move (old_path set) and
+    overflow (events were lost, anything may have changed). inotify, called
+    through ctypes, watches every directory and reports changes as they
+    happen; when it is unavailable, directories are polled every
+    WATCH_POLL_INTERVAL and rescanned when their mtime moves, which catches
+    created, deleted and replaced entries but not files edited in place.
+    Names starting with PARTIAL_UPLOAD_PREFIX are ignored. exhaustive is
+    True while every directory is watched, so subscribers can skip walks.
+
+    Every worker process watches for its own per-process caches, but
+    exclusive subscribers, which update state shared through the share
+    (the search catalog, rendered thumbnails), only hear events in the
+    process holding the WATCH_LEADER_PATH lock.
+    """
+
+    IN_MODIFY, IN_ATTRIB, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x4, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED = 0x100, 0x200, 0x4000, 0x8000
+    IN_ONLYDIR, IN_DONT_FOLLOW, IN_ISDIR, IN_CLOEXEC = 0x1000000, 0x2000000, 0x40000000, 0x80000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+    def __init__(self, root=DIRECTORY):
+        self.root = root
+        self.subscribers = []
+        self.thread = None
+        self.backend = None
+        self.exhaustive = False
+        self.libc = None
+        self.fd = None
+        self.watches = {}  # inotify watch descriptor -> directory path
+        self.watched = {}  # directory path -> watch descriptor
+        self.leader_fd = None
+        self.leader = False
+
+    def subscribe(self, callback, exclusive=False):
+        """Call callback(events) from the watcher thread for every batch of changes, in one process only if exclusive"""
+        self.subscribers.append((callback, exclusive))
+
+    def claim_leadership(self):
+        """Whether this process feeds the exclusive subscribers, taking over once the holder exits"""
+        if self.leader or fcntl is None:
+            return True
+        fresh = False
+        try:
+            if self.leader_fd is None:
+                try:
+                    self.leader_fd = os.open(WATCH_LEADER_PATH, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, FILE_MODE)
+                    fresh = True
+                except FileExistsError:
+                    self.leader_fd = os.open(WATCH_LEADER_PATH, os.O_RDWR | os.O_CLOEXEC)
+            fcntl.flock(self.leader_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True  # No lock to be had (read-only share), act alone as before
+        self.leader = True
+        if not fresh:
+            # Took over from a process that exited, whatever it did not pass on since is unknown
+            self.publish([FileEvent('overflow', self.root, True, None)], exclusive_only=True)
+        return True
+
+    def publish(self, events, exclusive_only=False):
+        leader = self.claim_leadership()
+        for callback, exclusive in self.subscribers:
+            if (exclusive and not leader) or (exclusive_only and not exclusive):
+                continue
+            try:
+                callback(events)
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """Start watching in a background thread with the best available backend"""
+        if self.thread is not None:
+            return
+        self.claim_leadership()
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.fd = fd
+            self.backend = 'inotify'
+            self.exhaustive = True
+            self.watch_tree(self.root)
+            target = self.run_inotify
+        except (OSError, AttributeError) as e:  # Not Linux, or no inotify in this libc
+            if sys.platform.startswith('linux'):
+                print(f"⚠️  inotify unavailable ({e}), polling for changes every {WATCH_POLL_INTERVAL}s")
+            self.backend = 'polling'
+            self.exhaustive = False
+            target = self.run_polling
+        self.thread = threading.Thread(target=target, name="file-watcher", daemon=True)
+        self.thread.start()
+
+    def watch_tree(self, top):
+        """Add inotify watches on top and every directory below it"""
+        for directory, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if not d.startswith(PARTIAL_UPLOAD_PREFIX)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd < 0:
+                code = ctypes.get_errno()
+                if code == errno.ENOSPC and self.exhaustive:
+                    self.exhaustive = False
+                    print("⚠️  Out of inotify watches (see fs.inotify.max_user_watches), "
+                          "directories beyond the limit are picked up by periodic rescans")
+                if code != errno.ENOENT:
+                    dirs[:] = []
+                continue
+            self.watched.pop(self.watches.get(wd), None)
+            self.watches[wd] = directory
+            self.watched[directory] = wd
+
+    def unwatch_tree(self, top):
+        """Forget the watches of a directory moved out of the share and everything below it"""
+        prefix = top + os.sep
+        for directory in [d for d in self.watched if d == top or d.startswith(prefix)]:
+            wd = self.watched.pop(directory)
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def move_watches(self, old, new):
+        """Re-path the watches of a directory renamed within the share"""
+        prefix = old + os.sep
+        for directory in [d for d in self.watched if d == old or d.startswith(prefix)]:
+            wd = self.watched.pop(directory)
+            self.watches[wd] = new + directory[len(old):]
+            self.watched[self.watches[wd]] = wd
+
+    def run_inotify(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            # Collect the rest of a burst (an rsync run, a large copy) into the same batch
+            while len(data) < 1024 * 1024 and select.select([self.fd], [], [], 0.1)[0]:
+                data += os.read(self.fd, 64 * 1024)
+            events = self.parse_inotify(data)
+            if events:
+                self.publish(events)
+
+    def parse_inotify(self, data):
+        """Turn raw inotify_event records into FileEvents, keeping the watches in step"""
+        events = []
+        moves = {}  # cookie -> (path, is_dir) of a MOVED_FROM awaiting its MOVED_TO
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append(FileEvent('overflow', self.root, True, None))
+                continue
+            if mask & self.IN_IGNORED:
+                self.watched.pop(self.watches.pop(wd, None), None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name or name.startswith(PARTIAL_UPLOAD_PREFIX):
+                continue  # A finished upload's rename from its hidden temp name arrives as an unpaired MOVED_TO
+            path = os.path.join(directory, name)
+            is_dir = bool(mask & self.IN_ISDIR)
+            if mask & self.IN_MOVED_FROM:
+                moves[cookie] = (path, is_dir)
+            elif mask & self.IN_MOVED_TO:
+                old = moves.pop(cookie, None)
+                if old is not None:
+                    events.append(FileEvent('move', path, is_dir, old[0]))
+                    if is_dir:
+                        self.move_watches(old[0], path)
+                else:
+                    events.append(FileEvent('create', path, is_dir, None))
+                    if is_dir:
+                        self.watch_tree(path)
+            elif mask & self.IN_CREATE:
+                events.append(FileEvent('create', path, is_dir, None))
+                if is_dir:
+                    # Entries created before the watch exists are covered by this event's subtree
+                    self.watch_tree(path)
+            elif mask & self.IN_DELETE:
+                events.append(FileEvent('delete', path, is_dir, None))
+            elif not is_dir or mask & self.IN_ATTRIB:
+                events.append(FileEvent('modify', path, is_dir, None))
+        for path, is_dir in moves.values():  # Moved out of the share
+            events.append(FileEvent('delete', path, is_dir, None))
+            if is_dir:
+                self.unwatch_tree(path)
+        # Writes arrive as a stream of IN_MODIFY, one event per path and kind is enough
+        return list(dict.fromkeys(events))
+
+    def run_polling(self):
+        snapshot = {}  # directory -> (mtime_ns, {name: (inode, is_dir)})
+        self.poll_directory(self.root, snapshot, None)
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            events = []
+            for directory in list(snapshot):
+                if directory not in snapshot:
+                    continue  # Dropped with a deleted parent during this round
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    mtime_ns = None
+                if mtime_ns != snapshot[directory][0]:
+                    self.poll_directory(directory, snapshot, events)
+            if events:
+                self.publish(events)
+
+    def poll_directory(self, directory, snapshot, events):
+        """Rescan one directory, appending what changed since its snapshot to events (None: just record)"""
+        entries = {}
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.name.startswith(PARTIAL_UPLOAD_PREFIX):
+                        with contextlib.suppress(OSError):
+                            entries[entry.name] = (entry.inode(), entry.is_dir(follow_symlinks=False))
+        except OSError:
+            # Gone, the parent's rescan reports the deletion
+            prefix = directory + os.sep
+            for path in [d for d in snapshot if d == directory or d.startswith(prefix)]:
+                del snapshot[path]
+            return
+        old = snapshot.get(directory, (None, {}))[1]
+        snapshot[directory] = (mtime_ns, entries)
+        for name, (inode, is_dir) in entries.items():
+            path = os.path.join(directory, name)
+            if name not in old:
+                kind = 'create'
+            elif old[name] != (inode, is_dir):
+                kind = 'modify'  # Replaced, as rsync and the server's own uploads do
+            else:
+                continue
+            if events is not None:
+                events.append(FileEvent(kind, path, is_dir, None))
+            if is_dir and path not in snapshot:
+                self.poll_directory(path, snapshot, None)
+        for name, (_, is_dir) in old.items():
+            if name not in entries:
+                path = os.path.join(directory, name)
+                events.append(FileEvent('delete', path, is_dir, None))
+                prefix = path + os.sep
+                for gone in [d for d in snapshot if d == path or d.startswith(prefix)]:
+                    del snapshot[gone]
+
+FILE_WATCHER = FileWatcher()
+FILE_WATCHER.subscribe(LISTING_CACHE.on_file_events)
+FILE_WATCHER.subscribe(SEARCH_INDEX.on_file_events, exclusive=True)
+
+class EventHub:
+    """Fans folder changes out to browsers subscribed through /events (Server-Sent Events).
+
+    Request threads hand subscribed connections over once the response
+    head is sent, so an idle subscriber costs a socket rather than a pool
+    worker. One thread multiplexes them all with a selector: each batch of
+    changes is encoded once per directory and sent to its subscribers
+    without blocking, a subscriber that stops reading is dropped once
+    SSE_MAX_BUFFER is queued (the browser reconnects and refetches), and
+    SSE_HEARTBEAT comments keep idle streams open through proxies.
+    """
+
+    def __init__(self):
+        self.commands = queue.SimpleQueue()  # Work for the hub thread, which alone touches the sockets
+        self.streams = {}  # socket -> (directory, queued output)
+        self.directories = {}  # directory -> set of subscribed sockets
+        self.lock = threading.Lock()
+        self.thread = None
+        self.selector = None
+        self.wakeup = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.selector = selectors.DefaultSelector()
+            self.wakeup = socket.socketpair()
+            for end in self.wakeup:
+                end.setblocking(False)
+            self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self.run, name="event-hub", daemon=True)
+            self.thread.start()
+
+    def call(self, *command):
+        self.commands.put(command)
+        with contextlib.suppress(BlockingIOError):  # A full wakeup buffer means the hub wakes anyway
+            self.wakeup[1].send(b'\0')
+
+    def subscribe(self, sock, directory):
+        """Take over a connection whose event-stream response head was sent, streaming changes of directory"""
+        self.start()
+        self.call('add', sock, os.path.abspath(directory))
+
+    def on_file_events(self, events):
+        """FileWatcher subscriber: turn events into one add/change/remove entry per name in each subscribed directory"""
+        if not self.directories:
+            return
+        changes = collections.defaultdict(dict)  # directory -> name -> latest entry for it
+        for event in events:
+            if event.kind == 'overflow':
+                self.call('broadcast', b'data: {"reset": true}\n\n')
+                continue
+            if event.old_path:
+                key = os.path.abspath(event.old_path)
+                if os.path.dirname(key) in self.directories:
+                    changes[os.path.dirname(key)][os.path.basename(key)] = {'op': 'remove', 'name': os.path.basename(key)}
+            key = os.path.abspath(event.path)
+            directory, name = os.path.split(key)
+            if directory not in self.directories:
+                continue
+            if event.kind == 'delete':
+                changes[directory][name] = {'op': 'remove', 'name': name}
+                continue
+            try:
+                st = os.stat(key)
+            except OSError:
+                continue  # Already gone again, its delete event follows
+            is_dir = stat.S_ISDIR(st.st_mode)
+            entry = ListingEntry(name, is_dir, None if is_dir else st.st_size, st.st_mtime)
+            # A file created and then written in the same batch is still new to the browser
+            op = 'change' if event.kind == 'modify' and changes[directory].get(name, {}).get('op') != 'add' else 'add'
+            changes[directory][name] = {'op': op, 'entry': FileServerHandler.listing_entry_json(entry)}
+        for directory, items in changes.items():
+            self.call('publish', directory, b'data: ' + json.dumps({'changes': list(items.values())}).encode() + b'\n\n')
+
+    def run(self):
+        heartbeat = time.monotonic() + SSE_HEARTBEAT
+        while True:
+            for key, mask in self.selector.select(max(0.0, heartbeat - time.monotonic())):
+                sock = key.fileobj
+                if sock is self.wakeup[0]:
+                    with contextlib.suppress(BlockingIOError):
+                        sock.recv(4096)
+                    continue
+                if sock not in self.streams:
+                    continue  # Dropped earlier in this round
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = sock.recv(4096)  # Subscribers send nothing, this is the close
+                    except BlockingIOError:
+                        data = b'-'
+                    except OSError:
+                        data = b''
+                    if not data:
+                        self.drop(sock)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self.send(sock, b'')
+            while True:
+                try:
+                    command, *args = self.commands.get_nowait()
+                except queue.Empty:
+                    break
+                if command == 'add':
+                    sock, directory = args
+                    sock.setblocking(False)
+                    self.streams[sock] = (directory, bytearray())
+                    self.directories.setdefault(directory, set()).add(sock)
+                    self.selector.register(sock, selectors.EVENT_READ)
+                elif command == 'publish':
+                    for sock in list(self.directories.get(args[0], ())):
+                        self.send(sock, args[1])
+                else:
+                    for sock in list(self.streams):
+                        self.send(sock, args[0])
+            if time.monotonic() >= heartbeat:
+                heartbeat = time.monotonic() + SSE_HEARTBEAT
+                for sock in list(self.streams):
+                    self.send(sock, b': keep-alive\n\n')
+
+    def send(self, sock, data):
+        """Queue data for one subscriber and write as much of the queue as the socket takes"""
+        _, output = self.streams[sock]
+        waiting = bool(output)
+        if waiting or not data:
+            output += data
+            data = output
+        try:
+            sent = sock.send(data) if data else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return self.drop(sock)
+        if data is output:
+            del output[:sent]
+        else:
+            output += data[sent:]
+        if len(output) > SSE_MAX_BUFFER:
+            return self.drop(sock)
+        if bool(output) != waiting:
+            self.selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if output else 0))
+
+    def drop(self, sock):
+        directory, _ = self.streams.pop(sock)
+        subscribers = self.directories[directory]
+        subscribers.discard(sock)
+        if not subscribers:
+            del self.directories[directory]
+        self.selector.unregister(sock)
+        sock.close()
+
+EVENT_HUB = EventHub()
+FILE_WATCHER.subscribe(EVENT_HUB.on_file_events)
+
+def etag_matches(header, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+def make_etag(st):
+    """Build a strong ETag from a file's inode, size and modification time"""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def make_encoded_etag(st, encoding):
+    """Strong ETag of one content coding of a file, distinct from the identity ETag"""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}-{encoding}"'
+
+def parse_range_header(header, file_size):
+    """Parse a bytes Range header into sorted, coalesced (start, end) pairs.
+
+    Returns None when the header should be ignored (missing, malformed or
+    abusive) and an empty list when no range is satisfiable.
+    """
+    if not header or not header.strip().lower().startswith("bytes="):
+        return None
+    specs = header.strip()[6:].split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last) or not all(p.isdigit() for p in (first, last) if p):
+            return None
+        if not first:
+            # Suffix range: the final N bytes of the file
+            length = int(last)
+            if length and file_size:
+                ranges.append((max(0, file_size - length), file_size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = int(last) if last else file_size - 1
+        if start < file_size:
+            ranges.append((start, min(end, file_size - 1)))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+UI_CSS = """
+* { margin: 0; padding: 0; box-sizing: border-box; }
+
+body { 
+    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; 
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    min-height: 100vh;
+    padding: 20px;
+}
+
+.container {
+    max-width: 1200px;
+    margin: 0 auto;
+    background: white;
+    border-radius: 20px;
+    box-shadow: 0 20px 40px rgba(0,0,0,0.1);
+    overflow: hidden;
+}
+
+.header {
+    background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
+    color: white;
+    padding: 30px;
+    text-align: center;
+}
+
+.header h1 {
+    font-size: 2.5em;
+    margin-bottom: 10px;
+    font-weight: 300;
+}
+
+.header p {
+    opacity: 0.9;
+    font-size: 1.1em;
+}
+
+.content {
+    padding: 30px;
+}
+
+.section {
+    background: #f8f9fa;
+    border-radius: 15px;
+    padding: 25px;
+    margin-bottom: 25px;
+    border: 1px solid #e9ecef;
+}
+
+.section h2 {
+    color: #495057;
+    margin-bottom: 20px;
+    font-size: 1.5em;
+    display: flex;
+    align-items: center;
+    gap: 10px;
+}
+
+.file-grid {
+    display: grid;
+    grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
+    gap: 15px;
+}
+
+.listing-toolbar {
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+    margin-bottom: 15px;
+    color: #6c757d;
+}
+
+.listing-toolbar select {
+    padding: 6px 10px;
+    border: 2px solid #e9ecef;
+    border-radius: 8px;
+}
+
+.search-input {
+    width: 100%;
+    padding: 12px;
+    border: 2px solid #e9ecef;
+    border-radius: 8px;
+    font-size: 1em;
+}
+
+.search-results {
+    margin-top: 10px;
+    max-height: 400px;
+    overflow-y: auto;
+}
+
+.search-result {
+    display: flex;
+    align-items: center;
+    gap: 10px;
+    padding: 8px 10px;
+    border-radius: 8px;
+    color: inherit;
+    text-decoration: none;
+}
+
+.search-result:hover {
+    background: #f8f9fa;
+}
+
+.search-result .file-name {
+    flex: 1;
+    margin: 0;
+}
+
+.file-card {
+    background: white;
+    border-radius: 12px;
+    padding: 20px;
+    border: 2px solid #e9ecef;
+    transition: all 0.3s ease;
+    position: relative;
+}
+
+.file-card:hover {
+    border-color: #4facfe;
+    transform: translateY(-2px);
+    box-shadow: 0 10px 25px rgba(0,0,0,0.1);
+}
+
+.file-icon {
+    font-size: 2em;
+    margin-bottom: 10px;
+    display: block;
+}
+
+.file-thumb {
+    display: block;
+    width: 100%;
+    height: 160px;
+    object-fit: cover;
+    border-radius: 8px;
+    margin-bottom: 10px;
+    background: #f8f9fa;
+}
+
+.file-name {
+    font-weight: 600;
+    color: #495057;
+    margin-bottom: 8px;
+    word-break: break-word;
+}
+
+.file-size {
+    color: #6c757d;
+    font-size: 0.9em;
+    margin-bottom: 15px;
+}
+
+.file-actions {
+    display: flex;
+    gap: 8px;
+    flex-wrap: wrap;
+}
+
+.btn {
+    padding: 8px 16px;
+    border: none;
+    border-radius: 8px;
+    cursor: pointer;
+    font-size: 0.9em;
+    font-weight: 500;
+    transition: all 0.3s ease;
+    text-decoration: none;
+    display: inline-flex;
+    align-items: center;
+    gap: 5px;
+}
+
+.btn-primary {
+    background: #4facfe;
+    color: white;
+}
+
+.btn-primary:hover {
+    background: #3a8bfd;
+    transform: translateY(-1px);
+}
+
+.btn-danger {
+    background: #dc3545;
+    color: white;
+}
+
+.btn-danger:hover {
+    background: #c82333;
+    transform: translateY(-1px);
+}
+
+.btn-warning {
+    background: #ffc107;
+    color: #212529;
+}
+
+.btn-warning:hover {
+    background: #e0a800;
+    transform: translateY(-1px);
+}
+
+.btn-small {
+    padding: 6px 12px;
+    font-size: 0.8em;
+}
+
+.upload-area {
+    border: 3px dashed #dee2e6;
+    border-radius: 15px;
+    padding: 40px;
+    text-align: center;
+    transition: all 0.3s ease;
+    background: white;
+}
+
+.upload-area:hover {
+    border-color: #4facfe;
+    background: #f8f9ff;
+}
+
+.upload-area.dragover {
+    border-color: #4facfe;
+    background: #e3f2fd;
+}
+
+.file-input {
+    display: none;
+}
+
+.upload-btn {
+    background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
+    color: white;
+    border: none;
+    padding: 15px 30px;
+    border-radius: 10px;
+    font-size: 1.1em;
+    font-weight: 600;
+    cursor: pointer;
+    transition: all 0.3s ease;
+    margin-top: 15px;
+}
+
+.upload-btn:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 10px 25px rgba(79, 172, 254, 0.3);
+}
+
+.upload-btn:disabled {
+    background: #6c757d;
+    cursor: not-allowed;
+    transform: none;
+    box-shadow: none;
+}
+
+.progress-container {
+    margin-top: 20px;
+    display: none;
+}
+
+.progress-bar {
+    width: 100%;
+    height: 8px;
+    background: #e9ecef;
+    border-radius: 4px;
+    overflow: hidden;
+    margin-bottom: 10px;
+}
+
+.progress-fill {
+    height: 100%;
+    background: linear-gradient(90deg, #4facfe, #00f2fe);
+    width: 0%;
+    transition: width 0.3s ease;
+}
+
+.status {
+    padding: 15px;
+    border-radius: 10px;
+    margin-top: 15px;
+    font-weight: 500;
+}
+
+.status.success {
+    background: #d4edda;
+    color: #155724;
+    border: 1px solid #c3e6cb;
+}
+
+.status.error {
+    background: #f8d7da;
+    color: #721c24;
+    border: 1px solid #f5c6cb;
+}
+
+.status.info {
+    background: #d1ecf1;
+    color: #0c5460;
+    border: 1px solid #bee5eb;
+}
+
+.empty-state {
+    text-align: center;
+    padding: 60px 20px;
+    color: #6c757d;
+}
+
+.empty-state .icon {
+    font-size: 4em;
+    margin-bottom: 20px;
+    opacity: 0.5;
+}
+
+.modal {
+    display: none;
+    position: fixed;
+    z-index: 1000;
+    left: 0;
+    top: 0;
+    width: 100%;
+    height: 100%;
+    background-color: rgba(0,0,0,0.5);
+}
+
+.modal-content {
+    background-color: white;
+    margin: 15% auto;
+    padding: 30px;
+    border-radius: 15px;
+    width: 90%;
+    max-width: 500px;
+    box-shadow: 0 20px 40px rgba(0,0,0,0.2);
+}
+
+.modal h3 {
+    margin-bottom: 20px;
+    color: #495057;
+}
+
+.modal input {
+    width: 100%;
+    padding: 12px;
+    border: 2px solid #e9ecef;
+    border-radius: 8px;
+    font-size: 1em;
+    margin-bottom: 20px;
+}
+
+.modal input:focus {
+    outline: none;
+    border-color: #4facfe;
+}
+
+.modal-buttons {
+    display: flex;
+    gap: 10px;
+    justify-content: flex-end;
+}
+
+@media (max-width: 768px) {
+    .file-grid {
+        grid-template-columns: 1fr;
+    }
+
+    .header h1 {
+        font-size: 2em;
+    }
+
+    .content {
+        padding: 20px;
+    }
+}
+"""
+
+UI_JS = """
+let currentFile = '';
+
+// Upload functionality
+const uploadArea = document.getElementById('uploadArea');
+const fileInput = document.getElementById('fileInput');
+const progressContainer = document.getElementById('progressContainer');
+const progressFill = document.getElementById('progressFill');
+const progressText = document.getElementById('progressText');
+const status = document.getElementById('status');
+
+// Folder creation
+async function createFolder() {
+    const folderName = document.getElementById('folderName').value.trim();
+    if (!folderName) {
+        showStatus('Please enter a folder name', 'error');
+        return;
+    }
+
+    try {
+        const response = await fetch('/create_folder', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: `folder_name=${encodeURIComponent(folderName)}`
+        });
+
+        const result = await response.json();
+        if (result.status === 'success') {
+            showStatus('Folder created successfully!', 'success');
+            document.getElementById('folderName').value = '';
+            refreshListing();
+        } else {
+            showStatus('Folder creation failed: ' + result.message, 'error');
+        }
+    } catch (error) {
+        showStatus('Folder creation failed: ' + error.message, 'error');
+    }
+}
+
+// Bulk selection functions
+function selectAll() {
+    const checkboxes = document.querySelectorAll('.file-checkbox');
+    checkboxes.forEach(checkbox => checkbox.checked = true);
+}
+
+function deselectAll() {
+    const checkboxes = document.querySelectorAll('.file-checkbox');
+    checkboxes.forEach(checkbox => checkbox.checked = false);
+}
+
+function getSelectedFiles() {
+    const checkboxes = document.querySelectorAll('.file-checkbox:checked');
+    return Array.from(checkboxes).map(checkbox => checkbox.dataset.filename);
+}
+
+async function downloadSelected() {
+    const selectedFiles = getSelectedFiles();
+    if (selectedFiles.length === 0) {
+        showStatus('Please select files to download', 'error');
+        return;
+    }
+
+    const items = selectedFiles.join(',');
+    const url = `/download_zip?items=${encodeURIComponent(items)}`;
+    window.location.href = url;
+}
+
+async function deleteSelected() {
+    const selectedFiles = getSelectedFiles();
+    if (selectedFiles.length === 0) {
+        showStatus('Please select files to delete', 'error');
+        return;
+    }
+
+    if (!confirm(`Are you sure you want to delete ${selectedFiles.length} item(s)?`)) {
+        return;
+    }
+
+    let successCount = 0;
+    let errorCount = selectedFiles.length;
+
+    // One request for the whole selection, answered with a result line per item as it completes
+    try {
+        const response = await fetch('/api/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(selectedFiles.map(filename => ({
+                op: 'delete',
+                path: listingPath ? listingPath + '/' + filename : filename,
+                recursive: true,
+            })))
+        });
+        if (response.ok) {
+            const lines = (await response.text()).trim().split('\\n').map(line => JSON.parse(line));
+            const summary = lines[lines.length - 1];
+            if (summary.done) {
+                successCount = summary.succeeded;
+                errorCount = summary.failed;
+            }
+        }
+    } catch (error) {
+        // Counted as failed, the listing refresh below shows what was deleted
+    }
+
+    if (errorCount === 0) {
+        showStatus(`Successfully deleted ${successCount} item(s)!`, 'success');
+    } else {
+        showStatus(`Deleted ${successCount} item(s), ${errorCount} failed`, 'error');
+    }
+
+    refreshListing();
+}
+
+// Infinite scrolling: the server renders the first page, the rest comes from /api/list
+const fileGrid = document.getElementById('fileGrid');
+const gridSentinel = document.getElementById('gridSentinel');
+let listingOffset = fileGrid ? parseInt(fileGrid.dataset.loaded) : 0;
+let listingTotal = fileGrid ? parseInt(fileGrid.dataset.total) : 0;
+let listingSort = 'name';
+let listingOrder = 'asc';
+let listingLoading = false;
+let listingGeneration = 0;
+let listingObserver = null;
+
+function formatFileSize(size) {
+    for (const unit of ['B', 'KB', 'MB', 'GB']) {
+        if (size < 1024) {
+            return size.toFixed(1) + ' ' + unit;
+        }
+        size /= 1024;
+    }
+    return size.toFixed(1) + ' TB';
+}
+
+function createButton(label, className, onClick) {
+    const button = document.createElement('button');
+    button.className = 'btn btn-small ' + className;
+    button.textContent = label;
+    button.addEventListener('click', onClick);
+    return button;
+}
+
+function createFileCard(entry) {
+    const card = document.createElement('div');
+    card.className = 'file-card';
+    card.dataset.name = encodeURIComponent(entry.name);
+    card.dataset.dir = entry.is_dir ? '1' : '0';
+    card.dataset.size = entry.size || 0;
+    card.dataset.mtime = entry.mtime || 0;
+
+    const head = document.createElement('div');
+    head.style.cssText = 'display: flex; align-items: center; gap: 10px; margin-bottom: 10px;';
+    const checkbox = document.createElement('input');
+    checkbox.type = 'checkbox';
+    checkbox.className = 'file-checkbox';
+    checkbox.dataset.filename = entry.name;
+    checkbox.style.transform = 'scale(1.2)';
+    const icon = document.createElement('span');
+    icon.className = 'file-icon';
+    icon.textContent = entry.icon;
+    head.append(checkbox, icon);
+
+    let thumb = null;
+    if (entry.thumb) {
+        const dir = decodeURIComponent(fileGrid.dataset.path);
+        thumb = document.createElement('img');
+        thumb.className = 'file-thumb';
+        thumb.alt = '';
+        thumb.loading = 'lazy';
+        thumb.decoding = 'async';
+        thumb.onerror = () => thumb.remove();
+        thumb.src = '/thumb?' + new URLSearchParams({
+            path: dir ? dir + '/' + entry.name : entry.name,
+            size: fileGrid.dataset.thumbSize,
+            v: String(entry.mtime),
+        });
+    }
+
+    const name = document.createElement('div');
+    name.className = 'file-name';
+    name.textContent = entry.name;
+
+    const size = document.createElement('div');
+    size.className = 'file-size';
+    size.textContent = entry.is_dir ? '📁 Directory'
+        : (entry.size === null ? 'N/A' : '📄 ' + formatFileSize(entry.size));
+
+    const actions = document.createElement('div');
+    actions.className = 'file-actions';
+    if (entry.is_dir) {
+        actions.append(createButton('📂 Open', 'btn-primary', () => openFolder(encodeURIComponent(entry.name) + '/')));
+    } else {
+        const link = document.createElement('a');
+        link.href = encodeURIComponent(entry.name);
+        link.className = 'btn btn-primary btn-small';
+        link.textContent = '⬇️ Download';
+        actions.append(link);
+    }
+    actions.append(
+        createButton('✏️ Rename', 'btn-warning', () => renameFile(entry.name)),
+        createButton('🗑️ Delete', 'btn-danger', () => deleteFile(entry.name))
+    );
+
+    card.append(head, ...(thumb ? [thumb] : []), name, size, actions);
+    return card;
+}
+
+async function loadMoreEntries() {
+    if (!fileGrid || listingLoading || listingOffset >= listingTotal) {
+        return;
+    }
+    listingLoading = true;
+    const generation = listingGeneration;
+    try {
+        const params = new URLSearchParams({
+            path: decodeURIComponent(fileGrid.dataset.path),
+            offset: listingOffset,
+            limit: fileGrid.dataset.pageSize,
+            sort: listingSort,
+            order: listingOrder
+        });
+        const response = await fetch('/api/list?' + params);
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.message);
+        }
+        if (generation !== listingGeneration) {
+            return;  // The sort changed while this page was loading
+        }
+        const fragment = document.createDocumentFragment();
+        result.entries.forEach(entry => fragment.appendChild(createFileCard(entry)));
+        fileGrid.appendChild(fragment);
+        listingTotal = result.total;
+        listingOffset = result.entries.length ? listingOffset + result.entries.length : listingTotal;
+    } catch (error) {
+        showStatus('Could not load more files: ' + error.message, 'error');
+        listingOffset = listingTotal;
+    } finally {
+        listingLoading = false;
+    }
+    // Re-observing fires again right away if the sentinel is still on screen
+    if (listingObserver) {
+        listingObserver.unobserve(gridSentinel);
+        listingObserver.observe(gridSentinel);
+    }
+}
+
+function changeSort() {
+    [listingSort, listingOrder] = document.getElementById('sortSelect').value.split(':');
+    fileGrid.innerHTML = '';
+    listingGeneration++;
+    listingLoading = false;
+    listingOffset = 0;
+    listingTotal = parseInt(fileGrid.dataset.total);
+    loadMoreEntries();
+}
+
+if (fileGrid && gridSentinel && 'IntersectionObserver' in window) {
+    listingObserver = new IntersectionObserver((entries) => {
+        if (entries[0].isIntersecting) {
+            loadMoreEntries();
+        }
+    }, { rootMargin: '600px' });
+    listingObserver.observe(gridSentinel);
+}
+
+// Search across the whole share, a moment after typing stops
+const searchInput = document.getElementById('searchInput');
+const searchResults = document.getElementById('searchResults');
+let searchTimer = null;
+let searchGeneration = 0;
+
+function createSearchResult(entry) {
+    const link = document.createElement('a');
+    link.className = 'search-result';
+    link.href = '/' + entry.path.split('/').map(encodeURIComponent).join('/') + (entry.is_dir ? '/' : '');
+    const icon = document.createElement('span');
+    icon.className = 'file-icon';
+    icon.textContent = entry.icon;
+    const name = document.createElement('span');
+    name.className = 'file-name';
+    name.textContent = entry.path;
+    const size = document.createElement('span');
+    size.className = 'file-size';
+    size.textContent = entry.is_dir ? 'Directory' : formatFileSize(entry.size);
+    link.append(icon, name, size);
+    return link;
+}
+
+async function runSearch() {
+    const query = searchInput.value.trim();
+    const generation = ++searchGeneration;
+    if (!query) {
+        searchResults.innerHTML = '';
+        return;
+    }
+    try {
+        const response = await fetch('/api/search?' + new URLSearchParams({ q: query, limit: 50 }));
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.message);
+        }
+        if (generation !== searchGeneration) {
+            return;  // A newer query was typed meanwhile
+        }
+        searchResults.innerHTML = '';
+        result.results.forEach(entry => searchResults.appendChild(createSearchResult(entry)));
+        if (!result.results.length || result.more || !result.complete) {
+            const note = document.createElement('div');
+            note.className = 'file-size';
+            note.textContent = !result.results.length ? 'No matching files'
+                : result.more ? 'Showing the first 50 matches, type more to narrow them down' : '';
+            if (!result.complete) {
+                note.textContent += ' (still indexing, results may be incomplete)';
+            }
+            searchResults.appendChild(note);
+        }
+    } catch (error) {
+        if (generation === searchGeneration) {
+            searchResults.textContent = 'Search failed: ' + error.message;
+        }
+    }
+}
+
+searchInput.addEventListener('input', () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runSearch, 200);
+});
+
+// Live updates: the server pushes changes to this folder and the grid is patched in place
+const listingPath = decodeURIComponent(document.getElementById('filesSection').dataset.path);
+let liveUpdates = false;
+let liveDisconnected = false;
+
+function refreshListing() {
+    // Without live updates the page reloads to show the change
+    if (!liveUpdates) {
+        setTimeout(() => location.reload(), 1000);
+    }
+}
+
+function cardEntry(card) {
+    return {
+        name: decodeURIComponent(card.dataset.name),
+        is_dir: card.dataset.dir === '1',
+        size: parseFloat(card.dataset.size),
+        mtime: parseFloat(card.dataset.mtime)
+    };
+}
+
+function compareEntries(a, b) {
+    // The order of sort_entries on the server: directories first, then the sort key, then the name
+    if (a.is_dir !== b.is_dir) {
+        return a.is_dir ? -1 : 1;
+    }
+    const nameA = a.name.toLowerCase();
+    const nameB = b.name.toLowerCase();
+    let order = listingSort === 'size' ? (a.size || 0) - (b.size || 0)
+        : listingSort === 'mtime' ? (a.mtime || 0) - (b.mtime || 0) : 0;
+    if (order === 0) {
+        order = nameA < nameB ? -1 : (nameA > nameB ? 1 : 0);
+    }
+    return listingOrder === 'desc' ? -order : order;
+}
+
+function applyChange(change) {
+    const name = change.op === 'remove' ? change.name : change.entry.name;
+    const cards = Array.from(fileGrid.children);
+    const existing = cards.find(card => cardEntry(card).name === name);
+    if (existing) {
+        existing.remove();
+        listingOffset--;
+    }
+    if (existing || change.op === 'remove') {
+        listingTotal--;
+    }
+    if (change.op === 'remove') {
+        return;
+    }
+    listingTotal++;
+    const next = cards.find(card => card !== existing && compareEntries(change.entry, cardEntry(card)) < 0);
+    if (next) {
+        fileGrid.insertBefore(createFileCard(change.entry), next);
+    } else if (listingOffset + 1 >= listingTotal) {
+        fileGrid.appendChild(createFileCard(change.entry));
+    } else {
+        return;  // Sorts into a page that is not loaded yet
+    }
+    listingOffset++;
+}
+
+if ('EventSource' in window) {
+    const source = new EventSource('/events?' + new URLSearchParams({ path: listingPath }));
+    source.onopen = () => {
+        if (liveDisconnected && fileGrid) {
+            changeSort();  // Changes made while reconnecting were missed, refetch the grid
+        }
+        liveUpdates = true;
+        liveDisconnected = false;
+    };
+    source.onerror = () => {
+        liveUpdates = false;
+        liveDisconnected = true;
+    };
+    source.onmessage = (message) => {
+        const update = JSON.parse(message.data);
+        if (update.reset || !fileGrid) {
+            location.reload();  // Lost track of changes, or the first entry of an empty folder
+            return;
+        }
+        update.changes.forEach(applyChange);
+        listingTotal = Math.max(listingTotal, fileGrid.children.length);
+        listingOffset = Math.min(Math.max(listingOffset, 0), listingTotal);
+        document.getElementById('itemCount').textContent = listingTotal + ' item(s)';
+    };
+}
+
+// Drag and drop
+uploadArea.addEventListener('dragover', (e) => {
+    e.preventDefault();
+    uploadArea.classList.add('dragover');
+});
+
+uploadArea.addEventListener('dragleave', () => {
+    uploadArea.classList.remove('dragover');
+});
+
+uploadArea.addEventListener('drop', (e) => {
+    e.preventDefault();
+    uploadArea.classList.remove('dragover');
+    const files = e.dataTransfer.files;
+    if (files.length > 0) {
+        uploadFiles(files);
+    }
+});
+
+fileInput.addEventListener('change', (e) => {
+    if (e.target.files.length > 0) {
+        uploadFiles(e.target.files);
+    }
+});
+
+const UPLOAD_PARALLEL_JOBS = 4;  // Batches and large files uploading at once
+const UPLOAD_PARALLEL_CHUNKS = 4;  // Chunks in flight per large file
+const UPLOAD_BATCH_FILE_SIZE = 1024 * 1024;  // Smaller files are sent together through /api/upload_batch
+const UPLOAD_BATCH_BYTES = 8 * 1024 * 1024;
+const UPLOAD_BATCH_FILES = 200;
+const UPLOAD_CHUNK_RETRIES = 5;
+const UPLOAD_HASH_MAX_SIZE = 256 * 1024 * 1024;  // Larger files are not hashed in the browser (the whole file is read into memory)
+
+async function uploadFiles(files) {
+    files = Array.from(files);
+    progressContainer.style.display = 'block';
+    showStatus(`Uploading ${files.length} files...`, 'info');
+
+    // Byte-level progress: every batch and chunk reports how much of it has been sent
+    const total = files.reduce((sum, file) => sum + file.size, 0) || 1;
+    const sentBy = new Map();
+    let sent = 0;
+    const report = (key, bytes) => {
+        sent += bytes - (sentBy.get(key) || 0);
+        sentBy.set(key, bytes);
+        const progress = Math.min(100, (sent / total) * 100);
+        progressFill.style.width = progress + '%';
+        progressText.textContent = Math.round(progress) + '%';
+    };
+
+    // Small files travel in batches, large ones as resumable chunked uploads
+    const jobs = [];
+    let batch = [];
+    let batchBytes = 0;
+    const queueBatch = () => {
+        if (batch.length > 0) {
+            const files = batch;
+            jobs.push(() => uploadBatch(files, report));
+        }
+        batch = [];
+        batchBytes = 0;
+    };
+    for (const file of files) {
+        if (file.size >= UPLOAD_BATCH_FILE_SIZE) {
+            jobs.push(() => resumableUpload(file, report));
+            continue;
+        }
+        if (batch.length >= UPLOAD_BATCH_FILES || batchBytes + file.size > UPLOAD_BATCH_BYTES) {
+            queueBatch();
+        }
+        batch.push(file);
+        batchBytes += file.size;
+    }
+    queueBatch();
+
+    const failures = [];
+    const runJobs = async () => {
+        while (jobs.length > 0) {
+            const job = jobs.shift();
+            try {
+                await job();
+            } catch (error) {
+                failures.push(error.message);
+            }
+        }
+    };
+    await Promise.all(Array.from({ length: UPLOAD_PARALLEL_JOBS }, runJobs));
+
+    progressContainer.style.display = 'none';
+    if (failures.length > 0) {
+        showStatus(`Upload failed: ${failures[0]} (choose the files again to resume)`, 'error');
+        return;
+    }
+    showStatus('All files uploaded successfully!', 'success');
+    refreshListing();
+}
+
+async function uploadBatch(files, report) {
+    const bytes = files.reduce((sum, file) => sum + file.size, 0);
+    const formData = new FormData();
+    files.forEach(file => formData.append('file', file));
+    await uploadRequest('/api/upload_batch', { method: 'POST', body: formData },
+        (loaded, total) => report(files, total ? bytes * loaded / total : 0));
+    report(files, bytes);
+}
+
+// Resumable uploads: the session id is remembered per file, so retrying after
+// a failure or reload only sends the chunks the server has not committed yet
+async function resumableUpload(file, report) {
+    const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let session = null;
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const response = await fetch(`/api/uploads/${savedId}`);
+        if (response.ok) {
+            session = await response.json();
+        }
+    }
+    if (!session) {
+        // With deduplicated storage, content the server already has completes without sending it
+        const sha256 = await hashFile(file);
+        session = await uploadRequest('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, ...(sha256 && { sha256 }) })
+        });
+        if (session.deduplicated) {
+            report(file, file.size);
+            return;
+        }
+        localStorage.setItem(key, session.id);
+    }
+
+    const pending = [];
+    for (let start = 0; start < file.size; start += session.chunk_size) {
+        const end = Math.min(file.size, start + session.chunk_size);
+        if (!session.committed.some(([from, to]) => from <= start && to >= end)) {
+            pending.push([start, end]);
+        }
+    }
+    report(session.id, file.size - pending.reduce((sum, [start, end]) => sum + end - start, 0));
+
+    const sendChunks = async () => {
+        while (pending.length > 0) {
+            const [start, end] = pending.shift();
+            const chunkKey = `${session.id}:${start}`;
+            await uploadRequest(`/api/uploads/${session.id}`, {
+                method: 'PUT',
+                headers: { 'Content-Range': `bytes ${start}-${end - 1}/${file.size}` },
+                body: file.slice(start, end)
+            }, (loaded) => report(chunkKey, loaded));
+            report(chunkKey, end - start);
+        }
+    };
+    await Promise.all(Array.from({ length: UPLOAD_PARALLEL_CHUNKS }, sendChunks));
+
+    await uploadRequest(`/api/uploads/${session.id}/complete`, { method: 'POST' });
+    localStorage.removeItem(key);
+}
+
+// SHA-256 of a file as lowercase hex, or null when the server does not deduplicate, the file is
+// too large or the page is not a secure context (crypto.subtle needs https or localhost)
+async function hashFile(file) {
+    if (uploadArea.dataset.dedup !== '1' || !window.crypto || !crypto.subtle || file.size > UPLOAD_HASH_MAX_SIZE) {
+        return null;
+    }
+    try {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+    } catch (error) {
+        return null;  // Unreadable or out of memory, upload without it
+    }
+}
+
+// XHR request with upload progress, retried on network errors, 5xx and 503 Retry-After
+async function uploadRequest(url, options, onProgress) {
+    for (let attempt = 1; ; attempt++) {
+        let response = null;
+        try {
+            response = await sendRequest(url, options, onProgress);
+        } catch (error) {
+            if (attempt >= UPLOAD_CHUNK_RETRIES) throw error;
+        }
+        if (response && response.status >= 200 && response.status < 300) {
+            return response.body;
+        }
+        if (response && (response.status < 500 || attempt >= UPLOAD_CHUNK_RETRIES)) {
+            throw new Error(response.body.message || `HTTP ${response.status}`);
+        }
+        if (onProgress) onProgress(0, 0);
+        const retryAfter = response && Number(response.retryAfter);
+        await new Promise(resolve => setTimeout(resolve, retryAfter ? retryAfter * 1000 : 500 * 2 ** attempt));
+    }
+}
+
+function sendRequest(url, options, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open(options.method || 'GET', url);
+        for (const [name, value] of Object.entries(options.headers || {})) {
+            xhr.setRequestHeader(name, value);
+        }
+        if (onProgress) {
+            xhr.upload.onprogress = (e) => onProgress(e.loaded, e.lengthComputable ? e.total : 0);
+        }
+        xhr.onload = () => {
+            let body = {};
+            try {
+                body = JSON.parse(xhr.responseText);
+            } catch (error) {}
+            resolve({ status: xhr.status, body, retryAfter: xhr.getResponseHeader('Retry-After') });
+        };
+        xhr.onerror = () => reject(new Error('Network error'));
+        xhr.send(options.body === undefined ? null : options.body);
+    });
+}
+
+// File management functions
+function openFolder(path) {
+    window.location.href = path;
+}
+
+function renameFile(filename) {
+    currentFile = filename;
+    document.getElementById('newFileName').value = filename;
+    document.getElementById('renameModal').style.display = 'block';
+}
+
+function deleteFile(filename) {
+    currentFile = filename;
+    document.getElementById('deleteFileName').textContent = filename;
+    document.getElementById('deleteModal').style.display = 'block';
+}
+
+async function confirmRename() {
+    const newName = document.getElementById('newFileName').value.trim();
+    if (!newName) {
+        showStatus('Please enter a file name', 'error');
+        return;
+    }
+
+    try {
+        const response = await fetch('/rename', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: `old_name=${encodeURIComponent(currentFile)}&new_name=${encodeURIComponent(newName)}`
+        });
+
+        const result = await response.json();
+        if (result.status === 'success') {
+            showStatus('File renamed successfully!', 'success');
+            closeModal('renameModal');
+            refreshListing();
+        } else {
+            showStatus('Rename failed: ' + result.message, 'error');
+        }
+    } catch (error) {
+        showStatus('Rename failed: ' + error.message, 'error');
+    }
+}
+
+async function confirmDelete() {
+    try {
+        const response = await fetch('/delete', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: `filename=${encodeURIComponent(currentFile)}`
+        });
+
+        const result = await response.json();
+        if (result.status === 'success') {
+            showStatus('File deleted successfully!', 'success');
+            closeModal('deleteModal');
+            refreshListing();
+        } else {
+            showStatus('Delete failed: ' + result.message, 'error');
+        }
+    } catch (error) {
+        showStatus('Delete failed: ' + error.message, 'error');
+    }
+}
+
+function closeModal(modalId) {
+    document.getElementById(modalId).style.display = 'none';
+}
+
+function showStatus(message, type) {
+    status.textContent = message;
+    status.className = 'status ' + type;
+}
+
+// Close modals when clicking outside
+window.onclick = function(event) {
+    if (event.target.classList.contains('modal')) {
+        event.target.style.display = 'none';
+    }
+}
+"""
+
+def parse_accept_encoding(header):
+    """Parse an Accept-Encoding header into a {coding: q} dict"""
+    codings = {}
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding] = q
+    return codings
+
+def negotiate_encoding(header, available):
+    """Pick the best of the available content codings the client accepts, or identity"""
+    accepted = parse_accept_encoding(header)
+    best, best_q = "identity", 0.0
+    for coding in ("br", "gzip"):
+        if coding not in available:
+            continue
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def minify_asset(text):
+    """Strip indentation and blank lines, which is safe for the inline CSS and JS"""
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip()) + "\n"
+
+class StaticAsset:
+    """A UI asset built once at startup with a content hash and precompressed variants"""
+
+    def __init__(self, name, content_type, text):
+        body = minify_asset(text).encode("utf-8")
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        base, ext = os.path.splitext(name)
+        self.url = f"/static/{base}.{self.digest}{ext}"
+        self.content_type = content_type
+        self.variants = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding):
+        """Strong ETag for one encoded variant"""
+        if encoding == "identity":
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+def build_static_assets():
+    """Build the versioned UI assets, keyed by name and by their versioned URL"""
+    assets = {
+        "app.css": StaticAsset("app.css", "text/css; charset=utf-8", UI_CSS),
+        "app.js": StaticAsset("app.js", "application/javascript; charset=utf-8", UI_JS),
+    }
+    assets.update({asset.url: asset for asset in list(assets.values())})
+    return assets
+
+STATIC_ASSETS = build_static_assets()
+
+def is_not_modified(headers, etag, mtime=None):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since against the current validators"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is None or mtime is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(mtime) <= since.timestamp()
+
+def if_range_matches(headers, etag, mtime):
+    """Check an If-Range validator against the file's current ETag or Last-Modified"""
+    validator = headers.get('If-Range')
+    if not validator:
+        return True
+    validator = validator.strip()
+    if validator.startswith(('"', 'W/')):
+        # If-Range requires a strong comparison, weak tags never match
+        return validator == etag
+    try:
+        since = email.utils.parsedate_to_datetime(validator)
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(since.timestamp()) == int(mtime)
+
+def get_content_type(filepath):
+    """Get the Content-Type for a file from its extension"""
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext in ['.txt', '.py', '.js', '.css', '.html', '.json']:
+        return 'text/plain; charset=utf-8'
+    elif ext in ['.jpg', '.jpeg']:
+        return 'image/jpeg'
+    elif ext == '.png':
+        return 'image/png'
+    elif ext == '.gif':
+        return 'image/gif'
+    elif ext == '.pdf':
+        return 'application/pdf'
+    else:
+        return 'application/octet-stream'
+
+def http_date(timestamp):
+    """Format a timestamp for Last-Modified and similar headers"""
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+class PlannedResponse:
+    """Status, headers and body parts of a response, independent of the server engine.
+
+    Body parts are either bytes or (offset, length) ranges of the open file,
+    so each engine can send them its own way (socket.sendfile on a thread,
+    loop.sock_sendfile on the event loop).
+    """
+
+    def __init__(self, status, headers, parts=(), cache_control=None):
+        self.status = status
+        self.headers = headers
+        self.parts = list(parts)
+        self.cache_control = cache_control
+
+def plan_file_response(headers, filepath, st):
+    """Decide how to answer a download: 200, 206 (single or multipart), 304 or 416"""
+    file_size = st.st_size
+    etag = make_etag(st)
+    content_type = get_content_type(filepath)
+    validators = [('ETag', etag), ('Last-Modified', http_date(st.st_mtime))]
+    if is_compressible(filepath, st):
+        validators.append(('Vary', 'Accept-Encoding'))
+    policy = CACHE_POLICIES['files']
+
+    if is_not_modified(headers, etag, st.st_mtime):
+        return PlannedResponse(304, validators, cache_control=policy)
+
+    ranges = None
+    if if_range_matches(headers, etag, st.st_mtime):
+        ranges = parse_range_header(headers.get('Range'), file_size)
+
+    if ranges == []:
+        return PlannedResponse(416, [('Content-Range', f'bytes */{file_size}'), ('Content-Length', '0')],
+                               cache_control=policy)
+
+    response_headers = [('Accept-Ranges', 'bytes')] + validators
+    if not ranges:
+        response_headers += [('Content-Type', content_type), ('Content-Length', str(file_size))]
+        return PlannedResponse(200, response_headers, [(0, file_size)], policy)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response_headers += [
+            ('Content-Type', content_type),
+            ('Content-Range', f'bytes {start}-{end}/{file_size}'),
+            ('Content-Length', str(end - start + 1)),
+        ]
+        return PlannedResponse(206, response_headers, [(start, end - start + 1)], policy)
+
+    # Several ranges: a multipart/byteranges body with a precomputed length
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, end in ranges:
+        parts.append((f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                      f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n").encode())
+        parts.append((start, end - start + 1))
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    total = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+    response_headers += [
+        ('Content-Type', f'multipart/byteranges; boundary={boundary}'),
+        ('Content-Length', str(total)),
+    ]
+    return PlannedResponse(206, response_headers, parts, policy)
+
+CONTENT_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+def is_compressible(filepath, st):
+    """Whether a download is text large enough to be worth a Content-Encoding"""
+    return (st.st_size >= CONTENT_ENCODING_MIN_SIZE
+            and os.path.splitext(filepath)[1].lower() in COMPRESSIBLE_EXTENSIONS)
+
+def choose_content_encoding(headers, filepath, st):
+    """Pick gzip or br for a compressible download the client accepts, otherwise identity"""
+    if not is_compressible(filepath, st):
+        return "identity"
+    if headers.get('Range'):
+        # Byte ranges address the identity encoding, so resumed downloads get the original bytes
+        return "identity"
+    return negotiate_encoding(headers.get('Accept-Encoding'), CONTENT_ENCODINGS)
+
+def make_encoder(encoding):
+    """Return (compress, finish) callables of a streaming compressor for a content coding"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=CONTENT_ENCODING_LEVELS["br"])
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(CONTENT_ENCODING_LEVELS["gzip"], zlib.DEFLATED, 31)  # 31: gzip framing
+    return compressor.compress, compressor.flush
+
+class EncodedCache:
+    """Derived copies of files (compressed text, thumbnails), keyed by file identity so an edited file never hits a stale copy.
+
+    The first compressed download of a file version is encoded on the fly and
+    teed into a sidecar; later requests send the sidecar with sendfile and a
+    Content-Length, like any other file.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None  # Estimate of the bytes held, None until the first scan
+
+    def path(self, st, variant):
+        return os.path.join(self.directory,
+                            f"{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}.{variant}")
+
+    def open(self, st, encoding):
+        """Open the sidecar of this file version as (file, size), or None if it is not built yet"""
+        path = self.path(st, encoding)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        sidecar_st = os.fstat(f.fileno())
+        if time.time() - sidecar_st.st_mtime > 60:
+            # The mtime doubles as the last use for eviction, refreshed at most once a minute
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        return f, sidecar_st.st_size
+
+    @contextlib.contextmanager
+    def build(self, source, st, encoding):
+        """Yield a file collecting the encoded bytes, or None if the cache is not writable.
+
+        The result becomes the sidecar only if the block completes and the
+        source file was not modified while it was read.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        except OSError:
+            yield None
+            return
+        try:
+            with os.fdopen(fd, 'wb') as sidecar:
+                yield sidecar
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        current = os.fstat(source.fileno())
+        try:
+            if (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                raise OSError("file changed while it was encoded")
+            added = os.stat(temp_path).st_size
+            os.replace(temp_path, self.path(st, encoding))
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += added
+            if self.size is not None and self.size <= self.max_size:
+                return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used sidecars once the cache outgrows max_size"""
+        with self.lock:
+            now = time.time()
+            sidecars, total = [], 0
+            for entry in os.scandir(self.directory):
+                try:
+                    entry_st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".part"):
+                    if now - entry_st.st_mtime > 3600:
+                        # Left behind by a crashed process, live ones are written continuously
+                        with contextlib.suppress(OSError):
+                            os.unlink(entry.path)
+                    continue
+                sidecars.append((entry_st.st_mtime, entry_st.st_size, entry.path))
+                total += entry_st.st_size
+            for _, size, path in sorted(sidecars):
+                if total <= self.max_size:
+                    break
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+                total -= size
+            self.size = total
+
+ENCODED_CACHE = EncodedCache(ENCODED_CACHE_DIR, ENCODED_CACHE_SIZE)
+
+def plan_encoded_response(headers, filepath, st, encoding, sidecar_size=None):
+    """Answer a compressed download: 304, or 200 sending the sidecar of sidecar_size bytes.
+
+    Without a sidecar the 200 has no body parts and no Content-Length, the
+    caller then compresses the file on the fly.
+    """
+    etag = make_encoded_etag(st, encoding)
+    validators = [('ETag', etag), ('Last-Modified', http_date(st.st_mtime)), ('Vary', 'Accept-Encoding')]
+    policy = CACHE_POLICIES['files']
+    if is_not_modified(headers, etag, st.st_mtime):
+        return PlannedResponse(304, validators, cache_control=policy)
+
+    response_headers = validators + [('Content-Type', get_content_type(filepath)), ('Content-Encoding', encoding)]
+    if sidecar_size is None:
+        return PlannedResponse(200, response_headers, cache_control=policy)
+    response_headers.append(('Content-Length', str(sidecar_size)))
+    return PlannedResponse(200, response_headers, [(0, sidecar_size)], policy)
+
+def parse_exif_thumbnail(tiff):
+    """Extract the JPEG thumbnail IFD1 points to (tags 0x0201/0x0202) from a TIFF-structured EXIF block"""
+    order = {b'II': 'little', b'MM': 'big'}.get(tiff[:2])
+    if order is None:
+        return None
+
+    def number(offset, size):
+        return int.from_bytes(tiff[offset:offset + size], order)
+
+    ifd0 = number(4, 4)
+    ifd1 = number(ifd0 + 2 + 12 * number(ifd0, 2), 4)  # IFD0 is followed by the offset of the next IFD
+    if not ifd1:
+        return None
+    start = length = 0
+    for i in range(number(ifd1, 2)):
+        entry = ifd1 + 2 + 12 * i
+        tag = number(entry, 2)
+        if tag == 0x0201:
+            start = number(entry + 8, 4)
+        elif tag == 0x0202:
+            length = number(entry + 8, 4)
+    thumbnail = tiff[start:start + length]
+    if not start or len(thumbnail) != length or not thumbnail.startswith(b'\xff\xd8'):
+        return None
+    return thumbnail
+
+def read_exif_thumbnail(f):
+    """Return the thumbnail a camera embedded in the EXIF block of JPEG file f, or None"""
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] in (0xDA, 0xD9):
+            return None  # Metadata segments all come before the start of scan
+        length = int.from_bytes(marker[2:], 'big') - 2
+        if length < 0:
+            return None  # A declared length counts its own two bytes, anything shorter is corrupt
+        if marker[1] != 0xE1:
+            f.seek(length, os.SEEK_CUR)
+            continue
+        segment = f.read(min(length, 0xFFFF))  # No segment is larger than 64 KB
+        if segment.startswith(b'Exif\0\0'):
+            return parse_exif_thumbnail(segment[6:])
+
+def render_thumbnail(f, size):
+    """Render the image in file f as JPEG bytes fitting size x size, or None if it cannot be decoded"""
+    if Image is None:
+        return read_exif_thumbnail(f)
+    try:
+        with Image.open(f) as image:
+            image.draft('RGB', (size, size))  # JPEGs are decoded at 1/2 to 1/8 scale, far less work than a full decode
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode != 'RGB':
+                image = image.convert('RGBA')
+                flattened = Image.new('RGB', image.size, (255, 255, 255))
+                flattened.paste(image, mask=image.getchannel('A'))
+                image = flattened
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=THUMB_QUALITY)
+            return output.getvalue()
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return None
+
+def thumb_variant(size):
+    return f"{size}.jpg"
+
+THUMB_CACHE = EncodedCache(THUMB_CACHE_DIR, THUMB_CACHE_SIZE)
+
+class Thumbnailer:
+    """Bounded pool rendering thumbnails into THUMB_CACHE.
+
+    Requests go before warming renders of new images, and requests for a
+    thumbnail already being rendered share that render.
+    """
+
+    MAX_WARMING = 1000  # Queued renders beyond which new images are left for their first request
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = queue.PriorityQueue()  # (priority, sequence, key, filepath, st, size)
+        self.pending = {}  # Cache path -> [future, urgent, started]
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, filepath, st, size, urgent=True):
+        """Return a future of the JPEG bytes of this file version's thumbnail, None if it has none"""
+        key = THUMB_CACHE.path(st, thumb_variant(size))
+        with self.lock:
+            job = self.pending.get(key)
+            if job is None or (urgent and not job[1]):
+                if job is None:
+                    job = self.pending[key] = [concurrent.futures.Future(), urgent, False]
+                job[1] = urgent  # A warming render someone now waits for is queued again up front
+                self.jobs.put((0 if urgent else 1, next(self.sequence), key, filepath, st, size))
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            return job[0]
+
+    def run(self):
+        while True:
+            _, _, key, filepath, st, size = self.jobs.get()
+            with self.lock:
+                job = self.pending.get(key)
+                if job is None or job[2]:
+                    continue
+                job[2] = True
+            try:
+                result = self.render(filepath, st, size)
+            except Exception as e:
+                result = e
+            with self.lock:
+                del self.pending[key]
+            if isinstance(result, Exception):
+                job[0].set_exception(result)
+            else:
+                job[0].set_result(result)
+
+    def render(self, filepath, st, size):
+        """Render one thumbnail and keep it in THUMB_CACHE, returns its bytes or None"""
+        try:
+            source = open(filepath, 'rb')
+        except OSError:
+            return None
+        with source:
+            current = os.fstat(source.fileno())
+            if (current.st_ino, current.st_size, current.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+                return None  # Replaced since it was queued, the new version has its own cache entry
+            data = render_thumbnail(source, size)
+            if data is not None:
+                with THUMB_CACHE.build(source, st, thumb_variant(size)) as cached:
+                    if cached is not None:
+                        cached.write(data)
+        return data
+
+    def on_file_events(self, events):
+        """FileWatcher subscriber: render the card thumbnails of new and changed images before they are shown"""
+        for event in events:
+            if event.is_dir or event.kind not in ('create', 'modify', 'move') \
+                    or os.path.splitext(event.path)[1].lower() not in THUMBNAIL_EXTENSIONS:
+                continue
+            if self.jobs.qsize() >= self.MAX_WARMING:
+                return
+            try:
+                st = os.stat(event.path)
+            except OSError:
+                continue
+            # A file still being written queues one render per batch of writes, stale ones are skipped by render
+            if stat.S_ISREG(st.st_mode) and not os.path.exists(THUMB_CACHE.path(st, thumb_variant(THUMB_CARD_SIZE))):
+                self.submit(event.path, st, THUMB_CARD_SIZE, urgent=False)
+
+THUMBNAILER = Thumbnailer(THUMB_WORKERS)
+FILE_WATCHER.subscribe(THUMBNAILER.on_file_events, exclusive=True)
+
+def lookup_thumbnail(query_string):
+    """Resolve a /thumb query to (filepath, st, size, versioned), None if it names no image that has one.
+
+    Raises ValueError for a malformed size or v.
+    """
+    params = parse_qs(query_string)
+    requested = int(params.get('size', [THUMB_CARD_SIZE])[0])
+    size = next((s for s in THUMB_SIZES if s >= requested), THUMB_SIZES[-1])
+    filepath = resolve_share_path(params.get('path', [''])[0])
+    if filepath is None or os.path.splitext(filepath)[1].lower() not in THUMBNAIL_EXTENSIONS:
+        return None
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    version = params.get('v')
+    # Card URLs carry the file's mtime, so a new version gets a new URL and old ones can be cached for good
+    versioned = version is not None and float(version[0]) == st.st_mtime
+    return filepath, st, size, versioned
+
+def plan_thumb_response(headers, st, size, versioned, body=None):
+    """Answer a thumbnail request: 304, or 200 sending body (JPEG bytes or the size of the cached copy).
+
+    Returns None when the client has no valid copy and no body is given.
+    """
+    etag = make_encoded_etag(st, f"thumb{size}")
+    policy = CACHE_POLICIES['static'] if versioned else CACHE_POLICIES['files']
+    if is_not_modified(headers, etag):
+        return PlannedResponse(304, [('ETag', etag)], cache_control=policy)
+    if body is None:
+        return None
+    length = len(body) if isinstance(body, bytes) else body
+    response_headers = [('ETag', etag), ('Content-Type', 'image/jpeg'), ('Content-Length', str(length))]
+    return PlannedResponse(200, response_headers, [body if isinstance(body, bytes) else (0, length)], policy)
+
+def plan_cached_thumb(headers, filepath, st, size, versioned):
+    """Answer a thumbnail request without rendering as (response, file), (None, None) if it is not cached"""
+    response = plan_thumb_response(headers, st, size, versioned)
+    if response is not None:
+        return response, None
+    cached = THUMB_CACHE.open(st, thumb_variant(size))
+    if cached is None:
+        return None, None
+    f, length = cached
+    return plan_thumb_response(headers, st, size, versioned, length), f
+
+def plan_native_thumb(headers, query_string):
+    """plan_cached_thumb for the event loop, (None, None) leaves errors and renders to a handler"""
+    try:
+        thumb = lookup_thumbnail(query_string)
+    except ValueError:
+        return None, None
+    if thumb is None:
+        return None, None
+    return plan_cached_thumb(headers, *thumb)
+
+def plan_static_response(headers, path):
+    """Answer a versioned UI asset request, or None if there is no such asset"""
+    asset = STATIC_ASSETS.get(path)
+    if asset is None:
+        return None
+
+    encoding = negotiate_encoding(headers.get('Accept-Encoding'), asset.variants)
+    etag = asset.etag(encoding)
+    policy = CACHE_POLICIES['static']
+    if is_not_modified(headers, etag):
+        return PlannedResponse(304, [('ETag', etag)], cache_control=policy)
+
+    body = asset.variants[encoding]
+    response_headers = [
+        ('Content-Type', asset.content_type),
+        ('Content-Length', str(len(body))),
+        ('ETag', etag),
+        ('Vary', 'Accept-Encoding'),
+    ]
+    if encoding != 'identity':
+        response_headers.append(('Content-Encoding', encoding))
+    return PlannedResponse(200, response_headers, [body], policy)
+
+class LoadGauges:
+    """Thread-safe gauges for sizing the worker pool: queued, active_workers, heavy_active, rejected"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = collections.Counter()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    def get(self, name):
+        with self.lock:
+            return self.values[name]
+
+    def snapshot(self):
+        with self.lock:
+            return {name: self.values[name] for name in ('queued', 'active_workers', 'heavy_active', 'rejected')}
+
+LOAD_GAUGES = LoadGauges()
+
+class BatchError(ValueError):
+    """Raised for a batch operation that cannot be carried out, carrying the HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# HTTP status reported for a batch operation that failed with an OSError
+BATCH_ERRNO_STATUS = {
+    errno.ENOENT: 404,
+    errno.EEXIST: 409,
+    errno.ENOTEMPTY: 409,
+    errno.ENOTDIR: 409,
+    errno.EISDIR: 409,
+    errno.EINVAL: 400,
+    errno.EACCES: 403,
+    errno.EPERM: 403,
+    errno.ENOSPC: 507,
+}
+
+def get_batch_executor():
+    """Get the thread pool shared by all /api/batch requests, creating it on first use"""
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+        return _batch_executor
+
+def resolve_batch_path(value):
+    """Map a share-relative path from a batch operation to a path under DIRECTORY.
+
+    Only the parent is resolved, so symlinks are moved and deleted rather
+    than their targets. The share root and hidden upload internals are refused.
+    """
+    if not isinstance(value, str) or not value.strip('/'):
+        raise BatchError(400, "A path inside the share is required")
+    parent, _, name = os.path.normpath(value.strip('/')).rpartition('/')
+    if resolve_share_path(parent) is None or name in ('', '.', '..') \
+            or is_internal_path(value):
+        raise BatchError(400, f"Invalid path: {value}")
+    return os.path.join(DIRECTORY, parent, name)
+
+def copy_file(source, target):
+    """Copy a file's data and mode to a new target, inside the kernel where copy_file_range works.
+
+    Filesystems with reflinks or server-side copy (btrfs, XFS, NFS 4.2)
+    then clone the data without reading it.
+    """
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while True:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30)
+                    if not count:
+                        break
+                    copied += count
+            except OSError as e:
+                if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copied = None  # Not supported between these files, fall back to a user-space copy
+        if not copied:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    shutil.copymode(source, target)
+
+def batch_delete(path, recursive):
+    if os.path.isdir(path) and not os.path.islink(path):
+        if recursive:
+            shutil.rmtree(path)
+        else:
+            os.rmdir(path)
+    else:
+        os.unlink(path)
+    return [path]
+
+def batch_mkdir(path):
+    created = path
+    while not os.path.isdir(os.path.dirname(created)):
+        created = os.path.dirname(created)
+    os.makedirs(path)
+    return [created]
+
+def batch_move(source, target):
+    os.lstat(source)
+    if target.startswith(source + os.sep):
+        raise BatchError(400, "Cannot move a folder into itself")
+    if os.path.lexists(target):
+        raise BatchError(409, "Destination already exists")
+    os.rename(source, target)
+    return [source, target]
+
+def batch_copy(source, target):
+    if not os.path.lexists(source):
+        raise BatchError(404, "Source not found")
+    if target.startswith(source + os.sep):
+        raise BatchError(400, "Cannot copy a folder into itself")
+    if os.path.lexists(target):
+        raise BatchError(409, "Destination already exists")
+    # Built under a hidden name, so listings and the watcher only ever see the finished copy
+    temp_path = os.path.join(os.path.dirname(target), f"{PARTIAL_UPLOAD_PREFIX}{uuid.uuid4().hex}.copy")
+    try:
+        if os.path.isdir(source):
+            shutil.copytree(source, temp_path, symlinks=True, copy_function=copy_file,
+                            ignore=shutil.ignore_patterns(PARTIAL_UPLOAD_PREFIX + '*'))
+        else:
+            copy_file(source, temp_path)
+        os.rename(temp_path, target)
+    except BaseException:
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+        raise
+    return [target]
+
+def prepare_batch_operation(operation):
+    """Validate one batch operation, returns (paths it touches, function carrying it out)"""
+    if not isinstance(operation, dict):
+        raise BatchError(400, "Each operation must be a JSON object")
+    op = operation.get('op')
+    if op == 'delete':
+        path = resolve_batch_path(operation.get('path'))
+        return [path], lambda: batch_delete(path, bool(operation.get('recursive')))
+    if op == 'mkdir':
+        path = resolve_batch_path(operation.get('path'))
+        return [path], lambda: batch_mkdir(path)
+    if op == 'rename':
+        name = operation.get('name')
+        if not isinstance(name, str) or '/' in name or name in ('', '.', '..') or name.startswith(PARTIAL_UPLOAD_PREFIX):
+            raise BatchError(400, "rename needs a new name without slashes")
+        source = resolve_batch_path(operation.get('path'))
+        target = os.path.join(os.path.dirname(source), name)
+        return [source, target], lambda: batch_move(source, target)
+    if op in ('move', 'copy'):
+        source = resolve_batch_path(operation.get('from'))
+        target = resolve_batch_path(operation.get('to'))
+        action = batch_move if op == 'move' else batch_copy
+        return [source, target], lambda: action(source, target)
+    raise BatchError(400, "op must be one of delete, move, rename, mkdir or copy")
+
+def run_batch_operation(index, op, action):
+    """Carry out one prepared batch operation and record its changes, returns its result line"""
+    try:
+        changed = action()
+    except (BatchError, OSError) as e:
+        status = e.status if isinstance(e, BatchError) else BATCH_ERRNO_STATUS.get(e.errno, 500)
+        message = str(e) if isinstance(e, BatchError) else e.strerror or str(e)
+        return {"index": index, "op": op, "status": "error", "code": status, "message": message}
+    for path in changed:
+        LISTING_CACHE.invalidate(path)
+    SEARCH_INDEX.changed(*changed)
+    return {"index": index, "op": op, "status": "success"}
+
+def run_batch(operations):
+    """Run batch operations on the shared pool, yielding each result line as it finishes.
+
+    Operations run concurrently until one touches a path at, above or below
+    a path an earlier operation still in flight touches; that one waits for
+    them, so a batch ends up as if it had run in order.
+    """
+    executor = get_batch_executor()
+    root = os.path.abspath(DIRECTORY)
+    running, touched, above = [], set(), set()
+
+    def ancestors(path):
+        while path != root and path.startswith(root):
+            path = os.path.dirname(path)
+            yield path
+
+    try:
+        for index, operation in enumerate(operations):
+            op = operation.get('op') if isinstance(operation, dict) else None
+            try:
+                paths, action = prepare_batch_operation(operation)
+            except BatchError as e:
+                yield {"index": index, "op": op, "status": "error", "code": e.status, "message": str(e)}
+                continue
+            paths = [os.path.abspath(path) for path in paths]
+            if any(path in touched or path in above or not touched.isdisjoint(ancestors(path)) for path in paths):
+                for future in concurrent.futures.as_completed(running):
+                    yield future.result()
+                running, touched, above = [], set(), set()
+            touched.update(paths)
+            for path in paths:
+                above.update(ancestors(path))
+            running.append(executor.submit(run_batch_operation, index, op, action))
+        for future in concurrent.futures.as_completed(running):
+            yield future.result()
+    finally:
+        for future in running:
+            future.cancel()  # The client went away, operations not started yet are dropped
+
+# Exact (method, path) routes; the rest is matched in classify_route
+METRIC_ROUTES = {
+    ('GET', '/'): 'listing',
+    ('GET', '/api/list'): 'api_list',
+    ('GET', '/api/search'): 'api_search',
+    ('GET', '/api/status'): 'api_status',
+    ('GET', '/api/bandwidth'): 'api_bandwidth',
+    ('GET', '/metrics'): 'metrics',
+    ('GET', '/events'): 'events',
+    ('GET', '/thumb'): 'thumb',
+    ('POST', '/upload'): 'upload',
+    ('POST', '/api/upload_batch'): 'upload_batch',
+    ('POST', '/api/uploads'): 'upload_session',
+    ('POST', '/api/bandwidth'): 'api_bandwidth',
+    ('POST', '/delete'): 'delete',
+    ('POST', '/rename'): 'rename',
+    ('POST', '/create_folder'): 'create_folder',
+    ('POST', '/api/batch'): 'batch',
+}
+
+def classify_route(command, target):
+    """Label a request for /metrics from its method and path; directory listings relabel themselves"""
+    path = target.partition('?')[0]
+    if '%' in path:
+        path = urllib.parse.unquote(path)
+    route = METRIC_ROUTES.get((command, path))
+    if route is not None:
+        return route
+    if path.startswith('/api/uploads/'):
+        return 'upload_session'
+    if command == 'GET':
+        if path.startswith('/static/'):
+            return 'static'
+        return 'download_zip' if path.startswith('/download_zip') else 'download'
+    return {'POST': 'upload_form', 'PUT': 'rename', 'DELETE': 'delete'}.get(command, 'other')
+
+def format_sample(name, label_names, labels, value):
+    """One line of the Prometheus text format"""
+    pairs = ','.join(f'{key}="{value}"' for key, value in zip(label_names, labels))
+    return f'{name}{{{pairs}}} {value}' if pairs else f'{name} {value}'
+
+class Metrics:
+    """Request metrics kept in per-thread shards and merged when /metrics is scraped.
+
+    A thread only ever writes its own shard, so recording a request is a
+    few dict and list updates without a lock; the lock is only taken once
+    per thread to register its shard and on each scrape. Shards outlive
+    their threads so that counters never go backwards.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            # route -> [{status: count}, received, sent, latency histogram], name -> histogram, name -> gauge
+            shard = self.local.shard = ({}, {}, {})
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def new_histogram(self):
+        return [0] * (len(self.buckets) + 2)  # One count per bucket, +Inf, then the sum
+
+    def request(self, route, status, seconds, received, sent):
+        """Record one answered request"""
+        routes = self.shard()[0]
+        stats = routes.get(route)
+        if stats is None:
+            stats = routes[route] = [{}, 0, 0, self.new_histogram()]
+        statuses = stats[0]
+        statuses[status] = statuses.get(status, 0) + 1
+        stats[1] += received
+        stats[2] += sent
+        histogram = stats[3]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def observe(self, name, seconds):
+        histograms = self.shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = self.new_histogram()
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def gauge(self, name, amount):
+        """Move a gauge up or down; a thread lowers what it raised, so the sum over shards is exact"""
+        gauges = self.shard()[2]
+        gauges[name] = gauges.get(name, 0) + amount
+
+    def collect(self):
+        """Merge the shards into (routes, histograms, gauges) shaped like one shard"""
+        with self.lock:
+            shards = list(self.shards)
+        routes, histograms, gauges = {}, {}, collections.Counter()
+        for shard_routes, shard_histograms, shard_gauges in shards:
+            for route, (statuses, received, sent, histogram) in shard_routes.copy().items():
+                merged = routes.setdefault(route, [collections.Counter(), 0, 0, self.new_histogram()])
+                merged[0].update(statuses.copy())
+                merged[1] += received
+                merged[2] += sent
+                merged[3] = [a + b for a, b in zip(merged[3], list(histogram))]
+            for name, histogram in shard_histograms.copy().items():
+                histograms[name] = [a + b for a, b in zip(histograms.get(name) or self.new_histogram(), list(histogram))]
+            gauges.update(shard_gauges.copy())
+        return routes, histograms, gauges
+
+    def format_histogram(self, name, label_names, labels, histogram):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(format_sample(f'{name}_bucket', label_names + ('le',), labels + (bound,), cumulative))
+        lines.append(format_sample(f'{name}_sum', label_names, labels, round(histogram[-1], 6)))
+        lines.append(format_sample(f'{name}_count', label_names, labels, cumulative))
+        return lines
+
+    def render(self, extra=()):
+        """Prometheus text format of the recorded metrics plus extra (name, type, help, value) samples"""
+        routes, histograms, gauges = self.collect()
+        lines = ['# HELP fileserver_requests_total Requests answered',
+                 '# TYPE fileserver_requests_total counter']
+        for route, stats in sorted(routes.items()):
+            lines += [format_sample('fileserver_requests_total', ('route', 'status'), (route, status), count)
+                      for status, count in sorted(stats[0].items())]
+        lines += ['# HELP fileserver_request_duration_seconds Time from the parsed request head to the end of the response',
+                  '# TYPE fileserver_request_duration_seconds histogram']
+        for route, stats in sorted(routes.items()):
+            lines += self.format_histogram('fileserver_request_duration_seconds', ('route',), (route,), stats[3])
+        for index, name, help_text in ((1, 'fileserver_received_bytes_total', 'Request body bytes (Content-Length)'),
+                                       (2, 'fileserver_sent_bytes_total', 'Response bytes sent, headers included')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [format_sample(name, ('route',), (route,), stats[index]) for route, stats in sorted(routes.items())]
+        lines += ['# HELP fileserver_zip_build_seconds Time to build and stream a ZIP archive',
+                  '# TYPE fileserver_zip_build_seconds histogram']
+        lines += self.format_histogram('fileserver_zip_build_seconds', (), (),
+                                       histograms.get('zip_build') or self.new_histogram())
+        extra = [('fileserver_uploads_in_flight', 'gauge', 'Upload requests being received', gauges['uploads'])] + list(extra)
+        for name, kind, help_text, value in extra:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+class MeteredSocket:
+    """Socket proxy counting the bytes sent through sendall and sendfile for /metrics"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+        self.settimeout = sock.settimeout  # Called twice per keep-alive request, skip __getattr__
 
-def get_local_ip():
-    """Detect local LAN IP address"""
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-    except Exception:
-        ip = "127.0.0.1"
-    return ip
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def sendfile(self, f, offset=0, count=None):
+        sent = self.sock.sendfile(f, offset, count)
+        self.sent += sent
+        return sent
+
+class Transfer:
+    """Token bucket of one shaped response; its rate is set by BandwidthShaper.rebalance"""
+
+    def __init__(self, shaper, client, weight):
+        self.shaper = shaper
+        self.client = client
+        self.weight = weight
+        self.rate = 0.0  # Bytes per second, 0 means unlimited
+        self.tokens = SHAPING_BURST
+        self.last = time.monotonic()
+        self.sent = 0
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket and return the seconds to wait before sending them"""
+        with self.shaper.lock:
+            self.sent += nbytes
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(SHAPING_BURST, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def throttle(self, nbytes):
+        """Blocking form of reserve for handler threads"""
+        delay = self.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+class BandwidthShaper:
+    """Token-bucket shaping of bulk downloads, globally and per client IP.
+
+    Active transfers share the global limit by weight (water-filling, so
+    bandwidth a client cannot use under its own cap goes to the others),
+    and each client's cap is split by weight between its transfers.
+    Responses smaller than PRIORITY_RESPONSE_SIZE are never shaped, which
+    keeps listings, API calls and UI assets fast while bulk transfers run.
+    Limits are totals; with `processes` worker processes each one enforces
+    its share of them.
+    """
+
+    def __init__(self, global_limit=BANDWIDTH_LIMIT, client_limit=CLIENT_BANDWIDTH_LIMIT):
+        self.lock = threading.Lock()
+        self.global_limit = global_limit
+        self.client_limit = client_limit
+        self.processes = 1  # Connections land on any worker process, each shapes 1/processes of the limits
+        self.transfers = set()
+
+    def set_limits(self, global_limit=None, client_limit=None):
+        """Change limits at runtime; running transfers pick up their new rates immediately"""
+        with self.lock:
+            if global_limit is not None:
+                self.global_limit = max(0, int(global_limit))
+            if client_limit is not None:
+                self.client_limit = max(0, int(client_limit))
+            self.rebalance()
+
+    def share_limits(self):
+        """Publish the current limits to the other worker processes through the supervisor"""
+        with self.lock:
+            limits = {'global_limit': self.global_limit, 'client_limit': self.client_limit}
+        temp_path = f"{BANDWIDTH_LIMITS_PATH}.{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            json.dump(limits, f)
+        os.replace(temp_path, BANDWIDTH_LIMITS_PATH)
+        os.kill(os.getppid(), signal.SIGUSR1)  # Forwarded to every worker, which then calls load_limits
+
+    def load_limits(self):
+        """Apply limits published by share_limits, if any"""
+        try:
+            with open(BANDWIDTH_LIMITS_PATH) as f:
+                limits = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.set_limits(limits.get('global_limit'), limits.get('client_limit'))
+
+    @contextlib.contextmanager
+    def transfer(self, client, size=None, weight=1):
+        """Shape one response body of size bytes (None when unknown); yields None for the priority lane"""
+        if size is not None and size < PRIORITY_RESPONSE_SIZE:
+            yield None
+            return
+        transfer = Transfer(self, client, weight)
+        with self.lock:
+            self.transfers.add(transfer)
+            self.rebalance()
+        try:
+            yield transfer
+        finally:
+            with self.lock:
+                self.transfers.discard(transfer)
+                self.rebalance()
+
+    def rebalance(self):
+        """Recompute every transfer's rate; the caller holds the lock"""
+        caps = {}
+        clients = collections.defaultdict(list)
+        client_limit = self.client_limit / self.processes
+        for transfer in self.transfers:
+            clients[transfer.client].append(transfer)
+        for group in clients.values():
+            weight = sum(t.weight for t in group)
+            for transfer in group:
+                caps[transfer] = client_limit * transfer.weight / weight if client_limit else float('inf')
+
+        if not self.global_limit:
+            for transfer in self.transfers:
+                transfer.rate = 0.0 if caps[transfer] == float('inf') else caps[transfer]
+            return
+        remaining = self.global_limit / self.processes
+        weight_left = sum(t.weight for t in self.transfers)
+        for transfer in sorted(self.transfers, key=lambda t: caps[t] / t.weight):
+            rate = min(caps[transfer], remaining * transfer.weight / weight_left)
+            transfer.rate = rate
+            remaining -= rate
+            weight_left -= transfer.weight
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'global_limit': self.global_limit,
+                'client_limit': self.client_limit,
+                'processes': self.processes,
+                'priority_response_size': PRIORITY_RESPONSE_SIZE,
+                'transfers': [{'client': t.client, 'weight': t.weight, 'rate': round(t.rate), 'sent': t.sent}
+                              for t in self.transfers],
+            }
+
+SHAPER = BandwidthShaper()
+HEAVY_REQUESTS = threading.BoundedSemaphore(MAX_HEAVY_REQUESTS)
+
+OVERLOADED_BODY = b'{"status": "error", "message": "Server is busy, retry shortly"}'
+
+def overloaded_response():
+    """Raw 503 sent before a request reaches a handler"""
+    return (
+        "HTTP/1.1 503 Service Unavailable\r\n"
+        f"Retry-After: {RETRY_AFTER}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(OVERLOADED_BODY)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + OVERLOADED_BODY
 
 class FileServerHandler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=DIRECTORY, **kwargs)
         self.upload_progress = {}
 
+    protocol_version = 'HTTP/1.1'
+    cache_control = None  # Set by a handler to replace the default no-store headers for one response
+    timeout = IDLE_TIMEOUT  # Stalled clients must not pin a pool worker
+    disable_nagle_algorithm = True  # Headers and body are separate writes; on keep-alive Nagle would stall the body
+    requests_handled = 0  # Earlier requests answered on this connection
+    response_status = None
+    response_framed = False  # Whether the current response sent Content-Length or Transfer-Encoding
+    response_connection = False  # Whether the current response sent its own Connection header
+    UPLOAD_HANDLERS = {'handle_upload', 'handle_upload_batch', 'handle_multipart_upload', 'handle_upload_session'}  # Heavy handlers counted in the uploads gauge
+    route = None  # /metrics label set by handlers that cannot be told apart by URL
+
+    def setup(self):
+        if METRICS_ENABLED:
+            self.request = MeteredSocket(self.request)
+        super().setup()
+
+    def handle(self):
+        """Answer requests on one persistent connection until either side closes it"""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.requests_handled += 1
+            if not self.wait_for_request():
+                break
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """Answer one request and record it for /metrics"""
+        if not METRICS_ENABLED:
+            return super().handle_one_request()
+        started = time.perf_counter()
+        sent = self.connection.sent
+        self.command = self.route = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.command is not None and self.raw_requestline:
+                # Headers are unset when a first request is rejected while parsing them
+                length = getattr(self, 'headers', {}).get('Content-Length', '') if self.command != 'GET' else ''
+                METRICS.request(self.route or classify_route(self.command, self.path), self.response_status,
+                                time.perf_counter() - started, int(length) if length.isdigit() else 0,
+                                self.connection.sent - sent)
+
+    def wait_for_request(self):
+        """Wait up to KEEPALIVE_TIMEOUT for the next request on an idle connection.
+
+        Gives up as soon as other connections are queued for a worker. A
+        timed out read would leave rfile unusable, so the wait is a select
+        in KEEPALIVE_POLL_INTERVAL slices after a non-blocking look at what
+        is already buffered.
+        """
+        deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        try:
+            self.connection.settimeout(0)
+            if not self.rfile.peek(1):
+                while not select.select([self.connection], [], [], KEEPALIVE_POLL_INTERVAL)[0]:
+                    if self.server.is_busy() or time.monotonic() >= deadline:
+                        return False
+            self.connection.settimeout(self.timeout)
+            return bool(self.rfile.peek(1))  # Empty when the client closed the connection
+        except OSError:
+            return False
+
+    def keep_alive_allowed(self):
+        """Whether the connection may stay open after the current response"""
+        if self.requests_handled + 1 >= MAX_KEEPALIVE_REQUESTS:
+            return False
+        if not self.response_framed and self.response_status not in (204, 304):
+            return False  # The body can only be delimited by closing
+        return not self.server.is_busy()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.response_framed = False
+        self.response_connection = False
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() in ('content-length', 'transfer-encoding'):
+            self.response_framed = True
+        elif keyword.lower() == 'connection':
+            self.response_connection = True
+        super().send_header(keyword, value)
+
     def end_headers(self):
-        """Add performance headers"""
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
+        """Add performance and connection headers"""
+        if not self.response_connection:
+            if self.close_connection or not self.keep_alive_allowed():
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        cache_control, self.cache_control = self.cache_control, None
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        else:
+            self.send_header('Cache-Control', CACHE_POLICIES['default'])
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Expires', '0')
         super().end_headers()
 
+    def send_not_modified(self, etag, mtime=None):
+        """Send a bodiless 304 carrying the validators"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.end_headers()
+
     def send_file_streaming(self, filepath):
-        """Stream file in chunks instead of loading entirely into memory"""
+        """Stream file in chunks instead of loading entirely into memory, honouring Range requests"""
         try:
-            file_size = os.path.getsize(filepath)
-            self.send_response(200)
-            self.send_header('Content-Length', str(file_size))
-            self.send_header('Accept-Ranges', 'bytes')
-            
-            # Get file extension for content type
-            ext = os.path.splitext(filepath)[1].lower()
-            if ext in ['.txt', '.py', '.js', '.css', '.html', '.json']:
-                self.send_header('Content-Type', 'text/plain; charset=utf-8')
-            elif ext in ['.jpg', '.jpeg']:
-                self.send_header('Content-Type', 'image/jpeg')
-            elif ext == '.png':
-                self.send_header('Content-Type', 'image/png')
-            elif ext == '.gif':
-                self.send_header('Content-Type', 'image/gif')
-            elif ext == '.pdf':
-                self.send_header('Content-Type', 'application/pdf')
-            else:
-                self.send_header('Content-Type', 'application/octet-stream')
-            
-            self.end_headers()
-            
-            # Stream file in chunks
-            with open(filepath, 'rb') as f:
-                bytes_sent = 0
+            f = open(filepath, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        with f:
+            try:
+                st = os.fstat(f.fileno())
+                encoding = choose_content_encoding(self.headers, filepath, st)
+                if encoding != "identity":
+                    return self.send_encoded_file(f, filepath, st, encoding)
+                response = plan_file_response(self.headers, filepath, st)
+                self.send_planned_response(response, f)
+            except Exception as e:
+                if not self.wfile.closed:
+                    self.send_error(500, f"Error serving file: {str(e)}")
+
+    def send_encoded_file(self, f, filepath, st, encoding):
+        """Send a compressed download from its sidecar, or compress it on the fly and build the sidecar"""
+        sidecar = ENCODED_CACHE.open(st, encoding)
+        if sidecar is not None:
+            with sidecar[0]:
+                response = plan_encoded_response(self.headers, filepath, st, encoding, sidecar[1])
+                return self.send_planned_response(response, sidecar[0])
+
+        response = plan_encoded_response(self.headers, filepath, st, encoding)
+        if response.status != 200:
+            return self.send_planned_response(response)
+
+        # The encoded size is unknown until the end, so use chunked framing or end the body by closing
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        for key, value in response.headers:
+            self.send_header(key, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.cache_control = response.cache_control
+        self.end_headers()
+
+        compress, finish = make_encoder(encoding)
+        buffer = get_copy_buffer()
+        try:
+            with ENCODED_CACHE.build(f, st, encoding) as sidecar, \
+                    SHAPER.transfer(self.client_address[0], st.st_size, TRANSFER_WEIGHTS['file']) as transfer:
+                stream = ResponseStream(self.wfile, chunked, transfer)
                 while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk:
+                    read = f.readinto(buffer)
+                    data = compress(buffer[:read]) if read else finish()
+                    if data:
+                        if sidecar is not None:
+                            sidecar.write(data)
+                        stream.write(data)
+                    if not read:
                         break
+                stream.finish()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client disconnected, the partial sidecar is discarded
+            self.close_connection = True
+
+    def send_planned_response(self, response, f=None):
+        """Send a PlannedResponse, copying file ranges from f"""
+        self.send_response(response.status)
+        for key, value in response.headers:
+            self.send_header(key, value)
+        self.cache_control = response.cache_control
+        self.end_headers()
+        size = sum(len(part) if isinstance(part, bytes) else part[1] for part in response.parts)
+        with SHAPER.transfer(self.client_address[0], size, TRANSFER_WEIGHTS['file']) as transfer:
+            for part in response.parts:
+                if isinstance(part, bytes):
                     try:
-                        self.wfile.write(chunk)
-                        bytes_sent += len(chunk)
-                        self.wfile.flush()  # Ensure data is sent immediately
+                        self.wfile.write(part)
                     except (BrokenPipeError, ConnectionResetError):
-                        # Client disconnected, stop sending
-                        break
-                    
-        except Exception as e:
-            if not self.wfile.closed:
-                self.send_error(500, f"Error serving file: {str(e)}")
+                        return
+                elif not self.copy_file_range(f, *part, transfer):
+                    return
 
+    def copy_file_range(self, f, offset, length, transfer=None):
+        """Send length bytes of an open file starting at offset, returns False if the client left"""
+        if length <= 0:
+            return True
+        if transfer is not None:
+            # Shaped: send in slices, each waiting for its tokens. Without a limit the
+            # rest goes out in one sendfile and is only counted; a limit set meanwhile
+            # applies from the next response
+            position, end = offset, offset + length
+            while position < end:
+                count = min(SHAPING_SLICE, end - position) if transfer.rate else end - position
+                transfer.throttle(count)
+                if not self.copy_file_range(f, position, count):
+                    return False
+                position += count
+            return True
+        try:
+            if USE_SENDFILE and hasattr(self.connection, 'sendfile'):
+                # Zero-copy path: the kernel moves pages from the file to the socket
+                self.wfile.flush()
+                sent = self.connection.sendfile(f, offset, length)
+                return sent == length
+            return self.copy_file_range_buffered(f, offset, length)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client disconnected, stop sending
+            return False
 
+    def copy_file_range_buffered(self, f, offset, length):
+        """Fallback copy loop reusing one large per-thread buffer and no per-chunk flush"""
+        buffer = get_copy_buffer()
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            view = buffer[:min(len(buffer), remaining)]
+            read = f.readinto(view)
+            if not read:
+                return False
+            self.wfile.write(view[:read])
+            remaining -= read
+        return True
 
     def list_directory(self, path):
         """Generate a modern, organized file browser UI with file management features"""
+        self.route = 'listing'  # Directory URLs look like downloads to classify_route
         try:
-            file_list = os.listdir(path)
+            entries = LISTING_CACHE.get(path)
         except OSError:
             self.send_error(404, "No permission to list directory")
             return None
 
-        # Sort files: directories first, then files, both alphabetically
-        dirs = []
-        files = []
-        for name in file_list:
-            fullname = os.path.join(path, name)
-            if os.path.isdir(fullname):
-                dirs.append(name)
-            else:
-                files.append(name)
-        
-        dirs.sort(key=lambda a: a.lower())
-        files.sort(key=lambda a: a.lower())
-        sorted_list = dirs + files
+        etag = LISTING_CACHE.get_view(path, entries, 'etag', make_listing_etag)
+        self.cache_control = CACHE_POLICIES['listing']
+        if is_not_modified(self.headers, etag):
+            self.send_not_modified(etag)
+            return None
 
+        rel_path = os.path.relpath(path, DIRECTORY)
+        rel_path = '' if rel_path == '.' else rel_path.replace(os.sep, '/')
         html = []
-        html.append("""
+        html.append(f"""
         <!DOCTYPE html>
         <html lang="en">
         <head>
             <meta charset="utf-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
             <title>📂 Local File Server</title>
-            <style>
-                * { margin: 0; padding: 0; box-sizing: border-box; }
-                
-                body { 
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; 
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    min-height: 100vh;
-                    padding: 20px;
-                }
-                
-                .container {
-                    max-width: 1200px;
-                    margin: 0 auto;
-                    background: white;
-                    border-radius: 20px;
-                    box-shadow: 0 20px 40px rgba(0,0,0,0.1);
-                    overflow: hidden;
-                }
-                
-                .header {
-                    background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
-                    color: white;
-                    padding: 30px;
-                    text-align: center;
-                }
-                
-                .header h1 {
-                    font-size: 2.5em;
-                    margin-bottom: 10px;
-                    font-weight: 300;
-                }
-                
-                .header p {
-                    opacity: 0.9;
-                    font-size: 1.1em;
-                }
-                
-                .content {
-                    padding: 30px;
-                }
-                
-                .section {
-                    background: #f8f9fa;
-                    border-radius: 15px;
-                    padding: 25px;
-                    margin-bottom: 25px;
-                    border: 1px solid #e9ecef;
-                }
-                
-                .section h2 {
-                    color: #495057;
-                    margin-bottom: 20px;
-                    font-size: 1.5em;
-                    display: flex;
-                    align-items: center;
-                    gap: 10px;
-                }
-                
-                .file-grid {
-                    display: grid;
-                    grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
-                    gap: 15px;
-                }
-                
-                .file-card {
-                    background: white;
-                    border-radius: 12px;
-                    padding: 20px;
-                    border: 2px solid #e9ecef;
-                    transition: all 0.3s ease;
-                    position: relative;
-                }
-                
-                .file-card:hover {
-                    border-color: #4facfe;
-                    transform: translateY(-2px);
-                    box-shadow: 0 10px 25px rgba(0,0,0,0.1);
-                }
-                
-                .file-icon {
-                    font-size: 2em;
-                    margin-bottom: 10px;
-                    display: block;
-                }
-                
-                .file-name {
-                    font-weight: 600;
-                    color: #495057;
-                    margin-bottom: 8px;
-                    word-break: break-word;
-                }
-                
-                .file-size {
-                    color: #6c757d;
-                    font-size: 0.9em;
-                    margin-bottom: 15px;
-                }
-                
-                .file-actions {
-                    display: flex;
-                    gap: 8px;
-                    flex-wrap: wrap;
-                }
-                
-                .btn {
-                    padding: 8px 16px;
-                    border: none;
-                    border-radius: 8px;
-                    cursor: pointer;
-                    font-size: 0.9em;
-                    font-weight: 500;
-                    transition: all 0.3s ease;
-                    text-decoration: none;
-                    display: inline-flex;
-                    align-items: center;
-                    gap: 5px;
-                }
-                
-                .btn-primary {
-                    background: #4facfe;
-                    color: white;
-                }
-                
-                .btn-primary:hover {
-                    background: #3a8bfd;
-                    transform: translateY(-1px);
-                }
-                
-                .btn-danger {
-                    background: #dc3545;
-                    color: white;
-                }
-                
-                .btn-danger:hover {
-                    background: #c82333;
-                    transform: translateY(-1px);
-                }
-                
-                .btn-warning {
-                    background: #ffc107;
-                    color: #212529;
-                }
-                
-                .btn-warning:hover {
-                    background: #e0a800;
-                    transform: translateY(-1px);
-                }
-                
-                .btn-small {
-                    padding: 6px 12px;
-                    font-size: 0.8em;
-                }
-                
-                .upload-area {
-                    border: 3px dashed #dee2e6;
-                    border-radius: 15px;
-                    padding: 40px;
-                    text-align: center;
-                    transition: all 0.3s ease;
-                    background: white;
-                }
-                
-                .upload-area:hover {
-                    border-color: #4facfe;
-                    background: #f8f9ff;
-                }
-                
-                .upload-area.dragover {
-                    border-color: #4facfe;
-                    background: #e3f2fd;
-                }
-                
-                .file-input {
-                    display: none;
-                }
-                
-                .upload-btn {
-                    background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
-                    color: white;
-                    border: none;
-                    padding: 15px 30px;
-                    border-radius: 10px;
-                    font-size: 1.1em;
-                    font-weight: 600;
-                    cursor: pointer;
-                    transition: all 0.3s ease;
-                    margin-top: 15px;
-                }
-                
-                .upload-btn:hover {
-                    transform: translateY(-2px);
-                    box-shadow: 0 10px 25px rgba(79, 172, 254, 0.3);
-                }
-                
-                .upload-btn:disabled {
-                    background: #6c757d;
-                    cursor: not-allowed;
-                    transform: none;
-                    box-shadow: none;
-                }
-                
-                .progress-container {
-                    margin-top: 20px;
-                    display: none;
-                }
-                
-                .progress-bar {
-                    width: 100%;
-                    height: 8px;
-                    background: #e9ecef;
-                    border-radius: 4px;
-                    overflow: hidden;
-                    margin-bottom: 10px;
-                }
-                
-                .progress-fill {
-                    height: 100%;
-                    background: linear-gradient(90deg, #4facfe, #00f2fe);
-                    width: 0%;
-                    transition: width 0.3s ease;
-                }
-                
-                .status {
-                    padding: 15px;
-                    border-radius: 10px;
-                    margin-top: 15px;
-                    font-weight: 500;
-                }
-                
-                .status.success {
-                    background: #d4edda;
-                    color: #155724;
-                    border: 1px solid #c3e6cb;
-                }
-                
-                .status.error {
-                    background: #f8d7da;
-                    color: #721c24;
-                    border: 1px solid #f5c6cb;
-                }
-                
-                .status.info {
-                    background: #d1ecf1;
-                    color: #0c5460;
-                    border: 1px solid #bee5eb;
-                }
-                
-                .empty-state {
-                    text-align: center;
-                    padding: 60px 20px;
-                    color: #6c757d;
-                }
-                
-                .empty-state .icon {
-                    font-size: 4em;
-                    margin-bottom: 20px;
-                    opacity: 0.5;
-                }
-                
-                .modal {
-                    display: none;
-                    position: fixed;
-                    z-index: 1000;
-                    left: 0;
-                    top: 0;
-                    width: 100%;
-                    height: 100%;
-                    background-color: rgba(0,0,0,0.5);
-                }
-                
-                .modal-content {
-                    background-color: white;
-                    margin: 15% auto;
-                    padding: 30px;
-                    border-radius: 15px;
-                    width: 90%;
-                    max-width: 500px;
-                    box-shadow: 0 20px 40px rgba(0,0,0,0.2);
-                }
-                
-                .modal h3 {
-                    margin-bottom: 20px;
-                    color: #495057;
-                }
-                
-                .modal input {
-                    width: 100%;
-                    padding: 12px;
-                    border: 2px solid #e9ecef;
-                    border-radius: 8px;
-                    font-size: 1em;
-                    margin-bottom: 20px;
-                }
-                
-                .modal input:focus {
-                    outline: none;
-                    border-color: #4facfe;
-                }
-                
-                .modal-buttons {
-                    display: flex;
-                    gap: 10px;
-                    justify-content: flex-end;
-                }
-                
-                @media (max-width: 768px) {
-                    .file-grid {
-                        grid-template-columns: 1fr;
-                    }
-                    
-                    .header h1 {
-                        font-size: 2em;
-                    }
-                    
-                    .content {
-                        padding: 20px;
-                    }
-                }
-            </style>
+            <link rel="stylesheet" href="{STATIC_ASSETS['app.css'].url}">
         </head>
         <body>
         """)
@@ -446,79 +4257,17 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
             
             <div class="content">
                 <div class="section">
+                    <h2>🔎 Search</h2>
+                    <input type="search" id="searchInput" class="search-input" placeholder="Find files anywhere by name" autocomplete="off">
+                    <div id="searchResults" class="search-results"></div>
+                </div>
+                
+                <div class="section" id="filesSection" data-path="{urllib.parse.quote(rel_path)}">
                     <h2>📁 Files & Folders</h2>
         """)
 
-        if not sorted_list:
-            html.append("""
-                    <div class="empty-state">
-                        <div class="icon">📁</div>
-                        <h3>No files available</h3>
-                        <p>Upload some files to get started!</p>
-                    </div>
-            """)
-        else:
-            html.append('<div class="file-grid">')
-            
-            for name in sorted_list:
-                    fullname = os.path.join(path, name)
-                    display_name = name
-                    is_dir = os.path.isdir(fullname)
-                    
-                    # Get file info
-                    try:
-                        if is_dir:
-                            size_str = "📁 Directory"
-                            icon = "📁"
-                            actions = f"""
-                                <button class="btn btn-primary btn-small" onclick="openFolder('{urllib.parse.quote(name)}/')">
-                                    📂 Open
-                                </button>
-                                <button class="btn btn-warning btn-small" onclick="renameFile('{name}')">✏️ Rename</button>
-                                <button class="btn btn-danger btn-small" onclick="deleteFile('{name}')">🗑️ Delete</button>
-                            """
-                        else:
-                            size = os.path.getsize(fullname)
-                            size_str = f"📄 {self.format_file_size(size)}"
-                            icon = self.get_file_icon(name)
-                            actions = f"""
-                                <a href="{urllib.parse.quote(name)}" class="btn btn-primary btn-small">⬇️ Download</a>
-                                <button class="btn btn-warning btn-small" onclick="renameFile('{name}')">✏️ Rename</button>
-                                <button class="btn btn-danger btn-small" onclick="deleteFile('{name}')">🗑️ Delete</button>
-                            """
-                    except:
-                        size_str = "N/A"
-                        icon = "📄"
-                        actions = ""
-                    
-                    html.append(f"""
-                        <div class="file-card">
-                            <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 10px;">
-                                <input type="checkbox" class="file-checkbox" data-filename="{name}" style="transform: scale(1.2);">
-                                <span class="file-icon">{icon}</span>
-                            </div>
-                            <div class="file-name">{display_name}</div>
-                            <div class="file-size">{size_str}</div>
-                            <div class="file-actions">
-                                {actions}
-                            </div>
-                        </div>
-                    """)
-            
-            html.append('</div>')
-            
-            # Add bulk actions section
-            html.append("""
-            <div style="margin-top: 20px; padding: 20px; background: #e3f2fd; border-radius: 10px; border: 1px solid #bbdefb;">
-                <h3 style="margin-bottom: 15px; color: #1976d2;">📦 Bulk Actions</h3>
-                <div style="display: flex; gap: 10px; flex-wrap: wrap;">
-                    <button class="btn btn-primary" onclick="selectAll()">☑️ Select All</button>
-                    <button class="btn" onclick="deselectAll()">☐ Deselect All</button>
-                    <button class="btn btn-primary" onclick="downloadSelected()">📦 Download Selected as ZIP</button>
-                    <button class="btn btn-danger" onclick="deleteSelected()">🗑️ Delete Selected</button>
-                </div>
-            </div>
-            """)
+        html.append(LISTING_CACHE.get_view(
+            path, entries, 'html', lambda e: self.render_file_grid(e, rel_path)))
 
         html.append("""
                 </div>
@@ -533,7 +4282,7 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
                 
                 <div class="section">
                     <h2>⬆️ Upload Files</h2>
-                    <div class="upload-area" id="uploadArea">
+                    <div class="upload-area" id="uploadArea" data-dedup="{DEDUP_STORAGE:d}">
                         <div class="icon">📤</div>
                         <h3>Drag & Drop Files Here</h3>
                         <p>or click to select files</p>
@@ -579,265 +4328,9 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         </div>
         """)
 
-        # JavaScript for enhanced functionality
-        html.append("""
-        <script>
-        let currentFile = '';
-        
-        // Upload functionality
-        const uploadArea = document.getElementById('uploadArea');
-        const fileInput = document.getElementById('fileInput');
-        const progressContainer = document.getElementById('progressContainer');
-        const progressFill = document.getElementById('progressFill');
-        const progressText = document.getElementById('progressText');
-        const status = document.getElementById('status');
-        
-        // Folder creation
-        async function createFolder() {
-            const folderName = document.getElementById('folderName').value.trim();
-            if (!folderName) {
-                showStatus('Please enter a folder name', 'error');
-                return;
-            }
-            
-            try {
-                const response = await fetch('/create_folder', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `folder_name=${encodeURIComponent(folderName)}`
-                });
-                
-                const result = await response.json();
-                if (result.status === 'success') {
-                    showStatus('Folder created successfully!', 'success');
-                    document.getElementById('folderName').value = '';
-                    setTimeout(() => location.reload(), 1000);
-                } else {
-                    showStatus('Folder creation failed: ' + result.message, 'error');
-                }
-            } catch (error) {
-                showStatus('Folder creation failed: ' + error.message, 'error');
-            }
-        }
-        
-        // Bulk selection functions
-        function selectAll() {
-            const checkboxes = document.querySelectorAll('.file-checkbox');
-            checkboxes.forEach(checkbox => checkbox.checked = true);
-        }
-        
-        function deselectAll() {
-            const checkboxes = document.querySelectorAll('.file-checkbox');
-            checkboxes.forEach(checkbox => checkbox.checked = false);
-        }
-        
-        function getSelectedFiles() {
-            const checkboxes = document.querySelectorAll('.file-checkbox:checked');
-            return Array.from(checkboxes).map(checkbox => checkbox.dataset.filename);
-        }
-        
-        async function downloadSelected() {
-            const selectedFiles = getSelectedFiles();
-            if (selectedFiles.length === 0) {
-                showStatus('Please select files to download', 'error');
-                return;
-            }
-            
-            const items = selectedFiles.join(',');
-            const url = `/download_zip?items=${encodeURIComponent(items)}`;
-            window.location.href = url;
-        }
-        
-        async function deleteSelected() {
-            const selectedFiles = getSelectedFiles();
-            if (selectedFiles.length === 0) {
-                showStatus('Please select files to delete', 'error');
-                return;
-            }
-            
-            if (!confirm(`Are you sure you want to delete ${selectedFiles.length} item(s)?`)) {
-                return;
-            }
-            
-            let successCount = 0;
-            let errorCount = 0;
-            
-            for (const filename of selectedFiles) {
-                try {
-                    const response = await fetch('/delete', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/x-www-form-urlencoded',
-                        },
-                        body: `filename=${encodeURIComponent(filename)}`
-                    });
-                    
-                    const result = await response.json();
-                    if (result.status === 'success') {
-                        successCount++;
-                    } else {
-                        errorCount++;
-                    }
-                } catch (error) {
-                    errorCount++;
-                }
-            }
-            
-            if (errorCount === 0) {
-                showStatus(`Successfully deleted ${successCount} item(s)!`, 'success');
-            } else {
-                showStatus(`Deleted ${successCount} item(s), ${errorCount} failed`, 'error');
-            }
-            
-            setTimeout(() => location.reload(), 1500);
-        }
-        
-        // Drag and drop
-        uploadArea.addEventListener('dragover', (e) => {
-            e.preventDefault();
-            uploadArea.classList.add('dragover');
-        });
-        
-        uploadArea.addEventListener('dragleave', () => {
-            uploadArea.classList.remove('dragover');
-        });
-        
-        uploadArea.addEventListener('drop', (e) => {
-            e.preventDefault();
-            uploadArea.classList.remove('dragover');
-            const files = e.dataTransfer.files;
-            if (files.length > 0) {
-                uploadFiles(files);
-            }
-        });
-        
-        fileInput.addEventListener('change', (e) => {
-            if (e.target.files.length > 0) {
-                uploadFiles(e.target.files);
-            }
-        });
-        
-        async function uploadFiles(files) {
-            progressContainer.style.display = 'block';
-            showStatus('Uploading files...', 'info');
-            
-            for (let i = 0; i < files.length; i++) {
-                const file = files[i];
-                const formData = new FormData();
-                formData.append('file', file);
-                
-                try {
-                    const response = await fetch('/upload', {
-                        method: 'POST',
-                        body: formData
-                    });
-                    
-                    if (response.ok) {
-                        const progress = ((i + 1) / files.length) * 100;
-                        progressFill.style.width = progress + '%';
-                        progressText.textContent = Math.round(progress) + '%';
-                    } else {
-                        throw new Error('Upload failed');
-                    }
-                } catch (error) {
-                    showStatus('Upload failed: ' + error.message, 'error');
-                    progressContainer.style.display = 'none';
-                    return;
-                }
-            }
-            
-            showStatus('All files uploaded successfully!', 'success');
-            progressContainer.style.display = 'none';
-            setTimeout(() => location.reload(), 1500);
-        }
-        
-        // File management functions
-        function openFolder(path) {
-            window.location.href = path;
-        }
-        
-        function renameFile(filename) {
-            currentFile = filename;
-            document.getElementById('newFileName').value = filename;
-            document.getElementById('renameModal').style.display = 'block';
-        }
-        
-        function deleteFile(filename) {
-            currentFile = filename;
-            document.getElementById('deleteFileName').textContent = filename;
-            document.getElementById('deleteModal').style.display = 'block';
-        }
-        
-        async function confirmRename() {
-            const newName = document.getElementById('newFileName').value.trim();
-            if (!newName) {
-                showStatus('Please enter a file name', 'error');
-                return;
-            }
-            
-            try {
-                const response = await fetch('/rename', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `old_name=${encodeURIComponent(currentFile)}&new_name=${encodeURIComponent(newName)}`
-                });
-                
-                const result = await response.json();
-                if (result.status === 'success') {
-                    showStatus('File renamed successfully!', 'success');
-                    closeModal('renameModal');
-                    setTimeout(() => location.reload(), 1000);
-                } else {
-                    showStatus('Rename failed: ' + result.message, 'error');
-                }
-            } catch (error) {
-                showStatus('Rename failed: ' + error.message, 'error');
-            }
-        }
-        
-        async function confirmDelete() {
-            try {
-                const response = await fetch('/delete', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `filename=${encodeURIComponent(currentFile)}`
-                });
-                
-                const result = await response.json();
-                if (result.status === 'success') {
-                    showStatus('File deleted successfully!', 'success');
-                    closeModal('deleteModal');
-                    setTimeout(() => location.reload(), 1000);
-                } else {
-                    showStatus('Delete failed: ' + result.message, 'error');
-                }
-            } catch (error) {
-                showStatus('Delete failed: ' + error.message, 'error');
-            }
-        }
-        
-        function closeModal(modalId) {
-            document.getElementById(modalId).style.display = 'none';
-        }
-        
-        function showStatus(message, type) {
-            status.textContent = message;
-            status.className = 'status ' + type;
-        }
-        
-        // Close modals when clicking outside
-        window.onclick = function(event) {
-            if (event.target.classList.contains('modal')) {
-                event.target.style.display = 'none';
-            }
-        }
-        </script>
+        # JavaScript for enhanced functionality, served as a cached static asset
+        html.append(f"""
+        <script src="{STATIC_ASSETS['app.js'].url}"></script>
         </body>
         </html>
         """)
@@ -847,6 +4340,8 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         self.send_response(200)
         self.send_header("Content-type", "text/html; charset=utf-8")
         self.send_header("Content-Length", str(len(encoded)))
+        self.send_header("ETag", etag)
+        self.cache_control = CACHE_POLICIES['listing']
         self.end_headers()
         
         try:
@@ -855,6 +4350,108 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
             pass
         return None
 
+    def render_file_grid(self, entries, rel_path=''):
+        """Render the first page of file cards and the bulk actions for a directory listing"""
+        grid = []
+        if not entries:
+            grid.append("""
+                    <div class="empty-state">
+                        <div class="icon">📁</div>
+                        <h3>No files available</h3>
+                        <p>Upload some files to get started!</p>
+                    </div>
+            """)
+        else:
+            grid.append(f"""
+            <div class="listing-toolbar">
+                <span id="itemCount">{len(entries)} item(s)</span>
+                <select id="sortSelect" onchange="changeSort()">
+                    <option value="name:asc">Name A→Z</option>
+                    <option value="name:desc">Name Z→A</option>
+                    <option value="size:desc">Largest first</option>
+                    <option value="size:asc">Smallest first</option>
+                    <option value="mtime:desc">Newest first</option>
+                    <option value="mtime:asc">Oldest first</option>
+                </select>
+            </div>
+            <div class="file-grid" id="fileGrid" data-path="{urllib.parse.quote(rel_path)}"
+                 data-total="{len(entries)}" data-loaded="{min(len(entries), LISTING_PAGE_SIZE)}"
+                 data-page-size="{LISTING_PAGE_SIZE}" data-thumb-size="{THUMB_CARD_SIZE}">""")
+        
+            # Only the first page is rendered here, the rest is fetched from /api/list while scrolling
+            for entry in entries[:LISTING_PAGE_SIZE]:
+                    name = entry.name
+                    display_name = name
+                
+                    # Get file info
+                    try:
+                        if entry.is_dir:
+                            size_str = "📁 Directory"
+                            icon = "📁"
+                            actions = f"""
+                                <button class="btn btn-primary btn-small" onclick="openFolder('{urllib.parse.quote(name)}/')">
+                                    📂 Open
+                                </button>
+                                <button class="btn btn-warning btn-small" onclick="renameFile('{name}')">✏️ Rename</button>
+                                <button class="btn btn-danger btn-small" onclick="deleteFile('{name}')">🗑️ Delete</button>
+                            """
+                        else:
+                            size_str = f"📄 {self.format_file_size(entry.size)}"
+                            icon = self.get_file_icon(name)
+                            actions = f"""
+                                <a href="{urllib.parse.quote(name)}" class="btn btn-primary btn-small">⬇️ Download</a>
+                                <button class="btn btn-warning btn-small" onclick="renameFile('{name}')">✏️ Rename</button>
+                                <button class="btn btn-danger btn-small" onclick="deleteFile('{name}')">🗑️ Delete</button>
+                            """
+                    except:
+                        size_str = "N/A"
+                        icon = "📄"
+                        actions = ""
+                
+                    thumb = ""
+                    if not entry.is_dir and os.path.splitext(name)[1].lower() in THUMBNAIL_EXTENSIONS:
+                        # Lazy: the browser only fetches thumbnails of cards scrolled into view
+                        thumb_query = urllib.parse.urlencode({
+                            'path': f"{rel_path}/{name}" if rel_path else name,
+                            'size': THUMB_CARD_SIZE,
+                            'v': entry.mtime,
+                        })
+                        thumb = (f'<img class="file-thumb" src="/thumb?{thumb_query.replace("&", "&amp;")}" alt="" '
+                                 'loading="lazy" decoding="async" onerror="this.remove()">')
+                
+                    grid.append(f"""
+                        <div class="file-card" data-name="{urllib.parse.quote(name)}" data-dir="{entry.is_dir:d}"
+                             data-size="{entry.size or 0}" data-mtime="{entry.mtime or 0}">
+                            <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 10px;">
+                                <input type="checkbox" class="file-checkbox" data-filename="{name}" style="transform: scale(1.2);">
+                                <span class="file-icon">{icon}</span>
+                            </div>
+                            {thumb}
+                            <div class="file-name">{display_name}</div>
+                            <div class="file-size">{size_str}</div>
+                            <div class="file-actions">
+                                {actions}
+                            </div>
+                        </div>
+                    """)
+        
+            grid.append('</div>')
+            grid.append('<div id="gridSentinel"></div>')
+        
+            # Add bulk actions section
+            grid.append("""
+            <div style="margin-top: 20px; padding: 20px; background: #e3f2fd; border-radius: 10px; border: 1px solid #bbdefb;">
+                <h3 style="margin-bottom: 15px; color: #1976d2;">📦 Bulk Actions</h3>
+                <div style="display: flex; gap: 10px; flex-wrap: wrap;">
+                    <button class="btn btn-primary" onclick="selectAll()">☑️ Select All</button>
+                    <button class="btn" onclick="deselectAll()">☐ Deselect All</button>
+                    <button class="btn btn-primary" onclick="downloadSelected()">📦 Download Selected as ZIP</button>
+                    <button class="btn btn-danger" onclick="deleteSelected()">🗑️ Delete Selected</button>
+                </div>
+            </div>
+            """)
+        return "\n".join(grid)
+
     def format_file_size(self, size):
         """Format file size in human readable format"""
         for unit in ['B', 'KB', 'MB', 'GB']:
@@ -863,18 +4460,19 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
             size /= 1024.0
         return f"{size:.1f} TB"
 
-    def get_file_icon(self, filename):
+    @staticmethod
+    def get_file_icon(filename):
         """Get appropriate icon for file type"""
         ext = os.path.splitext(filename)[1].lower()
         
         # Image files
-        if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp']:
+        if ext in IMAGE_EXTENSIONS:
             return "🖼️"
         # Video files
-        elif ext in ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv']:
+        elif ext in VIDEO_EXTENSIONS:
             return "🎥"
         # Audio files
-        elif ext in ['.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma']:
+        elif ext in AUDIO_EXTENSIONS:
             return "🎵"
         # Document files
         elif ext in ['.pdf']:
@@ -886,16 +4484,16 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         elif ext in ['.ppt', '.pptx']:
             return "📈"
         # Code files
-        elif ext in ['.py', '.js', '.html', '.css', '.php', '.java', '.cpp', '.c', '.h']:
+        elif ext in CODE_EXTENSIONS:
             return "💻"
         # Archive files
-        elif ext in ['.zip', '.rar', '.7z', '.tar', '.gz']:
+        elif ext in ARCHIVE_EXTENSIONS:
             return "📦"
         # Text files
-        elif ext in ['.txt', '.md', '.log', '.csv']:
+        elif ext in TEXT_EXTENSIONS:
             return "📄"
         # Executable files
-        elif ext in ['.exe', '.msi', '.deb', '.rpm', '.dmg']:
+        elif ext in EXECUTABLE_EXTENSIONS:
             return "⚙️"
         else:
             return "📄"
@@ -903,25 +4501,62 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
     def do_POST(self):
         """Handle file uploads with chunked processing"""
         if self.path == '/upload':
-            return self.handle_upload()
+            return self.run_heavy(self.handle_upload)
+        elif self.path == '/api/upload_batch':
+            return self.run_heavy(self.handle_upload_batch)
+        elif self.path == '/api/uploads':
+            return self.handle_upload_session_create()
+        elif self.path == '/api/bandwidth':
+            return self.handle_api_bandwidth()
+        elif UPLOAD_SESSION_ROUTE.match(self.path):
+            return self.run_heavy(self.handle_upload_session, self.path)
         elif self.path == '/delete':
             return self.handle_delete()
         elif self.path == '/rename':
             return self.handle_rename()
         elif self.path == '/create_folder':
             return self.handle_create_folder()
+        elif self.path == '/api/batch':
+            return self.run_heavy(self.handle_api_batch)
         
         # Fallback to old multipart handling
-        return self.handle_multipart_upload()
+        return self.run_heavy(self.handle_multipart_upload)
 
     def do_GET(self):
         """Handle GET requests with streaming for files and zip downloads"""
         parsed_path = urlparse(self.path)
         path = urllib.parse.unquote(parsed_path.path)
         
+        if path == '/api/list':
+            return self.handle_api_list(parsed_path.query)
+        
+        if path == '/api/search':
+            return self.handle_api_search(parsed_path.query)
+        
+        if path == '/api/status':
+            return self.handle_api_status()
+        
+        if path == '/api/bandwidth':
+            return self.handle_api_bandwidth()
+        
+        if path == '/metrics':
+            return self.handle_metrics()
+        
+        if path == '/events':
+            return self.handle_events(parsed_path.query)
+        
+        if UPLOAD_SESSION_ROUTE.match(path):
+            return self.handle_upload_session(path)
+        
+        if path.startswith('/static/'):
+            return self.handle_static(path)
+        
+        if path == '/thumb':
+            return self.handle_thumb(parsed_path.query)
+        
         # Handle zip download
         if path.startswith('/download_zip'):
-            return self.handle_zip_download(parsed_path.query)
+            return self.run_heavy(self.handle_zip_download, parsed_path.query)
         
         # Handle root path
         if path == '/':
@@ -929,7 +4564,9 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         
         # Handle file requests
         filepath = os.path.join(DIRECTORY, path.lstrip('/'))
-        if os.path.isfile(filepath):
+        if resolve_share_path(path) is None:
+            self.send_error(404, "File not found")
+        elif os.path.isfile(filepath):
             return self.send_file_streaming(filepath)
         elif os.path.isdir(filepath):
             return self.list_directory(filepath)
@@ -938,10 +4575,14 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_DELETE(self):
         """Handle DELETE requests for file deletion"""
+        if UPLOAD_SESSION_ROUTE.match(self.path):
+            return self.handle_upload_session(self.path)
         return self.handle_delete()
 
     def do_PUT(self):
-        """Handle PUT requests for file renaming"""
+        """Handle PUT requests for file renaming and resumable upload chunks"""
+        if UPLOAD_SESSION_ROUTE.match(self.path):
+            return self.run_heavy(self.handle_upload_session, self.path)
         return self.handle_rename()
 
     def handle_upload(self):
@@ -949,52 +4590,28 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         content_length = int(self.headers.get("Content-Length", 0))
         
         if content_length > MAX_UPLOAD_SIZE:
-            self.send_response(413, "File too large")
-            self.end_headers()
+            self.close_connection = True  # The body is never read
+            self.send_json(413, {'status': 'error', 'message': 'File too large'})
             return
 
         content_type = self.headers.get("Content-Type", "")
-        if "multipart/form-data" not in content_type:
-            self.send_response(400, "Invalid upload request")
-            self.end_headers()
+        boundary = get_multipart_boundary(content_type)
+        if not boundary:
+            self.close_connection = True
+            self.send_json(400, {'status': 'error', 'message': 'Invalid upload request'})
             return
 
         try:
-            boundary = content_type.split("boundary=")[-1].encode()
-            body = self.rfile.read(content_length)
-            
-            parts = body.split(b"--" + boundary)
-            for part in parts:
-                if b"Content-Disposition" in part and b"filename=" in part:
-                    try:
-                        header, file_data = part.split(b"\r\n\r\n", 1)
-                    except ValueError:
-                        continue
-                    
-                    file_data = file_data.rsplit(b"\r\n", 1)[0]
-                    header_str = header.decode(errors="ignore")
-                    
-                    filename_marker = 'filename="'
-                    filename_start = header_str.find(filename_marker)
-                    if filename_start != -1:
-                        filename_start += len(filename_marker)
-                        filename_end = header_str.find('"', filename_start)
-                        filename = header_str[filename_start:filename_end]
-                        
-                        if filename:
-                            filepath = os.path.join(DIRECTORY, os.path.basename(filename))
-                            with open(filepath, "wb") as f:
-                                f.write(file_data)
+            self.save_multipart_files(boundary, content_length)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"status": "success"}')
+            self.send_json(200, {'status': 'success'})
             
+        except MultipartError as e:
+            self.close_connection = True  # Parsing stopped somewhere inside the body
+            self.send_json(400, {'status': 'error', 'message': str(e)})
         except Exception as e:
-            self.send_response(500, "Upload failed")
-            self.end_headers()
-            self.wfile.write(f'{{"status": "error", "message": "{str(e)}"}}'.encode())
+            self.close_connection = True
+            self.send_json(500, {'status': 'error', 'message': str(e)})
 
     def handle_delete(self):
         """Handle file deletion"""
@@ -1010,10 +4627,10 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
             filename = query_params.get('filename', [''])[0]
 
         if not filename:
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"status": "error", "message": "No filename provided"}')
+            self.send_json(400, {'status': 'error', 'message': 'No filename provided'})
+            return
+        if is_internal_path(filename):
+            self.send_json(400, {'status': 'error', 'message': f'Invalid path: {filename}'})
             return
 
         try:
@@ -1023,21 +4640,14 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
                     os.rmdir(filepath)  # Remove empty directory
                 else:
                     os.remove(filepath)  # Remove file
+                LISTING_CACHE.invalidate(filepath)
+                SEARCH_INDEX.changed(filepath)
                 
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "success", "message": "File deleted successfully"}')
+                self.send_json(200, {'status': 'success', 'message': 'File deleted successfully'})
             else:
-                self.send_response(404)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "error", "message": "File not found"}')
+                self.send_json(404, {'status': 'error', 'message': 'File not found'})
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(f'{{"status": "error", "message": "{str(e)}"}}'.encode())
+            self.send_json(500, {'status': 'error', 'message': str(e)})
 
     def handle_rename(self):
         """Handle file renaming"""
@@ -1049,10 +4659,10 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         new_name = data.get('new_name', [''])[0]
 
         if not old_name or not new_name:
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"status": "error", "message": "Both old_name and new_name required"}')
+            self.send_json(400, {'status': 'error', 'message': 'Both old_name and new_name required'})
+            return
+        if is_internal_path(old_name) or is_internal_path(new_name):
+            self.send_json(400, {'status': 'error', 'message': 'Invalid path'})
             return
 
         try:
@@ -1061,28 +4671,19 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
             
             if os.path.exists(old_path):
                 if os.path.exists(new_path):
-                    self.send_response(409)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(b'{"status": "error", "message": "File with new name already exists"}')
+                    self.send_json(409, {'status': 'error', 'message': 'File with new name already exists'})
                     return
                 
                 os.rename(old_path, new_path)
+                LISTING_CACHE.invalidate(old_path)
+                LISTING_CACHE.invalidate(new_path)
+                SEARCH_INDEX.changed(old_path, new_path)
                 
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "success", "message": "File renamed successfully"}')
+                self.send_json(200, {'status': 'success', 'message': 'File renamed successfully'})
             else:
-                self.send_response(404)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "error", "message": "File not found"}')
+                self.send_json(404, {'status': 'error', 'message': 'File not found'})
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(f'{{"status": "error", "message": "{str(e)}"}}'.encode())
+            self.send_json(500, {'status': 'error', 'message': str(e)})
 
     def handle_create_folder(self):
         """Handle folder creation"""
@@ -1093,159 +4694,1080 @@ class FileServerHandler(http.server.SimpleHTTPRequestHandler):
         folder_name = data.get('folder_name', [''])[0]
 
         if not folder_name:
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"status": "error", "message": "Folder name is required"}')
+            self.send_json(400, {'status': 'error', 'message': 'Folder name is required'})
+            return
+        if is_internal_path(folder_name):
+            self.send_json(400, {'status': 'error', 'message': f'Invalid path: {folder_name}'})
             return
 
         try:
             folder_path = os.path.join(DIRECTORY, folder_name)
             
             if os.path.exists(folder_path):
-                self.send_response(409)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "error", "message": "Folder already exists"}')
+                self.send_json(409, {'status': 'error', 'message': 'Folder already exists'})
                 return
             
             os.makedirs(folder_path, exist_ok=True)
+            LISTING_CACHE.invalidate(folder_path)
+            SEARCH_INDEX.changed(folder_path)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"status": "success", "message": "Folder created successfully"}')
+            self.send_json(200, {'status': 'success', 'message': 'Folder created successfully'})
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(f'{{"status": "error", "message": "{str(e)}"}}'.encode())
+            self.send_json(500, {'status': 'error', 'message': str(e)})
+
+    def handle_api_batch(self):
+        """Run a JSON list of delete/move/rename/mkdir/copy operations, streaming an NDJSON result line for each"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length > BATCH_MAX_BODY:
+            self.close_connection = True
+            return self.send_json(413, {'status': 'error', 'message': 'Request too large'})
+        try:
+            operations = json.loads(self.rfile.read(content_length) or b'null')
+        except ValueError:
+            return self.send_json(400, {'status': 'error', 'message': 'Request body must be JSON'})
+        if not isinstance(operations, list) or not operations:
+            return self.send_json(400, {'status': 'error', 'message': 'Expected a JSON list of operations'})
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return self.send_json(413, {'status': 'error', 'message': f'At most {BATCH_MAX_OPERATIONS} operations per batch'})
+
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        response = ResponseStream(self.wfile, chunked)
+        stream = io.BufferedWriter(response, 64 * 1024)
+        counts = collections.Counter()
+        flushed = time.monotonic()
+        try:
+            with contextlib.closing(run_batch(operations)) as results:
+                for result in results:
+                    counts[result['status']] += 1
+                    stream.write(json.dumps(result).encode() + b"\n")
+                    if time.monotonic() - flushed > 0.25:
+                        # Long batches report progress while they run
+                        stream.flush()
+                        flushed = time.monotonic()
+            stream.write(json.dumps({"done": True, "succeeded": counts['success'], "failed": counts['error']}).encode() + b"\n")
+            stream.flush()
+            response.finish()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
 
     def handle_zip_download(self, query_string):
-        """Handle zip file creation and download"""
+        """Stream a zip archive of the requested items while it is being built"""
+        # Parse query parameters
+        params = urllib.parse.parse_qs(query_string)
+        items = params.get('items', [''])[0].split(',') if params.get('items') else []
+        items = [item.strip() for item in items if item.strip()]
+        mode, level = parse_zip_compression(params.get('compression', [''])[0])
+        
+        if not items:
+            self.send_json(400, {'status': 'error', 'message': 'No items specified for download'})
+            return
+
+        # Paths outside the share or into the upload internals are treated as missing
+        items = [item for item in items if resolve_share_path(item) is not None]
+        if not any(os.path.exists(os.path.join(DIRECTORY, item)) for item in items):
+            self.send_json(404, {'status': 'error', 'message': 'None of the requested items exist'})
+            return
+
+        # The archive size is unknown up front, so use chunked framing or end the body by closing
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', 'attachment; filename="download.zip"')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        started = time.perf_counter()
+        with SHAPER.transfer(self.client_address[0], None, TRANSFER_WEIGHTS['zip']) as transfer:
+            response = ResponseStream(self.wfile, chunked, transfer)
+            stream = io.BufferedWriter(response, ZIP_BUFFER_SIZE)
+            try:
+                if ZIP_WORKERS > 1:
+                    writer = ParallelZipWriter(stream, get_zip_executor(), level)
+                    writer.write_members(
+                        (file_path, arc_name, choose_zip_compression(file_path, mode))
+                        for file_path, arc_name in iter_zip_members(items)
+                    )
+                else:
+                    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zipf:
+                        for file_path, arc_name in iter_zip_members(items):
+                            zipf.write(file_path, arc_name, choose_zip_compression(file_path, mode))
+                stream.flush()
+                response.finish()
+                if METRICS_ENABLED:
+                    METRICS.observe('zip_build', time.perf_counter() - started)
+            except (BrokenPipeError, ConnectionResetError):
+                # Client disconnected, nothing to clean up since no temp file is used
+                self.close_connection = True
+            except Exception as e:
+                # Headers are already sent, so the only way to signal failure is a truncated body
+                self.log_error("Zip download failed: %s", str(e))
+                self.close_connection = True
+
+    def handle_static(self, path):
+        """Serve a versioned UI asset with immutable caching and a precompressed variant"""
+        response = plan_static_response(self.headers, path)
+        if response is None:
+            self.send_error(404, "File not found")
+            return
+        self.send_planned_response(response)
+
+    def handle_thumb(self, query_string):
+        """Serve a JPEG thumbnail of an image, rendered on the THUMBNAILER pool the first time"""
         try:
-            # Parse query parameters
-            params = urllib.parse.parse_qs(query_string)
-            items = params.get('items', [''])[0].split(',') if params.get('items') else []
-            
-            if not items:
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"status": "error", "message": "No items specified for download"}')
+            thumb = lookup_thumbnail(query_string)
+        except ValueError:
+            return self.send_json(400, {"status": "error", "message": "size and v must be numbers"})
+        if thumb is None:
+            self.send_error(404, "No thumbnail for this file")
+            return
+        response, f = plan_cached_thumb(self.headers, *thumb)
+        if response is None:
+            filepath, st, size, versioned = thumb
+            try:
+                data = THUMBNAILER.submit(filepath, st, size).result(THUMB_WAIT)
+            except concurrent.futures.TimeoutError:
+                return self.send_json(503, {"status": "error", "message": "Thumbnail is still being rendered"},
+                                      {'Retry-After': str(RETRY_AFTER)})
+            if data is None:
+                self.send_error(404, "No thumbnail for this file")
                 return
+            response = plan_thumb_response(self.headers, st, size, versioned, data)
+        try:
+            self.send_planned_response(response, f)
+        finally:
+            if f is not None:
+                f.close()
 
-            # Create temporary zip file
-            with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as temp_zip:
-                with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for item in items:
-                        item = item.strip()
-                        if not item:
-                            continue
-                            
-                        item_path = os.path.join(DIRECTORY, item)
-                        if os.path.exists(item_path):
-                            if os.path.isfile(item_path):
-                                # Add single file
-                                zipf.write(item_path, item)
-                            elif os.path.isdir(item_path):
-                                # Add entire directory
-                                for root, dirs, files in os.walk(item_path):
-                                    for file in files:
-                                        file_path = os.path.join(root, file)
-                                        arc_name = os.path.relpath(file_path, DIRECTORY)
-                                        zipf.write(file_path, arc_name)
-
-            # Send the zip file
-            zip_size = os.path.getsize(temp_zip.name)
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/zip')
-            self.send_header('Content-Disposition', 'attachment; filename="download.zip"')
-            self.send_header('Content-Length', str(zip_size))
-            self.end_headers()
-            
-            # Stream the zip file
-            with open(temp_zip.name, 'rb') as f:
-                while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    try:
-                        self.wfile.write(chunk)
-                        self.wfile.flush()
-                    except (BrokenPipeError, ConnectionResetError):
+    def handle_api_list(self, query_string):
+        """Serve a page of a directory listing as JSON, or stream it as NDJSON"""
+        params = urllib.parse.parse_qs(query_string)
+        dirpath = resolve_share_path(params.get('path', [''])[0])
+        sort = params.get('sort', ['name'])[0]
+        order = params.get('order', ['asc'])[0]
+        ndjson = params.get('format', [''])[0] == 'ndjson' or \
+            'application/x-ndjson' in self.headers.get('Accept', '')
+        try:
+            offset = max(0, int(params.get('offset', ['0'])[0]))
+            limit = int(params.get('limit', [str(LISTING_PAGE_SIZE)])[0])
+        except ValueError:
+            return self.send_json(400, {"status": "error", "message": "offset and limit must be integers"})
+        if sort not in LISTING_SORT_KEYS or order not in ('asc', 'desc'):
+            return self.send_json(400, {"status": "error", "message": "Invalid sort or order"})
+        if ndjson:
+            limit = limit if limit > 0 else None  # Stream the whole listing
+        else:
+            limit = min(limit, API_LIST_MAX_LIMIT) if limit > 0 else API_LIST_MAX_LIMIT
+
+        entries = None
+        if dirpath is not None:
+            try:
+                entries = LISTING_CACHE.get(dirpath)
+            except OSError:
+                pass
+        if entries is None:
+            return self.send_json(404, {"status": "error", "message": "Directory not found"})
+
+        descending = order == 'desc'
+        etag = LISTING_CACHE.get_view(dirpath, entries, 'etag', make_listing_etag)
+        self.cache_control = CACHE_POLICIES['api']
+        if not ndjson and is_not_modified(self.headers, etag):
+            self.send_not_modified(etag)
+            return
+        ordered = LISTING_CACHE.get_view(
+            dirpath, entries, ('sort', sort, descending),
+            lambda e: sort_entries(e, sort, descending))
+        page = ordered[offset:offset + limit] if limit else ordered[offset:]
+        rel_path = os.path.relpath(dirpath, os.path.realpath(DIRECTORY))
+        meta = {
+            "path": '' if rel_path == '.' else rel_path.replace(os.sep, '/'),
+            "total": len(ordered),
+            "offset": offset,
+            "limit": limit,
+            "sort": sort,
+            "order": order,
+        }
+
+        if not ndjson:
+            meta["entries"] = [self.listing_entry_json(entry) for entry in page]
+            return self.send_json(200, meta, {'ETag': etag})
+
+        # NDJSON: a metadata line, then one line per entry, written in small batches
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        response = ResponseStream(self.wfile, chunked)
+        stream = io.BufferedWriter(response, 64 * 1024)
+        try:
+            stream.write(json.dumps(meta).encode() + b"\n")
+            for entry in page:
+                stream.write(json.dumps(self.listing_entry_json(entry)).encode() + b"\n")
+            stream.flush()
+            response.finish()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def handle_api_search(self, query_string):
+        """Find files anywhere in the share by name, type and size from the SEARCH_INDEX catalog"""
+        if SEARCH_INDEX.thread is None:
+            return self.send_json(503, {"status": "error", "message": "Search index is not running"})
+        params = urllib.parse.parse_qs(query_string)
+        file_type = params.get('type', [None])[0]
+        sha256 = params.get('sha256', [None])[0]
+        try:
+            sizes = [int(params[name][0]) if name in params else None for name in ('min_size', 'max_size')]
+            offset = max(0, int(params.get('offset', ['0'])[0]))
+            limit = min(max(1, int(params.get('limit', ['50'])[0])), SEARCH_RESULT_LIMIT)
+        except ValueError:
+            return self.send_json(400, {"status": "error", "message": "min_size, max_size, offset and limit must be integers"})
+        if file_type is not None and file_type not in FILE_TYPE_NAMES:
+            return self.send_json(400, {"status": "error", "message": f"type must be one of {', '.join(sorted(FILE_TYPE_NAMES))}"})
+        query = params.get('q', [''])[0]
+        try:
+            results, more, complete = SEARCH_INDEX.search(query, file_type, *sizes, sha256=sha256, limit=limit, offset=offset)
+        except sqlite3.Error as e:
+            return self.send_json(503, {"status": "error", "message": f"Search index unavailable: {e}"},
+                                  {'Retry-After': str(RETRY_AFTER)})
+        for result in results:
+            result['icon'] = "📁" if result['is_dir'] else self.get_file_icon(result['name'])
+        self.cache_control = CACHE_POLICIES['api']
+        self.send_json(200, {
+            "query": query,
+            "offset": offset,
+            "limit": limit,
+            "more": more,
+            "complete": complete,
+            "results": results,
+        })
+
+    @staticmethod
+    def listing_entry_json(entry):
+        """Convert a ListingEntry into the dict returned by /api/list"""
+        return {
+            "name": entry.name,
+            "is_dir": entry.is_dir,
+            "size": entry.size,
+            "mtime": entry.mtime,
+            "icon": "📁" if entry.is_dir else FileServerHandler.get_file_icon(entry.name),
+            "thumb": not entry.is_dir and os.path.splitext(entry.name)[1].lower() in THUMBNAIL_EXTENSIONS,
+        }
+
+    def run_heavy(self, handler, *args):
+        """Run an upload or ZIP build in one of the MAX_HEAVY_REQUESTS slots, 503 when none frees up"""
+        if not HEAVY_REQUESTS.acquire(timeout=HEAVY_REQUEST_WAIT):
+            LOAD_GAUGES.add('rejected')
+            self.close_connection = True  # The request body is left unread
+            return self.send_json(503, {'status': 'error', 'message': 'Too many uploads and downloads in progress, retry shortly'},
+                                  {'Retry-After': str(RETRY_AFTER)})
+        LOAD_GAUGES.add('heavy_active')
+        upload = handler.__name__ in self.UPLOAD_HANDLERS
+        if upload:
+            METRICS.gauge('uploads', 1)
+        try:
+            return handler(*args)
+        finally:
+            if upload:
+                METRICS.gauge('uploads', -1)
+            LOAD_GAUGES.add('heavy_active', -1)
+            HEAVY_REQUESTS.release()
+
+    def handle_upload_batch(self):
+        """Store many small files from one streamed multipart request on the bounded writer pool"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        boundary = get_multipart_boundary(self.headers.get("Content-Type", ""))
+        if content_length > MAX_UPLOAD_SIZE or not boundary:
+            self.close_connection = True
+            return self.send_json(413 if boundary else 400, {'status': 'error', 'message': 'Invalid upload request'})
+
+        writers = get_upload_writers()
+        buffered = threading.BoundedSemaphore(UPLOAD_WRITERS * 2)  # Caps the file data held in memory
+        pending = []
+        saved = []
+        error = None
+        try:
+            for part in MultipartParser(self.rfile, boundary, content_length):
+                if not part.filename or not os.path.basename(part.filename) or is_internal_path(os.path.basename(part.filename)):
+                    continue
+                chunks = part.iter_chunks()
+                data = bytearray()
+                for chunk in chunks:
+                    data += chunk
+                    if len(data) > UPLOAD_BATCH_FILE_LIMIT:
                         break
-            
-            # Clean up temporary file
-            os.unlink(temp_zip.name)
-            
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(f'{{"status": "error", "message": "{str(e)}"}}'.encode())
+                if len(data) > UPLOAD_BATCH_FILE_LIMIT:
+                    # Too large to buffer, stream the rest of it from this thread
+                    save_upload_stream(itertools.chain([bytes(data)], chunks), part.filename)
+                    saved.append(os.path.basename(part.filename))
+                    continue
+                buffered.acquire()
+                future = writers.submit(save_upload_stream, [bytes(data)], part.filename)
+                future.add_done_callback(lambda _: buffered.release())
+                pending.append((os.path.basename(part.filename), future))
+        except MultipartError as e:
+            self.close_connection = True
+            error = (400, str(e))
+        except OSError as e:
+            self.close_connection = True
+            error = (500, str(e))
+
+        failed = []
+        for name, future in pending:
+            try:
+                future.result()
+                saved.append(name)
+            except OSError as e:
+                failed.append({'name': name, 'message': str(e)})
+        if error is None and failed:
+            error = (500, f"{len(failed)} files could not be saved")
+        if error is not None:
+            return self.send_json(error[0], {'status': 'error', 'message': error[1], 'saved': saved, 'failed': failed})
+        self.send_json(200, {'status': 'success', 'saved': saved})
+
+    def handle_upload_session_create(self):
+        """Start a resumable upload: {"filename": ..., "size": ...} -> session with its id and chunk size"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length > MAX_FORM_FIELD_SIZE:
+            self.close_connection = True
+            return self.send_json(413, {'status': 'error', 'message': 'Request too large'})
+        try:
+            request = json.loads(self.rfile.read(content_length) or b'{}')
+            session = UPLOAD_SESSIONS.create(request.get('filename'), request.get('size'), request.get('sha256'))
+        except (ValueError, AttributeError) as e:
+            status = e.status if isinstance(e, UploadSessionError) else 400
+            return self.send_json(status, {'status': 'error', 'message': str(e)})
+        if session.get('deduplicated'):
+            return self.send_json(200, {'status': 'success', 'name': session['filename'], 'deduplicated': True})
+        session['chunk_size'] = UPLOAD_SESSION_CHUNK_SIZE
+        self.send_json(201, session, {'Location': f"/api/uploads/{session['id']}"})
+
+    def handle_upload_session(self, path):
+        """GET state, PUT a Content-Range chunk, POST .../complete or DELETE one resumable upload"""
+        session_id, complete = UPLOAD_SESSION_ROUTE.match(path).groups()
+        if bool(complete) != (self.command == 'POST'):
+            self.close_connection = True
+            return self.send_json(405, {'status': 'error', 'message': 'Method not allowed'})
+        try:
+            if self.command == 'PUT':
+                session = self.receive_upload_chunk(session_id)
+            elif self.command == 'DELETE':
+                UPLOAD_SESSIONS.abort(session_id)
+                return self.send_json(200, {'status': 'success', 'message': 'Upload cancelled'})
+            elif complete:
+                final_path, missing = UPLOAD_SESSIONS.complete(session_id)
+                if missing:
+                    return self.send_json(409, {'status': 'error', 'message': 'Upload is incomplete', 'missing': missing})
+                return self.send_json(200, {'status': 'success', 'name': os.path.basename(final_path)})
+            else:
+                session = UPLOAD_SESSIONS.get(session_id)
+        except UploadSessionError as e:
+            if self.command == 'PUT':
+                self.close_connection = True  # The chunk body may be partly unread
+            return self.send_json(e.status, {'status': 'error', 'message': str(e)})
+        session['chunk_size'] = UPLOAD_SESSION_CHUNK_SIZE
+        session['received'] = sum(end - start for start, end in session['committed'])
+        self.send_json(200, session)
+
+    def receive_upload_chunk(self, session_id):
+        """Stream a PUT body carrying Content-Range: bytes start-end/size into the session"""
+        content_length = int(self.headers.get("Content-Length", 0))
+        match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', self.headers.get('Content-Range', '').strip())
+        if not match:
+            raise UploadSessionError(400, "Content-Range: bytes start-end/size is required")
+        start, last, size = (int(value) for value in match.groups())
+        if last - start + 1 != content_length:
+            raise UploadSessionError(400, "Content-Length does not match Content-Range")
+        if size != UPLOAD_SESSIONS.get(session_id)['size']:
+            raise UploadSessionError(416, "Content-Range size does not match the upload")
+
+        def body():
+            remaining = content_length
+            while remaining > 0:
+                chunk = self.rfile.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+        return UPLOAD_SESSIONS.write_chunk(session_id, start, last + 1, body())
+
+    def handle_events(self, query_string):
+        """Subscribe to live changes of one directory as Server-Sent Events, streamed by EVENT_HUB"""
+        dirpath = resolve_share_path(urllib.parse.parse_qs(query_string).get('path', [''])[0])
+        if dirpath is None or not os.path.isdir(dirpath):
+            return self.send_json(404, {'status': 'error', 'message': 'Directory not found'})
+        if FILE_WATCHER.thread is None or len(EVENT_HUB.streams) >= SSE_MAX_STREAMS:
+            # EventSource gives up on a 503, the page then reloads after changes as before
+            return self.send_json(503, {'status': 'error', 'message': 'Live updates are unavailable'})
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('X-Accel-Buffering', 'no')  # Keep reverse proxies from buffering the stream
+        self.cache_control = 'no-cache'
+        self.end_headers()
+        try:
+            self.wfile.write(b'retry: 3000\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        # The hub owns the connection from here on, closing the handler's socket object leaves it open
+        EVENT_HUB.subscribe(socket.socket(fileno=self.connection.detach()), dirpath)
+
+    def handle_api_bandwidth(self):
+        """Report shaping limits and active transfers; POST {"global_limit": B/s, "client_limit": B/s} changes them"""
+        if self.command == 'POST':
+            content_length = int(self.headers.get("Content-Length", 0))
+            if content_length > MAX_FORM_FIELD_SIZE:
+                self.close_connection = True
+                return self.send_json(413, {'status': 'error', 'message': 'Request too large'})
+            try:
+                limits = json.loads(self.rfile.read(content_length) or b'{}')
+                SHAPER.set_limits(limits.get('global_limit'), limits.get('client_limit'))
+            except (ValueError, TypeError, AttributeError):
+                return self.send_json(400, {'status': 'error', 'message': 'Limits must be numbers of bytes per second'})
+            if SHAPER.processes > 1:
+                try:
+                    SHAPER.share_limits()
+                except OSError as e:
+                    return self.send_json(500, {'status': 'error', 'message': f'Could not share the limits with the other workers: {e}'})
+        self.send_json(200, SHAPER.snapshot())
+
+    def handle_api_status(self):
+        """Report worker pool gauges"""
+        status = LOAD_GAUGES.snapshot()
+        status.update({
+            'workers': MAX_WORKERS,
+            'queue_capacity': MAX_QUEUED_CONNECTIONS,
+            'heavy_limit': MAX_HEAVY_REQUESTS,
+            'watcher': FILE_WATCHER.backend,
+            'watched_directories': len(FILE_WATCHER.watched),
+        })
+        self.send_json(200, status)
+
+    def handle_metrics(self):
+        """Serve per-route request metrics and the server gauges in the Prometheus text format"""
+        gauges = LOAD_GAUGES.snapshot()
+        hits, misses = LISTING_CACHE.hits, LISTING_CACHE.misses
+        body = METRICS.render([
+            ('fileserver_connections', 'gauge', 'Open client connections', self.server.connection_count()),
+            ('fileserver_queued_requests', 'gauge', 'Requests waiting for a worker thread', gauges['queued']),
+            ('fileserver_busy_workers', 'gauge', 'Worker threads answering a request', gauges['active_workers']),
+            ('fileserver_heavy_requests', 'gauge', 'Uploads and ZIP builds holding a slot', gauges['heavy_active']),
+            ('fileserver_rejected_requests_total', 'counter', 'Requests answered with 503 under load', gauges['rejected']),
+            ('fileserver_event_streams', 'gauge', 'Browsers subscribed to live folder updates', len(EVENT_HUB.streams)),
+            ('fileserver_listing_cache_hits_total', 'counter', 'Directory listings served from the cache', hits),
+            ('fileserver_listing_cache_misses_total', 'counter', 'Directory listings scanned from disk', misses),
+            ('fileserver_listing_cache_hit_ratio', 'gauge', 'Share of listings served from the cache',
+             round(hits / (hits + misses), 4) if hits + misses else 0),
+        ]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_json(self, status, payload, headers=None):
+        """Send a JSON response with an explicit Content-Length"""
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     def handle_multipart_upload(self):
         """Legacy multipart upload handling"""
         content_length = int(self.headers.get("Content-Length", 0))
-        content_type = self.headers.get("Content-Type", "")
+        boundary = get_multipart_boundary(self.headers.get("Content-Type", ""))
 
-        if "multipart/form-data" not in content_type:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Invalid upload request")
+        if not boundary or content_length > MAX_UPLOAD_SIZE:
+            self.send_error(400, "Invalid upload request")
             return
 
-        boundary = content_type.split("boundary=")[-1].encode()
-        body = self.rfile.read(content_length)
-
-        parts = body.split(b"--" + boundary)
-        for part in parts:
-            if b"Content-Disposition" in part and b"filename=" in part:
-                try:
-                    header, file_data = part.split(b"\r\n\r\n", 1)
-                except ValueError:
-                    continue
-                file_data = file_data.rsplit(b"\r\n", 1)[0]
-                header_str = header.decode(errors="ignore")
-
-                filename_marker = 'filename="'
-                filename_start = header_str.find(filename_marker)
-                if filename_start != -1:
-                    filename_start += len(filename_marker)
-                    filename_end = header_str.find('"', filename_start)
-                    filename = header_str[filename_start:filename_end]
-                    if filename:
-                        filepath = os.path.join(DIRECTORY, os.path.basename(filename))
-                        with open(filepath, "wb") as f:
-                            f.write(file_data)
+        try:
+            self.save_multipart_files(boundary, content_length)
+        except MultipartError as e:
+            self.send_error(400, str(e))
+            return
 
         self.send_response(303)
         self.send_header("Location", "/")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
+    def save_multipart_files(self, boundary, content_length):
+        """Stream every file part of a multipart request body straight to disk"""
+        saved = []
+        for part in MultipartParser(self.rfile, boundary, content_length):
+            if part.filename and os.path.basename(part.filename) and not is_internal_path(os.path.basename(part.filename)):
+                saved.append(save_upload_stream(part.iter_chunks(), part.filename))
+        return saved
+
+class LoopSocketIO:
+    """Blocking file-like view of a non-blocking socket for code running on a worker thread.
+
+    Reads are served from the connection's shared buffer first, then
+    every socket operation is handed to the event loop, so the thread
+    blocks on a future while the loop keeps multiplexing all sockets.
+    Unread bytes stay in the shared buffer for the next request.
+    """
+
+    def __init__(self, loop, sock, buffer, requests_handled=0):
+        self.loop = loop
+        self.sock = sock
+        self.buffer = buffer
+        self.requests_handled = requests_handled  # Earlier requests on this connection
+        self.closed = False
+        self.sent = 0  # Bytes written, for /metrics
+
+    def _call(self, coro):
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, IDLE_TIMEOUT), self.loop)
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out") from None
+
+    def _fill(self):
+        data = self._call(self.loop.sock_recv(self.sock, UPLOAD_CHUNK_SIZE))
+        self.buffer += data
+        return bool(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self.buffer)
+        while len(self.buffer) < size and self._fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            index = self.buffer.find(b"\n", start)
+            if index != -1:
+                end = index + 1
+                break
+            if 0 <= limit <= len(self.buffer):
+                end = limit
+                break
+            start = len(self.buffer)
+            if not self._fill():
+                end = len(self.buffer)
+                break
+        if 0 <= limit < end:
+            end = limit
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self._call(self.loop.sock_sendall(self.sock, data))
+        self.sent += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def sendfile(self, f, offset=0, count=None):
+        sent = self._call(self.loop.sock_sendfile(self.sock, f, offset, count))
+        self.sent += sent
+        return sent
+
+    def detach(self):
+        """Release the socket to another owner, the engine's close then leaves it open"""
+        return self.sock.detach()
+
+class BridgedHandler(FileServerHandler):
+    """FileServerHandler that answers exactly one request on behalf of the asyncio engine"""
+
+    def setup(self):
+        self.connection = self.request
+        self.rfile = self.request
+        self.wfile = self.request
+
+    def handle(self):
+        self.requests_handled = self.request.requests_handled
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        # The engine owns the socket and decides whether the connection stays open
+        pass
+
+def open_regular_file(filepath):
+    """Open a regular file for a native async download, or return None to fall back"""
+    try:
+        f = open(filepath, 'rb')
+    except OSError:
+        return None
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        return None
+    return f, st
+
+class AsyncFileServer:
+    """asyncio engine: one coroutine per connection instead of one OS thread.
+
+    Request heads, keep-alive idling, UI assets and file downloads (through
+    loop.sock_sendfile, including ranges) are handled on the event loop,
+    with blocking filesystem calls in the loop's default executor. Every
+    other route is answered by FileServerHandler on one of MAX_WORKERS
+    threads through LoopSocketIO, so both engines serve exactly the same
+    behaviour.
+    """
+
+    def __init__(self, server_address, workers=MAX_WORKERS, listener=None):
+        self.server_address = server_address
+        self.listener = listener
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="worker")
+        self.loop = None
+        self.connections = set()
+        self.idle_connections = set()  # Tasks waiting for the first byte of their next request
+        self.draining = False
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Accept connections until SIGTERM, then drain in-flight requests"""
+        self.loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGTERM, stopping.set)
+        listener = self.listener or make_listener(self.server_address)
+        listener.setblocking(False)
+        with listener:
+            accepting = self.loop.create_task(self.accept_connections(listener))
+            await stopping.wait()
+            accepting.cancel()
+        self.draining = True
+        for task in self.idle_connections:
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=DRAIN_TIMEOUT)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def accept_connections(self, listener):
+        while True:
+            sock, address = await self.loop.sock_accept(listener)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            task = self.loop.create_task(self.handle_connection(sock, address))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+
+    async def handle_connection(self, sock, address):
+        buffer = bytearray()
+        task = asyncio.current_task()
+        try:
+            for requests_handled in range(MAX_KEEPALIVE_REQUESTS):
+                if not buffer:
+                    self.idle_connections.add(task)
+                try:
+                    head_end = await self.read_request_head(sock, buffer)
+                finally:
+                    self.idle_connections.discard(task)
+                if head_end is None:
+                    break
+                keep_alive = await self.handle_request(sock, address, buffer, head_end, requests_handled)
+                if not keep_alive or self.draining:
+                    break
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            sock.close()
+
+    async def read_request_head(self, sock, buffer):
+        """Wait without a thread until a full request head is buffered, None on close/idle timeout"""
+        while True:
+            while buffer[:2] == b"\r\n":
+                del buffer[:2]  # Stray CRLFs between pipelined requests
+            end = buffer.find(b"\r\n\r\n")
+            if end != -1:
+                return end + 4
+            if len(buffer) > MAX_REQUEST_HEAD_SIZE:
+                return None
+            data = await asyncio.wait_for(self.loop.sock_recv(sock, 65536), IDLE_TIMEOUT)
+            if not data:
+                return None
+            buffer += data
+
+    async def handle_request(self, sock, address, buffer, head_end, requests_handled):
+        """Answer one request natively or through a BridgedHandler, returns whether to keep the connection"""
+        request_line, _, header_block = bytes(buffer[:head_end]).partition(b"\r\n")
+        words = request_line.decode('iso-8859-1').split()
+        if len(words) == 3 and words[0] == 'GET':
+            method, target, version = words
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+            connection = headers.get('Connection', '').lower()
+            keep_alive = 'close' not in connection if version == 'HTTP/1.1' else 'keep-alive' in connection
+            keep_alive = keep_alive and requests_handled + 1 < MAX_KEEPALIVE_REQUESTS and not self.draining
+            started = time.perf_counter()
+            response, f = await self.plan_native_get(target, headers)
+            if response is not None:
+                del buffer[:head_end]
+                sent = 0
+                try:
+                    sent = await self.send_native(sock, address, response, f, keep_alive)
+                finally:
+                    if f is not None:
+                        f.close()
+                    if METRICS_ENABLED:
+                        METRICS.request(classify_route('GET', target), response.status, time.perf_counter() - started, 0, sent)
+                self.log_request(address, request_line, response.status)
+                return keep_alive
+
+        if LOAD_GAUGES.get('queued') >= MAX_QUEUED_CONNECTIONS:
+            LOAD_GAUGES.add('rejected')
+            await self.loop.sock_sendall(sock, overloaded_response())
+            return False
+        LOAD_GAUGES.add('queued')
+        handler = await self.loop.run_in_executor(self.executor, self.run_bridged, sock, buffer, address, requests_handled)
+        return not handler.close_connection
+
+    async def plan_native_get(self, target, headers):
+        """Plan a GET the loop can answer itself: UI assets and regular files"""
+        path = urllib.parse.unquote(urlparse(target).path)
+        if path.startswith('/static/'):
+            return plan_static_response(headers, path), None
+        if path == '/thumb':
+            return await self.loop.run_in_executor(None, plan_native_thumb, headers, urlparse(target).query)
+        if path in ('/', '/api/list', '/api/search', '/api/status', '/api/bandwidth', '/metrics', '/events') \
+                or path.startswith('/download_zip'):
+            return None, None
+        if resolve_share_path(path) is None:
+            body = b"File not found"
+            return PlannedResponse(404, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))],
+                                   [body], CACHE_POLICIES['default']), None
+        opened = await self.loop.run_in_executor(
+            None, open_regular_file, os.path.join(DIRECTORY, path.lstrip('/')))
+        if opened is None:
+            return None, None
+        f, st = opened
+        encoding = choose_content_encoding(headers, path, st)
+        if encoding == "identity":
+            return plan_file_response(headers, path, st), f
+        f.close()
+        sidecar = await self.loop.run_in_executor(None, ENCODED_CACHE.open, st, encoding)
+        if sidecar is not None:
+            return plan_encoded_response(headers, path, st, encoding, sidecar[1]), sidecar[0]
+        response = plan_encoded_response(headers, path, st, encoding)
+        if response.status != 200:
+            return response, None
+        return None, None  # Compressed on the fly by a bridged handler, which also builds the sidecar
+
+    async def send_native(self, sock, address, response, f, keep_alive):
+        """Send a PlannedResponse from the loop, returns the bytes sent"""
+        lines = [
+            f"HTTP/1.1 {response.status} {http.HTTPStatus(response.status).phrase}",
+            f"Server: {FileServerHandler.server_version} {FileServerHandler.sys_version}",
+            f"Date: {http_date(time.time())}",
+        ]
+        lines += [f"{key}: {value}" for key, value in response.headers]
+        if response.cache_control:
+            lines.append(f"Cache-Control: {response.cache_control}")
+        else:
+            lines += [f"Cache-Control: {CACHE_POLICIES['default']}", "Pragma: no-cache", "Expires: 0"]
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1', 'strict')
+        await self.loop.sock_sendall(sock, head)
+        size = sum(len(part) if isinstance(part, bytes) else part[1] for part in response.parts)
+        with SHAPER.transfer(address[0], size, TRANSFER_WEIGHTS['file']) as transfer:
+            for part in response.parts:
+                if isinstance(part, bytes):
+                    await self.loop.sock_sendall(sock, part)
+                    continue
+                offset, length = part
+                if transfer is None:
+                    await self.loop.sock_sendfile(sock, f, offset, length)
+                    continue
+                position, end = offset, offset + length
+                while position < end:
+                    count = min(SHAPING_SLICE, end - position) if transfer.rate else end - position
+                    await asyncio.sleep(transfer.reserve(count))
+                    await self.loop.sock_sendfile(sock, f, position, count)
+                    position += count
+        return len(head) + size
+
+    def run_bridged(self, sock, buffer, address, requests_handled):
+        """Executor side: let FileServerHandler answer the buffered request"""
+        LOAD_GAUGES.add('queued', -1)
+        LOAD_GAUGES.add('active_workers')
+        try:
+            return BridgedHandler(LoopSocketIO(self.loop, sock, buffer, requests_handled), address, self)
+        finally:
+            LOAD_GAUGES.add('active_workers', -1)
+
+    def is_busy(self):
+        # Idle connections cost a coroutine, not a worker, so they only need closing while draining
+        return self.draining
+
+    def connection_count(self):
+        return len(self.connections)
+
+    def log_request(self, address, request_line, status):
+        sys.stderr.write('%s - - [%s] "%s" %s -\n' % (
+            address[0], time.strftime("%d/%b/%Y %H:%M:%S"),
+            request_line.decode('iso-8859-1'), status))
+
+# Create a simple threaded server since ThreadingHTTPServer isn't available
+class ThreadedTCPServer(socketserver.TCPServer):
+    """TCP server handing connections to a fixed pool of MAX_WORKERS threads.
+
+    Accepted connections wait in a queue of MAX_QUEUED_CONNECTIONS; once it
+    is full new connections get an immediate 503 instead of a thread, so a
+    burst degrades into retries rather than exhausting memory and descriptors.
+    """
+    allow_reuse_address = True
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=MAX_WORKERS, queue_size=MAX_QUEUED_CONNECTIONS,
+                 listener=None):
+        # Set before binding: a failed bind calls server_close(), which stops the (not yet started) workers
+        self.draining = False
+        self.pending = queue.Queue(queue_size)
+        self.workers = []
+        super().__init__(server_address, handler_class, bind_and_activate=listener is None)
+        if listener is not None:
+            self.socket.close()
+            self.socket = listener
+            self.server_address = listener.getsockname()
+        self.workers = [threading.Thread(target=self.work, name=f"worker-{n}", daemon=True) for n in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def is_busy(self):
+        """Connections are waiting for a worker (or the server is stopping), so idle keep-alive ones should close"""
+        return self.draining or not self.pending.empty()
+
+    def connection_count(self):
+        """Connections waiting for or held by a worker thread"""
+        return LOAD_GAUGES.get('queued') + LOAD_GAUGES.get('active_workers')
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            LOAD_GAUGES.add('rejected')
+            try:
+                request.settimeout(1)
+                request.sendall(overloaded_response())
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        LOAD_GAUGES.add('queued')
+
+    def work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            LOAD_GAUGES.add('queued', -1)
+            LOAD_GAUGES.add('active_workers')
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                LOAD_GAUGES.add('active_workers', -1)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Let the workers finish queued and in-flight requests, waiting at most timeout seconds"""
+        self.stop_workers()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+
+    def stop_workers(self):
+        if not self.draining:
+            self.draining = True
+            for _ in self.workers:
+                self.pending.put(None)
+
+    def server_close(self):
+        super().server_close()
+        self.stop_workers()
+
+def make_listener(address, reuse_port=False):
+    """Listening socket for either engine, optionally one of several sharing the port"""
+    return socket.create_server(address, backlog=1024, reuse_port=reuse_port)
+
+def run_server(engine, listener=None):
+    """Serve on PORT with one engine until Ctrl+C, or SIGTERM which drains in-flight requests first"""
+    if WATCH_CHANGES:
+        FILE_WATCHER.start()
+    if SEARCH_INDEX_ENABLED:
+        try:
+            SEARCH_INDEX.start()
+        except sqlite3.Error as e:
+            print(f"⚠️  Search index unavailable: {e}")
+    if engine == "asyncio":
+        AsyncFileServer(("", PORT), listener=listener).serve_forever()
+        return
+    with ThreadedTCPServer(("", PORT), FileServerHandler, listener=listener) as httpd:
+        # shutdown() waits for serve_forever to return, so it cannot run in the handler itself
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+        httpd.serve_forever()
+        httpd.socket.close()
+        httpd.drain()
+
+class Supervisor:
+    """Pre-fork supervisor keeping `processes` server processes on one port.
+
+    Each worker process binds its own SO_REUSEPORT socket so the kernel
+    spreads connections across them (platforms without it share one
+    inherited listening socket). Crashed workers are restarted; SIGTERM or
+    Ctrl+C is forwarded as SIGTERM so every worker drains before exiting.
+    Caches stay per worker: listings revalidate against the directory
+    mtime on every request and their ETags are derived from the entries,
+    so all workers agree on them; the load gauges describe one worker.
+    """
+
+    def __init__(self, address, processes, engine):
+        self.address = address
+        self.processes = processes
+        self.engine = engine
+        self.children = {}  # pid -> monotonic start time
+        self.stopping = False
+        self.shared_listener = None
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.shared_listener = make_listener(self.address)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill_children)
+        signal.signal(signal.SIGUSR1, self.share_limits)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(BANDWIDTH_LIMITS_PATH)  # Left by an earlier run, start from the configured limits
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(WATCH_LEADER_PATH)  # So the first worker to claim it knows there is nothing to catch up on
+        for _ in range(self.processes):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            print(f"⚠️  Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < 1:
+                time.sleep(1)  # Do not spin on a worker that crashes at startup
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches workers through the supervisor
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            # A thread, since the signal may interrupt this thread while it holds the shaper's lock
+            signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=SHAPER.load_limits).start())
+            listener = self.shared_listener or make_listener(self.address, reuse_port=True)
+            SHAPER.processes = self.processes
+            SHAPER.load_limits()  # A restarted worker picks up limits changed at runtime
+            run_server(self.engine, listener)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return self.kill_children(signum, frame)  # A second Ctrl+C does not wait for the drain
+        self.stopping = True
+        self.signal_children(signal.SIGTERM)
+        signal.alarm(DRAIN_TIMEOUT + 5)
+
+    def kill_children(self, signum, frame):
+        self.signal_children(signal.SIGKILL)
+
+    def share_limits(self, signum, frame):
+        """A worker published new bandwidth limits, have every worker load them"""
+        self.signal_children(signal.SIGUSR1)
+
+    def signal_children(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local file sharing server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded: one OS thread per connection; asyncio: event loop with sendfile")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server processes sharing the port (pre-fork, one per core to use them all)")
+    parser.add_argument("--dedup", action="store_true", default=DEDUP_STORAGE,
+                        help="store identical uploads once in a content-addressed store, hardlinked into the tree")
+    parser.add_argument("--gc", action="store_true",
+                        help="remove stored blobs no longer linked from the shared tree, then exit")
+    args = parser.parse_args()
+    DEDUP_STORAGE = args.dedup
+
     os.makedirs(DIRECTORY, exist_ok=True)
+    if args.gc or DEDUP_STORAGE:
+        blobs, freed = BLOB_STORE.collect()
+        print(f"🧹 Removed {blobs} unreferenced blobs ({freed // (1024*1024)}MB)")
+        if args.gc:
+            sys.exit(0)
     ip = get_local_ip()
     
-    # Create a simple threaded server since ThreadingHTTPServer isn't available
-    class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-        allow_reuse_address = True
-    
-    print("🚀 Serving '{DIRECTORY}' with threading support")
+    print(f"🚀 Serving '{DIRECTORY}' with the {args.engine} engine"
+          + (f" in {args.workers} worker processes" if args.workers > 1 else ""))
     print(f"📍 Local:   http://localhost:{PORT}")
     print(f"🌍 Network: http://{ip}:{PORT}")
     print(f"📊 Max upload size: {MAX_UPLOAD_SIZE // (1024*1024)}MB")
     print(f"⚡ Chunk size: {CHUNK_SIZE // 1024}KB")
     print("Press Ctrl+C to stop the server")
     
-    with ThreadedTCPServer(("", PORT), FileServerHandler) as httpd:
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n🛑 Server stopped")
-        
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n🛑 Server stopped")
\ No newline at end of file
+    try:
+        if args.workers > 1:
+            Supervisor(("", PORT), args.workers, args.engine).run()
+        else:
+            run_server(args.engine)
+    except KeyboardInterrupt:
+        pass
+    print("\n🛑 Server stopped")